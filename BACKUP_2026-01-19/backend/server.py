@@ -1,14 +1,31 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pydantic import ValidationError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, create_model
+from typing import Dict, List, Optional
 import uuid
+import time
+import math
+import hashlib
+import csv
+import codecs
+import re
+import unicodedata
+import io
+import json
+import asyncio
+import base64
+import heapq
+import bisect
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 import jwt
@@ -27,6 +44,43 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = os.environ.get("SECRET_KEY", "rihla-enterprise-secret-key-2024")
 ALGORITHM = "HS256"
 security = HTTPBearer()
+DASHBOARD_CACHE_TTL = float(os.environ.get("DASHBOARD_CACHE_TTL", "30"))
+DASHBOARD_CACHE_MAX_ENTRIES = int(os.environ.get("DASHBOARD_CACHE_MAX_ENTRIES", "256"))
+BASE_CURRENCY = os.environ.get("BASE_CURRENCY", "SAR")
+FX_CACHE_TTL = float(os.environ.get("FX_CACHE_TTL", "60"))
+SKETCH_FLUSH_INTERVAL = float(os.environ.get("SKETCH_FLUSH_INTERVAL", "30"))
+WAREHOUSES = [name.strip() for name in os.environ.get("WAREHOUSES", "main").split(",") if name.strip()]
+DEFAULT_WAREHOUSE = WAREHOUSES[0]
+SALES_FLUSH_INTERVAL = float(os.environ.get("SALES_FLUSH_INTERVAL", "5"))
+SALES_FLUSH_MAX_EVENTS = int(os.environ.get("SALES_FLUSH_MAX_EVENTS", "500"))
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "500"))
+SEARCH_CANDIDATE_LIMIT = int(os.environ.get("SEARCH_CANDIDATE_LIMIT", "500"))
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "1"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "2"))
+OUTBOX_LEASE_SECONDS = float(os.environ.get("OUTBOX_LEASE_SECONDS", "30"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETENTION_DAYS = int(os.environ.get("OUTBOX_RETENTION_DAYS", "7"))
+INSTANCE_ID = str(uuid.uuid4())
+# 0 disables coalescing: every checkout writes its own order
+WRITE_COALESCE_WINDOW_MS = float(os.environ.get("WRITE_COALESCE_WINDOW_MS", "0"))
+WRITE_COALESCE_MAX_DOCS = int(os.environ.get("WRITE_COALESCE_MAX_DOCS", "200"))
+SYNC_SETTLE_SECONDS = float(os.environ.get("SYNC_SETTLE_SECONDS", "5"))
+SYNC_TOMBSTONE_DAYS = int(os.environ.get("SYNC_TOMBSTONE_DAYS", "30"))
+ETAG_VERSION_TTL = float(os.environ.get("ETAG_VERSION_TTL", "1"))
+ETAG_SETTLE_SECONDS = float(os.environ.get("ETAG_SETTLE_SECONDS", "1"))
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "500"))
+# 0 disables the scheduled job; POST /api/admin/archive/run still works
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_WATERMARK_TTL = float(os.environ.get("ARCHIVE_WATERMARK_TTL", "30"))
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "5"))
+SUGGEST_SCAN_LIMIT = int(os.environ.get("SUGGEST_SCAN_LIMIT", "2000"))
+LOW_STOCK_WATCH_INTERVAL = float(os.environ.get("LOW_STOCK_WATCH_INTERVAL", "30"))
+LOW_STOCK_WATCH_OVERLAP = float(os.environ.get("LOW_STOCK_WATCH_OVERLAP", "60"))
+STOCK_SNAPSHOT_INTERVAL = float(os.environ.get("STOCK_SNAPSHOT_INTERVAL", "3600"))
+# Movements younger than this are left for the next run, so a write still in flight cannot land behind a snapshot
+STOCK_SNAPSHOT_LAG = float(os.environ.get("STOCK_SNAPSHOT_LAG", "300"))
 
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -76,6 +130,11 @@ class OrderItem(BaseModel):
     price: float
     total: float
 
+class StockAllocation(BaseModel):
+    product_id: str
+    location: str
+    quantity: int
+
 class Order(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -96,7 +155,47 @@ class Order(BaseModel):
     shipping_charges: float = 0.0
     payment_method: str = "Cash on delivery"
     total: float
+    total_base: Optional[float] = None
+    fx_rate: Optional[float] = None
+    fx_version: Optional[int] = None
     status: str
+    allocations: List[StockAllocation] = []
+    returned_quantities: Dict[str, int] = {}
+    refunded_total: float = 0.0
+    created_by: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ReturnItemCreate(BaseModel):
+    product_id: str
+    quantity: int
+
+class ReturnCreate(BaseModel):
+    order_id: str
+    items: List[ReturnItemCreate]
+    reason: Optional[str] = None
+    restock: bool = True
+    location: Optional[str] = None
+
+class ReturnItem(BaseModel):
+    product_id: str
+    product_name: str
+    quantity: int
+    amount: float
+
+class OrderReturn(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    rma_number: str
+    order_id: str
+    order_number: str
+    customer_email: Optional[str] = None
+    customer_phone: Optional[str] = None
+    items: List[ReturnItem]
+    currency: str = "SAR"
+    refund_amount: float
+    refund_base: Optional[float] = None
+    restocked: List[StockAllocation] = []
+    reason: Optional[str] = None
     created_by: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -114,6 +213,14 @@ class OrderCreate(BaseModel):
     payment_method: str = "Cash on delivery"
     status: str = "pending"
 
+class OrderStatusBulkUpdate(BaseModel):
+    order_ids: List[str] = Field(min_length=1, max_length=1000)
+    status: str
+
+class OrderImportRow(OrderCreate):
+    order_number: Optional[str] = None
+    created_at: Optional[datetime] = None
+
 class Product(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -125,6 +232,9 @@ class Product(BaseModel):
     stock: int
     price: float
     image_url: Optional[str] = None
+    reorder_level: Optional[int] = None
+    units_sold: int = 0
+    revenue: float = 0.0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ProductCreate(BaseModel):
@@ -135,10 +245,27 @@ class ProductCreate(BaseModel):
     stock: int
     price: float
     image_url: Optional[str] = None
+    reorder_level: Optional[int] = None
+    location: Optional[str] = None
+
+class ProductBulkRow(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    sku: str
+    name: Optional[str] = None
+    brand_id: Optional[str] = None
+    category: Optional[str] = None
+    price: Optional[float] = None
+    image_url: Optional[str] = None
+    reorder_level: Optional[int] = None
+    stock: Optional[int] = None
+    stock_delta: Optional[int] = None
+    location: Optional[str] = None
 
 class ProductUpdate(BaseModel):
     stock: Optional[int] = None
+    location: Optional[str] = None
     category: Optional[str] = None
+    reorder_level: Optional[int] = None
 
 class Customer(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -150,6 +277,64 @@ class Customer(BaseModel):
     lifetime_value: float = 0.0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class Supplier(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    email: Optional[EmailStr] = None
+    phone: Optional[str] = None
+    address: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class SupplierCreate(BaseModel):
+    name: str
+    email: Optional[EmailStr] = None
+    phone: Optional[str] = None
+    address: Optional[str] = None
+
+class PurchaseOrderLineCreate(BaseModel):
+    product_id: Optional[str] = None
+    sku: Optional[str] = None
+    quantity: int
+    unit_cost: float = 0.0
+
+class PurchaseOrderLine(BaseModel):
+    product_id: str
+    sku: str
+    product_name: str
+    quantity: int
+    unit_cost: float = 0.0
+    received_quantity: int = 0
+
+class PurchaseOrderCreate(BaseModel):
+    supplier_id: str
+    location: Optional[str] = None
+    lines: List[PurchaseOrderLineCreate]
+    notes: Optional[str] = None
+
+class PurchaseOrder(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    po_number: str
+    supplier_id: str
+    supplier_name: str
+    location: str
+    lines: List[PurchaseOrderLine]
+    total_cost: float = 0.0
+    status: str = "open"
+    notes: Optional[str] = None
+    created_by: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    received_at: Optional[datetime] = None
+
+class PurchaseOrderReceiptLine(BaseModel):
+    product_id: str
+    quantity: int = Field(gt=0)
+
+class PurchaseOrderReceipt(BaseModel):
+    # Without lines, everything still outstanding is received
+    lines: Optional[List[PurchaseOrderReceiptLine]] = None
+
 class CustomerCreate(BaseModel):
     name: str
     email: EmailStr
@@ -196,7 +381,19 @@ class EmployeeUpdate(BaseModel):
     achieved: Optional[float] = None
     status: Optional[str] = None
 
+class FxRate(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    currency: str
+    rate: float
+    version: int
+    updated_by: Optional[str] = None
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class FxRateUpdate(BaseModel):
+    rate: float = Field(gt=0)
+
 class DashboardMetrics(BaseModel):
+    currency: str = BASE_CURRENCY
     total_revenue: float
     total_orders: int
     total_customers: int
@@ -204,11 +401,174 @@ class DashboardMetrics(BaseModel):
     revenue_change: float
     orders_change: float
 
+class BrandMetrics(BaseModel):
+    brand_id: str
+    brand_name: str
+    total_revenue: float
+    total_orders: int
+    total_products: int
+
+class BrandsSummary(BaseModel):
+    brands: List[BrandMetrics]
+    total: DashboardMetrics
+
 class RevenueTrend(BaseModel):
     date: str
     revenue: float
     brand_id: Optional[str] = None
 
+class TDigest:
+    """Mergeable quantile sketch (merging t-digest with the k1 scale function)."""
+
+    def __init__(self, compression: float = 100, centroids: Optional[list] = None, min_value: Optional[float] = None, max_value: Optional[float] = None):
+        self.compression = compression
+        self.centroids = centroids or []
+        self.min = min_value
+        self.max = max_value
+        self._buffer = []
+
+    @property
+    def count(self) -> float:
+        self._compress()
+        return sum(w for _, w in self.centroids)
+
+    def add(self, value: float, weight: float = 1):
+        self._buffer.append([float(value), weight])
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) > self.compression * 5:
+            self._compress()
+
+    def merge(self, other: "TDigest"):
+        other._compress()
+        if not other.centroids:
+            return
+        self._buffer.extend([m, w] for m, w in other.centroids)
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress()
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _k_inverse(self, k: float) -> float:
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        items = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        total = sum(w for _, w in items)
+        merged = []
+        mean, weight = items[0]
+        cumulative = 0.0
+        q_limit = self._k_inverse(self._k(0) + 1)
+        for m, w in items[1:]:
+            if (cumulative + weight + w) / total <= q_limit:
+                mean += (m - mean) * w / (weight + w)
+                weight += w
+            else:
+                merged.append([mean, weight])
+                cumulative += weight
+                q_limit = self._k_inverse(self._k(cumulative / total) + 1)
+                mean, weight = m, w
+        merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q: float) -> Optional[float]:
+        self._compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        total = sum(w for _, w in self.centroids)
+        target = q * total
+        first_mean, first_weight = self.centroids[0]
+        if target < first_weight / 2:
+            return self.min + (first_mean - self.min) * target / (first_weight / 2)
+        cumulative = 0.0
+        for (m1, w1), (m2, w2) in zip(self.centroids, self.centroids[1:]):
+            left = cumulative + w1 / 2
+            right = cumulative + w1 + w2 / 2
+            if target <= right:
+                return m1 + (m2 - m1) * (target - left) / (right - left)
+            cumulative += w1
+        last_mean, last_weight = self.centroids[-1]
+        tail = (target - (total - last_weight / 2)) / (last_weight / 2)
+        return last_mean + (self.max - last_mean) * min(tail, 1.0)
+
+    def summary(self) -> dict:
+        self._compress()
+        total = sum(w for _, w in self.centroids)
+        return {
+            "count": int(total),
+            "min": self.min,
+            "max": self.max,
+            "mean": sum(m * w for m, w in self.centroids) / total if total else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99)
+        }
+
+    def to_doc(self) -> dict:
+        self._compress()
+        return {"compression": self.compression, "centroids": self.centroids, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_doc(cls, doc: Optional[dict]) -> "TDigest":
+        if not doc:
+            return cls()
+        return cls(doc.get("compression", 100), doc.get("centroids"), doc.get("min"), doc.get("max"))
+
+class HyperLogLog:
+    """Mergeable distinct-count sketch; relative error is about 1.04 / sqrt(2 ** precision)."""
+
+    def __init__(self, precision: int = 12, registers: Optional[bytes] = None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.m)
+
+    def add(self, value: str):
+        h = int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches with different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        raw = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * self.m and zeros:
+            return round(self.m * math.log(self.m / zeros))
+        return round(raw)
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(self.m)
+
+    def to_doc(self) -> dict:
+        return {"precision": self.precision, "registers": bytes(self.registers)}
+
+    @classmethod
+    def from_doc(cls, doc: Optional[dict]) -> "HyperLogLog":
+        if not doc:
+            return cls()
+        return cls(doc.get("precision", 12), doc.get("registers"))
+
+ORDER_SKETCH_TYPES = {
+    "order_value": TDigest,
+    "basket_size": TDigest,
+    "customers": HyperLogLog
+}
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(days=7)
@@ -313,16 +673,83 @@ async def get_brands():
     ]
     return brands
 
+_fx_cache = {"version": None, "rates": {BASE_CURRENCY: 1.0}, "checked_at": 0.0}
+
+async def get_fx_rates():
+    if _fx_cache["version"] is not None and time.monotonic() - _fx_cache["checked_at"] < FX_CACHE_TTL:
+        return _fx_cache["version"], _fx_cache["rates"]
+    
+    counter = await db.counters.find_one({"_id": "fx_rates_version"})
+    version = counter["seq"] if counter else 0
+    if version != _fx_cache["version"]:
+        rates = {BASE_CURRENCY: 1.0}
+        async for doc in db.fx_rates.find({}, {"_id": 0, "currency": 1, "rate": 1}):
+            rates[doc["currency"]] = doc["rate"]
+        _fx_cache["rates"] = rates
+        _fx_cache["version"] = version
+    _fx_cache["checked_at"] = time.monotonic()
+    return _fx_cache["version"], _fx_cache["rates"]
+
+async def backfill_total_base(currency: str, rate: float):
+    result = await db.orders.update_many(
+        {"currency": currency, "total_base": None},
+        [{"$set": {"total_base": {"$multiply": ["$total", rate]}, "fx_rate": rate, **await stamp_update("orders")}}]
+    )
+    return result.modified_count
+
+@api_router.get("/fx-rates")
+async def get_fx_rate_table(_: dict = Depends(verify_token)):
+    version, _rates = await get_fx_rates()
+    rates = await db.fx_rates.find({}, {"_id": 0}).sort("currency", 1).to_list(100)
+    return {"base_currency": BASE_CURRENCY, "version": version, "rates": rates}
+
+@api_router.put("/fx-rates/{currency}", response_model=FxRate)
+async def update_fx_rate(currency: str, update_data: FxRateUpdate, current_user: dict = Depends(verify_token)):
+    admin_doc = await db.users.find_one({"email": current_user["sub"]}, {"_id": 0})
+    if not admin_doc or admin_doc.get('role') != 'admin':
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    currency = currency.upper()
+    if currency == BASE_CURRENCY and update_data.rate != 1.0:
+        raise HTTPException(status_code=400, detail=f"{BASE_CURRENCY} is the base currency and always has rate 1.0")
+    
+    # The rate is written before the version moves, so a reader that sees the new version also sees the new rate
+    updated_at = datetime.now(timezone.utc)
+    await db.fx_rates.update_one(
+        {"currency": currency},
+        {"$set": {"currency": currency, "rate": update_data.rate, "updated_by": current_user.get("sub"), "updated_at": updated_at.isoformat()}},
+        upsert=True
+    )
+    counter = await db.counters.find_one_and_update(
+        {"_id": "fx_rates_version"},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    await db.fx_rates.update_one({"currency": currency}, {"$max": {"version": counter["seq"]}})
+    fx_rate = FxRate(currency=currency, rate=update_data.rate, version=counter["seq"], updated_by=current_user.get("sub"), updated_at=updated_at)
+    
+    _fx_cache["checked_at"] = 0.0
+    await backfill_total_base(currency, update_data.rate)
+    return fx_rate
+
 @api_router.get("/dashboard/metrics", response_model=DashboardMetrics)
 async def get_dashboard_metrics(brand_id: Optional[str] = None, _: dict = Depends(verify_token)):
     filter_query = {"brand_id": brand_id} if brand_id else {}
     
-    orders = await db.orders.find(filter_query, {"_id": 0}).to_list(10000)
-    total_revenue = sum(o.get('total', 0) for o in orders)
-    total_orders = len(orders)
+    totals = await db.orders.aggregate([
+        {"$match": filter_query},
+        {"$group": {"_id": None, "total_revenue": {"$sum": "$total_base"}, "total_orders": {"$sum": 1}}}
+    ]).to_list(1)
+    total_revenue = totals[0]["total_revenue"] if totals else 0
+    total_orders = totals[0]["total_orders"] if totals else 0
+    
+    archive_query = {"_id": brand_id} if brand_id else {}
+    async for archived in db.archive_totals.find(archive_query):
+        total_revenue += archived["total_revenue"]
+        total_orders += archived["total_orders"]
     
-    customers = await db.customers.find({}, {"_id": 0}).to_list(10000)
-    total_customers = len(customers)
+    total_customers = await db.customers.count_documents({})
     
     products_query = {"brand_id": brand_id} if brand_id else {}
     total_products = await db.products.count_documents(products_query)
@@ -336,6 +763,60 @@ async def get_dashboard_metrics(brand_id: Optional[str] = None, _: dict = Depend
         orders_change=8.3
     )
 
+@api_router.get("/dashboard/brands-summary", response_model=BrandsSummary)
+async def get_brands_summary(_: dict = Depends(verify_token)):
+    # Sorting on brand_id lets the planner answer from the (brand_id, total_base) index without fetching documents
+    pipeline = [
+        {"$sort": {"brand_id": 1}},
+        {"$project": {"_id": 0, "brand_id": 1, "total_base": 1}},
+        {"$facet": {
+            "by_brand": [
+                {"$group": {"_id": "$brand_id", "total_revenue": {"$sum": "$total_base"}, "total_orders": {"$sum": 1}}}
+            ],
+            "overall": [
+                {"$group": {"_id": None, "total_revenue": {"$sum": "$total_base"}, "total_orders": {"$sum": 1}}}
+            ]
+        }}
+    ]
+    facets = await db.orders.aggregate(pipeline).to_list(1)
+    by_brand = {row["_id"]: row for row in facets[0]["by_brand"]} if facets else {}
+    overall = dict(facets[0]["overall"][0]) if facets and facets[0]["overall"] else {"total_revenue": 0, "total_orders": 0}
+    async for archived in db.archive_totals.find({}):
+        row = by_brand.setdefault(archived["_id"], {"total_revenue": 0, "total_orders": 0})
+        for field in ("total_revenue", "total_orders"):
+            row[field] += archived[field]
+            overall[field] += archived[field]
+    
+    product_counts = await db.products.aggregate([
+        {"$group": {"_id": "$brand_id", "count": {"$sum": 1}}}
+    ]).to_list(100)
+    products_by_brand = {row["_id"]: row["count"] for row in product_counts}
+    
+    total_customers = await db.customers.count_documents({})
+    
+    brands = []
+    for brand in await get_brands():
+        row = by_brand.get(brand["id"], {})
+        brands.append(BrandMetrics(
+            brand_id=brand["id"],
+            brand_name=brand["name"],
+            total_revenue=row.get("total_revenue", 0),
+            total_orders=row.get("total_orders", 0),
+            total_products=products_by_brand.get(brand["id"], 0)
+        ))
+    
+    return BrandsSummary(
+        brands=brands,
+        total=DashboardMetrics(
+            total_revenue=overall.get("total_revenue", 0),
+            total_orders=overall.get("total_orders", 0),
+            total_customers=total_customers,
+            total_products=sum(products_by_brand.values()),
+            revenue_change=12.5,
+            orders_change=8.3
+        )
+    )
+
 @api_router.get("/dashboard/revenue-trend", response_model=List[RevenueTrend])
 async def get_revenue_trend(brand_id: Optional[str] = None, _: dict = Depends(verify_token)):
     from datetime import timedelta
@@ -346,20 +827,528 @@ async def get_revenue_trend(brand_id: Optional[str] = None, _: dict = Depends(ve
         trends.append({"date": date, "revenue": revenue, "brand_id": brand_id})
     return trends
 
+@api_router.get("/dashboard/top-products")
+async def get_top_products(brand_id: Optional[str] = None, limit: int = 5, _: dict = Depends(verify_token)):
+    pipeline = []
+    if brand_id:
+        pipeline.append({"$match": {"brand_id": brand_id}})
+    limit = min(max(limit, 1), 50)
+    # Archived orders count through their per-product rollups, like archive_totals in the metrics
+    archived = await db.archive_product_totals.find({"brand_id": brand_id} if brand_id else {}, {"_id": 0}).to_list(None)
+    pipeline += [
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": "$items.product_id",
+            "product_name": {"$first": "$items.product_name"},
+            "quantity": {"$sum": "$items.quantity"},
+            "revenue": {"$sum": {"$multiply": ["$items.total", {"$ifNull": ["$fx_rate", 1]}]}}
+        }},
+        {"$sort": {"quantity": -1}},
+        *([] if archived else [{"$limit": limit}])
+    ]
+    totals = {}
+    for r in await db.orders.aggregate(pipeline).to_list(None):
+        totals[r["_id"]] = {"product_id": r["_id"], "product_name": r["product_name"], "quantity": r["quantity"], "revenue": r["revenue"]}
+    for r in archived:
+        row = totals.setdefault(r["product_id"], {"product_id": r["product_id"], "product_name": r["product_name"], "quantity": 0, "revenue": 0.0})
+        row["quantity"] += r["quantity"]
+        row["revenue"] += r["revenue"]
+    return sorted(totals.values(), key=lambda row: -row["quantity"])[:limit]
+
+@api_router.get("/dashboard/recent-orders")
+async def get_recent_orders(brand_id: Optional[str] = None, limit: int = 5, _: dict = Depends(verify_token)):
+    filter_query = {"brand_id": brand_id} if brand_id else {}
+    projection = {"_id": 0, "id": 1, "order_number": 1, "customer_name": 1, "brand_id": 1, "currency": 1, "total": 1, "status": 1, "created_at": 1}
+    limit = min(max(limit, 1), 50)
+    return await db.orders.find(filter_query, projection).sort("created_at", -1).limit(limit).to_list(limit)
+
+DASHBOARD_SECTIONS = {
+    "metrics": lambda brand_id, payload: get_dashboard_metrics(brand_id, payload),
+    "brands_summary": lambda brand_id, payload: get_brands_summary(payload),
+    "trend": lambda brand_id, payload: get_revenue_trend(brand_id, payload),
+    "top_products": lambda brand_id, payload: get_top_products(brand_id, 5, payload),
+    "recent_orders": lambda brand_id, payload: get_recent_orders(brand_id, 5, payload)
+}
+
+# Sections that cover every brand share one cache entry whatever brand_id was asked for
+BRAND_AGNOSTIC_SECTIONS = {"brands_summary"}
+_dashboard_cache = {}
+
+async def _cached_dashboard_section(name: str, brand_id: Optional[str], payload: dict):
+    key = (name, None if name in BRAND_AGNOSTIC_SECTIONS else brand_id)
+    cached = _dashboard_cache.get(key)
+    now = time.monotonic()
+    if cached and cached[0] > now:
+        return cached[1], True
+    
+    value = await DASHBOARD_SECTIONS[name](brand_id, payload)
+    if DASHBOARD_CACHE_TTL > 0:
+        for expired in [k for k, (expires, _) in _dashboard_cache.items() if expires <= now]:
+            del _dashboard_cache[expired]
+        while len(_dashboard_cache) >= DASHBOARD_CACHE_MAX_ENTRIES:
+            del _dashboard_cache[next(iter(_dashboard_cache))]
+        _dashboard_cache.pop(key, None)
+        _dashboard_cache[key] = (now + DASHBOARD_CACHE_TTL, value)
+    return value, False
+
+@api_router.get("/dashboard/bundle")
+async def get_dashboard_bundle(parts: str = "metrics,trend,top_products,recent_orders", brand_id: Optional[str] = None, payload: dict = Depends(verify_token)):
+    requested = list(dict.fromkeys(p.strip() for p in parts.split(",") if p.strip()))
+    unknown = [p for p in requested if p not in DASHBOARD_SECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown dashboard parts: {', '.join(unknown)}")
+    if brand_id and brand_id not in {b["id"] for b in await get_brands()}:
+        raise HTTPException(status_code=400, detail=f"Unknown brand '{brand_id}'")
+    
+    async def run_section(name):
+        started = time.perf_counter()
+        try:
+            value, cached = await _cached_dashboard_section(name, brand_id, payload)
+            error = None
+        except HTTPException as e:
+            value, cached, error = None, False, e.detail
+        except Exception as e:
+            logger.exception(f"Dashboard section {name} failed")
+            value, cached, error = None, False, str(e)
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        return name, value, {"ms": elapsed_ms, "cached": cached, "error": error}
+    
+    started = time.perf_counter()
+    results = await asyncio.gather(*(run_section(name) for name in requested))
+    
+    return {
+        "brand_id": brand_id,
+        "data": {name: value for name, value, _meta in results},
+        "meta": {name: meta for name, _value, meta in results},
+        "total_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
+ORDER_PROJECTION = {"_id": 0, "search_tokens": 0}
+CUSTOMER_PROJECTION = {"_id": 0, "applied_jobs": 0}
+
+ARABIC_LETTER_MAP = str.maketrans({
+    "ٱ": "ا", "ى": "ي", "ة": "ه", "ـ": None,
+    **{chr(0x0660 + d): str(d) for d in range(10)},
+    **{chr(0x06F0 + d): str(d) for d in range(10)}
+})
+SEARCH_MAX_PREFIX = 20
+
+def normalize_search_text(value: Optional[str]) -> str:
+    # NFKD splits accented Latin letters and hamza/madda forms of Arabic letters into base + combining mark
+    decomposed = unicodedata.normalize("NFKD", value or "")
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return stripped.translate(ARABIC_LETTER_MAP).casefold()
+
+def _search_words(value: Optional[str]) -> List[str]:
+    return re.findall(r"\w+", normalize_search_text(value))
+
+def _compact(value: Optional[str]) -> str:
+    return "".join(_search_words(value))
+
+def _digits(value: Optional[str]) -> str:
+    return "".join(ch for ch in normalize_search_text(value) if ch.isdigit())
+
+def _edge_ngrams(tag: str, value: str, min_length: int = 2) -> set:
+    tokens = {f"{tag}:{value[:i]}" for i in range(min_length, min(len(value), SEARCH_MAX_PREFIX) + 1)}
+    tokens.add(f"{tag.upper()}:{value[:SEARCH_MAX_PREFIX]}")
+    return tokens
+
+def order_search_tokens(order: dict) -> List[str]:
+    # Lower-case tags are prefixes (edge n-grams); the upper-case tag marks the complete term and is used for ranking
+    tokens = set()
+    for word in _search_words(order.get("customer_name")):
+        tokens |= _edge_ngrams("n", word)
+        if word.startswith("ال") and len(word) > 4:
+            tokens |= _edge_ngrams("n", word[2:])
+    
+    order_number = order.get("order_number") or ""
+    tokens |= _edge_ngrams("o", _compact(order_number), 3)
+    sequence = _compact(order_number.rsplit("-", 1)[-1]).lstrip("0")
+    if sequence:
+        tokens |= _edge_ngrams("o", sequence, 1)
+    
+    email = normalize_search_text(order.get("customer_email")).strip()
+    if email:
+        # Same compaction as the query side, so "sara.q@..." is found as "saraq"
+        tokens |= _edge_ngrams("e", _compact(email.split("@")[0]))
+        tokens.add(f"E:{email}")
+    
+    phone = _digits(order.get("customer_phone"))
+    for variant in {phone, phone[-9:]}:
+        if len(variant) >= 3:
+            tokens |= _edge_ngrams("p", variant, 3)
+    return sorted(tokens)
+
+def _search_query_tokens(q: str):
+    email = normalize_search_text(q).strip()
+    if "@" in email:
+        local = _compact(email.split("@")[0])[:SEARCH_MAX_PREFIX]
+        return ([{"search_tokens": f"e:{local}"}] if len(local) >= 2 else []), [f"E:{email}"]
+    
+    words = [w[:SEARCH_MAX_PREFIX] for w in _search_words(q) if len(w) >= 2 or w.isdigit()]
+    clauses = []
+    exact = set()
+    for word in words:
+        variants = [f"n:{word}", f"o:{word}", f"e:{word}"]
+        exact |= {f"N:{word}", f"O:{word}"}
+        digits = word.lstrip("0") if word.isdigit() else ""
+        if len(digits) >= 3:
+            variants.append(f"p:{digits}")
+            variants.append(f"o:{digits}")
+            exact.add(f"P:{digits}")
+        clauses.append({"search_tokens": {"$in": variants}})
+    
+    compact = _compact(q)[:SEARCH_MAX_PREFIX]
+    exact |= {f"O:{compact}", f"E:{compact}"}
+    if len(words) > 1 and len(compact) >= 3:
+        clauses = [{"$or": [{"$and": clauses}, {"search_tokens": f"o:{compact}"}]}]
+    return clauses, sorted(exact)
+
+@api_router.get("/orders/search")
+async def search_orders(q: str, page: int = Query(1, ge=1), limit: int = Query(20, ge=1, le=100), _: dict = Depends(verify_token)):
+    clauses, exact = _search_query_tokens(q)
+    if not clauses:
+        raise HTTPException(status_code=400, detail="Search query must contain at least two letters or digits")
+    
+    pipeline = [
+        {"$match": {"$and": clauses}},
+        {"$sort": {"created_at": -1}},
+        {"$limit": SEARCH_CANDIDATE_LIMIT},
+        {"$addFields": {"score": {"$size": {"$filter": {"input": "$search_tokens", "cond": {"$in": ["$$this", exact]}}}}}},
+        {"$sort": {"score": -1, "created_at": -1}},
+        {"$skip": (page - 1) * limit},
+        {"$limit": limit + 1},
+        {"$project": {
+            "_id": 0, "id": 1, "order_number": 1, "customer_name": 1, "customer_email": 1, "customer_phone": 1,
+            "brand_id": 1, "currency": 1, "total": 1, "status": 1, "created_at": 1, "score": 1
+        }}
+    ]
+    results = await db.orders.aggregate(pipeline).to_list(limit + 1)
+    return {"q": q, "page": page, "limit": limit, "has_more": len(results) > limit, "results": results[:limit]}
+
+@api_router.post("/orders/search/reindex")
+async def reindex_order_search(current_user: dict = Depends(verify_token)):
+    admin_doc = await db.users.find_one({"email": current_user["sub"]}, {"_id": 0})
+    if not admin_doc or admin_doc.get('role') != 'admin':
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {"reindexed": await reindex_order_search_tokens({})}
+
+async def reindex_order_search_tokens(filter_query: dict) -> int:
+    reindexed = 0
+    batch = []
+    projection = {"_id": 0, "id": 1, "order_number": 1, "customer_name": 1, "customer_email": 1, "customer_phone": 1}
+    async for order in db.orders.find(filter_query, projection).batch_size(EXPORT_BATCH_SIZE):
+        batch.append(UpdateOne({"id": order["id"]}, {"$set": {"search_tokens": order_search_tokens(order)}}))
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            await db.orders.bulk_write(batch, ordered=False)
+            reindexed += len(batch)
+            batch = []
+    if batch:
+        await db.orders.bulk_write(batch, ordered=False)
+        reindexed += len(batch)
+    return reindexed
+
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders(brand_id: Optional[str] = None, status: Optional[str] = None, _: dict = Depends(verify_token)):
+async def get_orders(
+    request: Request,
+    response: Response,
+    brand_id: Optional[str] = None,
+    status: Optional[str] = None,
+    fields: Optional[str] = None,
+    _: dict = Depends(verify_token)
+):
+    not_modified = await conditional_list(request, response, "orders")
+    if not_modified:
+        return not_modified
+    
     filter_query = {}
     if brand_id:
         filter_query["brand_id"] = brand_id
     if status:
         filter_query["status"] = status
     
-    orders = await db.orders.find(filter_query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    projection, slim_model = field_projection(Order, fields) if fields else (ORDER_PROJECTION, None)
+    orders = await db.orders.find(filter_query, projection).sort("created_at", -1).to_list(1000)
+    if slim_model:
+        return projected_response(orders, slim_model, response)
     for order in orders:
         if isinstance(order['created_at'], str):
             order['created_at'] = datetime.fromisoformat(order['created_at'])
     return orders
 
+ORDER_EXPORT_COLUMNS = [
+    "id", "order_number", "created_at", "brand_id", "brand_name", "customer_name", "customer_email",
+    "customer_phone", "customer_address", "category", "currency", "subtotal", "apply_vat", "vat_rate",
+    "vat_amount", "shipping_charges", "total", "total_base", "payment_method", "status", "created_by"
+]
+ORDER_EXPORT_ITEM_COLUMNS = ["product_id", "product_name", "quantity", "price", "total"]
+
+def as_utc(value: datetime) -> datetime:
+    # created_at is compared as text everywhere, so every stored value has to carry the same +00:00 offset
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def created_at_range(start: Optional[str], end: Optional[str]) -> dict:
+    created_at = {}
+    try:
+        if start:
+            created_at["$gte"] = datetime.fromisoformat(start).date().isoformat()
+        if end:
+            created_at["$lt"] = (datetime.fromisoformat(end).date() + timedelta(days=1)).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+    return {"created_at": created_at} if created_at else {}
+
+async def _stream_orders_ndjson(cursor):
+    buffer = io.StringIO()
+    async for order in cursor:
+        buffer.write(json.dumps(order, default=str))
+        buffer.write("\n")
+        if buffer.tell() >= 65536:
+            yield buffer.getvalue()
+            buffer = io.StringIO()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+async def _stream_orders_csv(cursor):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(ORDER_EXPORT_COLUMNS + [f"item_{c}" for c in ORDER_EXPORT_ITEM_COLUMNS])
+    async for order in cursor:
+        order_row = [order.get(c) for c in ORDER_EXPORT_COLUMNS]
+        for item in order.get("items") or [{}]:
+            writer.writerow(order_row + [item.get(c) for c in ORDER_EXPORT_ITEM_COLUMNS])
+        if buffer.tell() >= 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@api_router.get("/orders/export")
+async def export_orders(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    brand_id: Optional[str] = None,
+    _: dict = Depends(verify_token)
+):
+    filter_query = created_at_range(start, end)
+    if brand_id:
+        filter_query["brand_id"] = brand_id
+    
+    cursor = db.orders.find(filter_query, ORDER_PROJECTION).sort("created_at", 1).batch_size(EXPORT_BATCH_SIZE)
+    if await range_reaches_archive(filter_query):
+        archived = db.orders_archive.find(filter_query, ORDER_PROJECTION).sort("created_at", 1).batch_size(EXPORT_BATCH_SIZE)
+        cursor = _merge_by_created_at(archived, cursor)
+    filename = f"orders-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}.{format}"
+    if format == "csv":
+        return StreamingResponse(_stream_orders_csv(cursor), media_type="text/csv", headers={"Content-Disposition": f"attachment; filename={filename}"})
+    return StreamingResponse(_stream_orders_ndjson(cursor), media_type="application/x-ndjson", headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+def calculate_vat(subtotal: float, currency: str, apply_vat: bool):
+    if not apply_vat:
+        return 0.0, 0.0
+    vat_rate = 0.15 if currency == "SAR" else 0.18
+    return vat_rate, subtotal * vat_rate
+
+async def allocate_order_numbers(count: int) -> List[str]:
+    counter = await db.counters.find_one_and_update(
+        {"_id": "order_number"},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    date_part = datetime.now(timezone.utc).strftime('%Y%m%d')
+    first = counter["seq"] - count + 1
+    return [f"ORD-{date_part}-{str(seq).zfill(6)}" for seq in range(first, counter["seq"] + 1)]
+
+async def stamp_update(collection: str) -> dict:
+    # One sequence number per write; documents written together share it and are ordered by id in /sync
+    counter = await db.counters.find_one_and_update(
+        {"_id": f"updated_seq:{collection}"},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    _note_collection_version(collection, counter["seq"])
+    return {"updated_seq": counter["seq"], "updated_at": datetime.now(timezone.utc).isoformat()}
+
+ETAG_COLLECTIONS = ("orders", "products", "customers", "employees")
+_version_cache = {"versions": {}, "seen_at": {}, "checked_at": 0.0}
+
+def _note_collection_version(collection: str, seq: int):
+    if seq > _version_cache["versions"].get(collection, -1):
+        _version_cache["versions"][collection] = seq
+        _version_cache["seen_at"][collection] = time.monotonic()
+
+async def get_collection_version(collection: str):
+    if time.monotonic() - _version_cache["checked_at"] > ETAG_VERSION_TTL:
+        async for counter in db.counters.find({"_id": {"$in": [f"updated_seq:{name}" for name in ETAG_COLLECTIONS]}}):
+            _note_collection_version(counter["_id"].split(":", 1)[1], counter["seq"])
+        _version_cache["checked_at"] = time.monotonic()
+    return _version_cache["versions"].get(collection, 0), _version_cache["seen_at"].get(collection, 0.0)
+
+async def conditional_list(request: Request, response: Response, collection: str, variant: str = ""):
+    version, seen_at = await get_collection_version(collection)
+    # The version is bumped just before the write lands; a brand-new version is not cached yet
+    # so a body read in between can never be pinned under it
+    if time.monotonic() - seen_at < ETAG_SETTLE_SECONDS:
+        return None
+    params = "&".join(f"{key}={value}" for key, value in sorted(request.query_params.multi_items()))
+    etag = '"' + hashlib.sha1(f"{collection}:{version}:{variant}:{params}".encode()).hexdigest()[:24] + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+# Catalog fields only: stock and the sales counters change with every sale and are always read from the database
+CATALOG_PROJECTION = {"_id": 0, "stock": 0, "units_sold": 0, "revenue": 0, "low_stock": 0, "updated_seq": 0, "updated_at": 0}
+_catalog_cache = {"version": None, "by_id": {}, "by_brand": {}, "checked_at": 0.0}
+
+def product_suggest_keys(product: dict) -> List[tuple]:
+    # (normalized key, rank, product id): rank 0 is the SKU, 1 the whole name, 2 a single word of it
+    keys = set()
+    sku = _compact(product.get("sku"))
+    if sku:
+        keys.add((sku, 0, product["id"]))
+    words = _search_words(product.get("name"))
+    if words:
+        keys.add((" ".join(words), 1, product["id"]))
+        for word in words:
+            keys.add((word, 2, product["id"]))
+            if word.startswith("ال") and len(word) > 4:
+                keys.add((word[2:], 2, product["id"]))
+    return sorted(keys)
+
+class ProductSuggestIndex:
+    """Sorted per-brand key arrays for type-ahead, kept in step with the catalog cache one product at a time."""
+    
+    def __init__(self):
+        self._by_brand = {}
+        self._indexed = {}
+    
+    def upsert(self, product: dict):
+        signature = (product.get("brand_id"), product.get("sku"), product.get("name"))
+        current = self._indexed.get(product["id"])
+        if current and current[1] == signature:
+            return
+        self.remove(product["id"])
+        keys = product_suggest_keys(product)
+        entries = self._by_brand.setdefault(product.get("brand_id"), [])
+        for key in keys:
+            bisect.insort(entries, key)
+        self._indexed[product["id"]] = (product.get("brand_id"), signature, keys)
+    
+    def remove(self, product_id: str):
+        current = self._indexed.pop(product_id, None)
+        if not current:
+            return
+        entries = self._by_brand.get(current[0], [])
+        for key in current[2]:
+            index = bisect.bisect_left(entries, key)
+            if index < len(entries) and entries[index] == key:
+                del entries[index]
+    
+    def sync(self, products: dict):
+        for product_id in [pid for pid in self._indexed if pid not in products]:
+            self.remove(product_id)
+        for product in products.values():
+            self.upsert(product)
+    
+    def _scan(self, brands: List[str], prefix: str) -> dict:
+        matches = {}
+        for brand in brands:
+            entries = self._by_brand.get(brand, [])
+            index = bisect.bisect_left(entries, (prefix,))
+            end = min(len(entries), index + SUGGEST_SCAN_LIMIT)
+            while index < end and entries[index][0].startswith(prefix):
+                key, rank, product_id = entries[index]
+                matches[product_id] = min(matches.get(product_id, (rank, len(key))), (rank, len(key)))
+                index += 1
+        return matches
+    
+    def suggest(self, q: str, brand_id: Optional[str] = None, limit: int = 10) -> List[str]:
+        words = _search_words(q)
+        if not words:
+            return []
+        brands = [brand_id] if brand_id else list(self._by_brand)
+        matches = self._scan(brands, " ".join(words))
+        for product_id, score in self._scan(brands, _compact(q)).items():
+            matches[product_id] = min(matches.get(product_id, score), score)
+        if len(words) > 1:
+            # Words in any order: every query word has to prefix some word of the name
+            per_word = [self._scan(brands, word) for word in words]
+            for product_id in set(per_word[0]).intersection(*per_word[1:]):
+                matches.setdefault(product_id, (3, sum(m[product_id][1] for m in per_word)))
+        ranked = sorted(matches.items(), key=lambda item: (item[1], item[0]))
+        return [product_id for product_id, _ in ranked[:limit]]
+
+product_suggest_index = ProductSuggestIndex()
+
+async def _load_catalog(version):
+    by_id, by_brand = {}, {}
+    async for product in db.products.find({}, CATALOG_PROJECTION):
+        by_id[product["id"]] = product
+        by_brand.setdefault(product["brand_id"], []).append(product["id"])
+    _catalog_cache.update(version=version, by_id=by_id, by_brand=by_brand)
+    product_suggest_index.sync(by_id)
+
+async def get_catalog() -> dict:
+    if time.monotonic() - _catalog_cache["checked_at"] > CATALOG_CACHE_TTL:
+        counter = await db.counters.find_one({"_id": "catalog_version"})
+        version = counter["seq"] if counter else 0
+        if version != _catalog_cache["version"]:
+            await _load_catalog(version)
+        _catalog_cache["checked_at"] = time.monotonic()
+    return _catalog_cache
+
+async def get_catalog_product(product_id: str) -> Optional[dict]:
+    catalog = await get_catalog()
+    product = catalog["by_id"].get(product_id)
+    if product is None:
+        # Created by another instance since our last reload
+        product = await db.products.find_one({"id": product_id}, CATALOG_PROJECTION)
+        if product:
+            catalog["by_id"][product_id] = product
+            catalog["by_brand"].setdefault(product["brand_id"], []).append(product_id)
+            product_suggest_index.upsert(product)
+    return product
+
+async def bump_catalog_version():
+    await db.counters.update_one({"_id": "catalog_version"}, {"$inc": {"seq": 1}}, upsert=True)
+    _catalog_cache["checked_at"] = 0.0
+
+_projection_models = {}
+
+def field_projection(model, fields: str):
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in names if name not in model.model_fields]
+    if not names:
+        raise HTTPException(status_code=400, detail="fields must list at least one field")
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(model.model_fields)}")
+    if "id" in model.model_fields and "id" not in names:
+        names.insert(0, "id")
+    
+    key = (model.__name__, tuple(names))
+    if key not in _projection_models:
+        _projection_models[key] = create_model(
+            f"{model.__name__}Fields",
+            __config__=ConfigDict(extra="ignore"),
+            **{name: (model.model_fields[name].annotation, model.model_fields[name]) for name in names}
+        )
+    return {"_id": 0, **{name: 1 for name in names}}, _projection_models[key]
+
+def projected_response(docs: List[dict], slim_model, response: Response) -> JSONResponse:
+    # Returned directly so the full response_model does not reject the missing fields
+    cache_headers = {name: response.headers[name] for name in ("etag", "cache-control", "x-next-cursor") if name in response.headers}
+    return JSONResponse([slim_model.model_validate(doc).model_dump(mode="json") for doc in docs], headers=cache_headers)
+
 @api_router.post("/orders", response_model=Order)
 async def create_order(order_data: OrderCreate, current_user: dict = Depends(verify_token)):
     if not order_data.customer_email and not order_data.customer_phone:
@@ -368,39 +1357,31 @@ async def create_order(order_data: OrderCreate, current_user: dict = Depends(ver
     if not order_data.items or len(order_data.items) == 0:
         raise HTTPException(status_code=400, detail="At least one product is required")
     
+    status_error = validate_initial_status(order_data.status)
+    if status_error:
+        raise HTTPException(status_code=400, detail=status_error)
+    
     brand = await db.brands.find_one({"id": order_data.brand_id}, {"_id": 0})
     if not brand:
         brands = await get_brands()
         brand = next((b for b in brands if b['id'] == order_data.brand_id), None)
     brand_name = brand['name'] if brand and isinstance(brand, dict) else (brand.name if brand else "Unknown")
     
-    order_count = await db.orders.count_documents({})
-    order_number = f"ORD-{datetime.now(timezone.utc).strftime('%Y%m%d')}-{str(order_count + 1).zfill(6)}"
-    
-    existing_order = await db.orders.find_one({"order_number": order_number}, {"_id": 0})
-    if existing_order:
-        order_number = f"ORD-{datetime.now(timezone.utc).strftime('%Y%m%d')}-{str(uuid.uuid4())[:8].upper()}"
+    order_number = (await allocate_order_numbers(1))[0]
     
     order_items = []
     subtotal = 0.0
+    needed = {}
+    products = {}
     
     for item_data in order_data.items:
-        product = await db.products.find_one({"id": item_data['product_id']}, {"_id": 0})
+        product = await get_catalog_product(item_data['product_id'])
         if not product:
             raise HTTPException(status_code=404, detail=f"Product {item_data['product_id']} not found")
         
         quantity = item_data.get('quantity', 1)
-        if product["stock"] < quantity:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Insufficient stock for {product['name']}. Available: {product['stock']}, Requested: {quantity}"
-            )
-        
-        new_stock = product["stock"] - quantity
-        await db.products.update_one(
-            {"id": item_data['product_id']},
-            {"$set": {"stock": new_stock}}
-        )
+        needed[product['id']] = needed.get(product['id'], 0) + quantity
+        products[product['id']] = product
         
         item_total = product['price'] * quantity
         order_items.append(OrderItem(
@@ -412,15 +1393,34 @@ async def create_order(order_data: OrderCreate, current_user: dict = Depends(ver
         ))
         subtotal += item_total
     
-    vat_rate = 0.0
-    vat_amount = 0.0
-    
-    if order_data.apply_vat:
-        vat_rate = 0.15 if order_data.currency == "SAR" else 0.18
-        vat_amount = subtotal * vat_rate
+    # The available-to-promise total rejects most short orders without looking at locations
+    available = {p["id"]: p["stock"] async for p in db.products.find({"id": {"$in": list(needed)}}, {"_id": 0, "id": 1, "stock": 1})}
+    short = next((pid for pid, qty in needed.items() if available.get(pid, 0) < qty), None)
+    allocations = {}
+    if short is None:
+        # Decrement atomically and only while enough stock is left; if another checkout got there first, undo our part
+        allocations = await allocate_stock(needed, order_number)
+        if len(allocations) < len(needed):
+            await apply_stock_changes({
+                (pid, location): qty for pid, taken in allocations.items() for location, qty in taken.items()
+            }, "sale_reversal", order_number)
+            short = next(pid for pid in needed if pid not in allocations)
+            current = await db.products.find_one({"id": short}, {"_id": 0, "stock": 1})
+            available[short] = current["stock"] if current else 0
+    if short is not None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Insufficient stock for {products[short]['name']}. Available: {available.get(short, 0)}, Requested: {needed[short]}"
+        )
     
+    vat_rate, vat_amount = calculate_vat(subtotal, order_data.currency, order_data.apply_vat)
     total = subtotal + vat_amount + order_data.shipping_charges
     
+    fx_version, fx_rates = await get_fx_rates()
+    fx_rate = fx_rates.get(order_data.currency)
+    if fx_rate is None:
+        logger.warning(f"No FX rate for {order_data.currency}; total_base will be filled once a rate is configured")
+    
     order = Order(
         order_number=order_number,
         customer_name=order_data.customer_name,
@@ -439,63 +1439,1638 @@ async def create_order(order_data: OrderCreate, current_user: dict = Depends(ver
         shipping_charges=order_data.shipping_charges,
         payment_method=order_data.payment_method,
         total=total,
+        total_base=total * fx_rate if fx_rate is not None else None,
+        fx_rate=fx_rate,
+        fx_version=fx_version,
         status=order_data.status,
+        allocations=[
+            StockAllocation(product_id=pid, location=location, quantity=qty)
+            for pid, taken in allocations.items() for location, qty in taken.items()
+        ],
         created_by=current_user.get("sub")
     )
     
     order_dict = order.model_dump()
     order_dict['created_at'] = order_dict['created_at'].isoformat()
     order_dict['items'] = [item.model_dump() for item in order_items]
-    await db.orders.insert_one(order_dict)
+    order_dict['search_tokens'] = order_search_tokens(order_dict)
+    order_dict.update(await stamp_update("orders"))
+    try:
+        await insert_order_with_outbox(order_dict, order_outbox_jobs(order_dict))
+    except (HTTPException, OperationFailure):
+        # The order was not written, so the stock it took goes back
+        await apply_stock_changes(order_stock_changes(order_dict), "sale_reversal", order_number)
+        raise
+    
+    return order
+
+async def _iter_body_lines(request: Request, quoted_fields: bool = False):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    logical = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            logical = f"{logical}\n{line}" if logical else line
+            # A CSV field may contain newlines; keep joining until the quotes balance
+            if quoted_fields and logical.count('"') % 2:
+                continue
+            yield logical.rstrip("\r")
+            logical = ""
+    pending += decoder.decode(b"", final=True)
+    if pending or logical:
+        yield (f"{logical}\n{pending}" if logical else pending).rstrip("\r")
+
+CSV_IMPORT_ORDER_FIELDS = [
+    "customer_name", "customer_email", "customer_phone", "customer_address", "brand_id", "category",
+    "currency", "apply_vat", "shipping_charges", "payment_method", "status", "order_number", "created_at"
+]
+
+async def _iter_ndjson_records(request: Request):
+    row_number = 0
+    async for line in _iter_body_lines(request):
+        row_number += 1
+        if not line.strip():
+            continue
+        try:
+            yield row_number, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield row_number, ValueError(f"Invalid JSON: {e.msg}")
+
+async def _iter_csv_rows(request: Request):
+    header = None
+    row_number = 0
+    async for line in _iter_body_lines(request, quoted_fields=True):
+        if not line.strip():
+            continue
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [h.strip() for h in values]
+            continue
+        row_number += 1
+        yield row_number, {k: v.strip() for k, v in zip(header, values) if v is not None and v.strip() != ""}
+
+async def _iter_import_records(request: Request, format: str):
+    if format == "ndjson":
+        async for record in _iter_ndjson_records(request):
+            yield record
+        return
+    
+    current_ref, current = None, None
+    async for row_number, row in _iter_csv_rows(request):
+        order_ref = row.get("order_ref") or f"__row{row_number}"
+        if order_ref != current_ref:
+            if current is not None:
+                yield current
+            record = {k: row[k] for k in CSV_IMPORT_ORDER_FIELDS if k in row}
+            if "apply_vat" in record:
+                record["apply_vat"] = record["apply_vat"].lower() in ("1", "true", "yes")
+            record["items"] = []
+            current_ref, current = order_ref, (row_number, record)
+        item = {k: row[k] for k in ("product_id", "sku") if k in row}
+        item["quantity"] = row.get("quantity", "1")
+        current[1]["items"].append(item)
+    if current is not None:
+        yield current
+
+async def _import_order_chunk(records: list, created_by: Optional[str]):
+    errors = {}
+    rows = []
+    for row_number, record in records:
+        if isinstance(record, Exception):
+            errors[row_number] = str(record)
+            continue
+        try:
+            order_data = OrderImportRow(**record)
+            items = [{**item, "quantity": int(item.get("quantity", 1))} for item in order_data.items]
+        except ValidationError as e:
+            first = e.errors()[0]
+            errors[row_number] = f"{'.'.join(str(part) for part in first['loc'])}: {first['msg']}"
+            continue
+        except (TypeError, ValueError) as e:
+            errors[row_number] = str(e)
+            continue
+        status_error = validate_initial_status(order_data.status)
+        if not order_data.customer_email and not order_data.customer_phone:
+            errors[row_number] = "Either email or phone number is required"
+        elif not items:
+            errors[row_number] = "At least one product is required"
+        elif any(item["quantity"] <= 0 for item in items):
+            errors[row_number] = "Quantities must be positive"
+        elif status_error:
+            errors[row_number] = status_error
+        else:
+            rows.append((row_number, order_data, items))
+    
+    product_ids = {item["product_id"] for _, _, items in rows for item in items if item.get("product_id")}
+    skus = {item["sku"] for _, _, items in rows for item in items if not item.get("product_id") and item.get("sku")}
+    products_by_id, products_by_sku = {}, {}
+    if product_ids or skus:
+        async for product in db.products.find({"$or": [{"id": {"$in": list(product_ids)}}, {"sku": {"$in": list(skus)}}]}, {"_id": 0}):
+            products_by_id[product["id"]] = product
+            products_by_sku[product["sku"]] = product
+    
+    available = {pid: p["stock"] for pid, p in products_by_id.items()}
+    reserved = []
+    for row_number, order_data, items in rows:
+        lines = []
+        for item in items:
+            product = products_by_id.get(item.get("product_id")) or products_by_sku.get(item.get("sku"))
+            if not product:
+                errors[row_number] = f"Product {item.get('product_id') or item.get('sku')} not found"
+                break
+            lines.append((product, item["quantity"]))
+        if row_number in errors:
+            continue
+        
+        needed = {}
+        for product, quantity in lines:
+            needed[product["id"]] = needed.get(product["id"], 0) + quantity
+        short = next((pid for pid, qty in needed.items() if available[pid] < qty), None)
+        if short:
+            errors[row_number] = f"Insufficient stock for {products_by_id[short]['name']}. Available: {available[short]}, Requested: {needed[short]}"
+            continue
+        for pid, qty in needed.items():
+            available[pid] -= qty
+        reserved.append((row_number, order_data, lines, needed))
+    
+    totals = {}
+    for _, _, _, needed in reserved:
+        for pid, qty in needed.items():
+            totals[pid] = totals.get(pid, 0) + qty
+    
+    import_ref = f"import:{uuid.uuid4()}"
+    allocations = await allocate_stock(totals, import_ref) if totals else {}
+    still_reserved = []
+    refunds = {}
+    for row_number, order_data, lines, needed in reserved:
+        if all(pid in allocations for pid in needed):
+            still_reserved.append((row_number, order_data, lines, needed))
+            continue
+        errors[row_number] = "Stock changed during import; please retry this row"
+        for pid, qty in needed.items():
+            if pid in allocations:
+                for location, taken in take_allocation(allocations, pid, qty).items():
+                    refunds[(pid, location)] = refunds.get((pid, location), 0) + taken
+    reserved = still_reserved
+    await apply_stock_changes(refunds, "sale_reversal", import_ref)
+    
+    order_numbers = iter(await allocate_order_numbers(len(reserved))) if reserved else iter(())
+    brand_names = {b["id"]: b["name"] for b in await get_brands()}
+    fx_version, fx_rates = await get_fx_rates()
+    
+    order_docs = []
+    for row_number, order_data, lines, needed in reserved:
+        order_items = [
+            OrderItem(product_id=p["id"], product_name=p["name"], quantity=qty, price=p["price"], total=p["price"] * qty)
+            for p, qty in lines
+        ]
+        subtotal = sum(item.total for item in order_items)
+        vat_rate, vat_amount = calculate_vat(subtotal, order_data.currency, order_data.apply_vat)
+        total = subtotal + vat_amount + order_data.shipping_charges
+        fx_rate = fx_rates.get(order_data.currency)
+        order = Order(
+            order_number=order_data.order_number or next(order_numbers),
+            customer_name=order_data.customer_name,
+            customer_email=order_data.customer_email,
+            customer_phone=order_data.customer_phone,
+            customer_address=order_data.customer_address,
+            brand_id=order_data.brand_id,
+            brand_name=brand_names.get(order_data.brand_id, "Unknown"),
+            items=order_items,
+            category=order_data.category,
+            currency=order_data.currency,
+            subtotal=subtotal,
+            apply_vat=order_data.apply_vat,
+            vat_rate=vat_rate,
+            vat_amount=vat_amount,
+            shipping_charges=order_data.shipping_charges,
+            payment_method=order_data.payment_method,
+            total=total,
+            total_base=total * fx_rate if fx_rate is not None else None,
+            fx_rate=fx_rate,
+            fx_version=fx_version,
+            status=order_data.status,
+            allocations=[
+                StockAllocation(product_id=pid, location=location, quantity=taken)
+                for pid, qty in needed.items() for location, taken in take_allocation(allocations, pid, qty).items()
+            ],
+            created_by=created_by,
+            **({"created_at": as_utc(order_data.created_at)} if order_data.created_at else {})
+        )
+        order_dict = order.model_dump()
+        order_dict['created_at'] = order_dict['created_at'].isoformat()
+        order_dict['search_tokens'] = order_search_tokens(order_dict)
+        order_docs.append(order_dict)
+    
+    failed_inserts = set()
+    if order_docs:
+        order_stamp = await stamp_update("orders")
+        for order_dict in order_docs:
+            order_dict.update(order_stamp)
+        try:
+            await db.orders.insert_many(order_docs, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                failed_inserts.add(write_error["index"])
+                errors[reserved[write_error["index"]][0]] = "Duplicate order number" if write_error.get("code") == 11000 else write_error.get("errmsg", "Insert failed")
+    
+    refunds = {}
+    inserted = []
+    for index, order_dict in enumerate(order_docs):
+        if index in failed_inserts:
+            for key, qty in order_stock_changes(order_dict).items():
+                refunds[key] = refunds.get(key, 0) + qty
+        else:
+            inserted.append(order_dict)
+    await apply_stock_changes(refunds, "sale_reversal", import_ref)
+    
+    customer_ops = {}
+    for order_dict in inserted:
+        record_order_sketches(order_dict)
+        record_product_sales(order_dict)
+        email, phone = order_dict.get("customer_email"), order_dict.get("customer_phone")
+        key = ("email", email) if email else ("phone", phone)
+        op = customer_ops.setdefault(key, {"orders": 0, "value": 0.0, "name": order_dict["customer_name"], "phone": phone})
+        op["orders"] += 1
+        op["value"] += order_dict["total"]
+    if customer_ops:
+        customer_stamp = await stamp_update("customers")
+        await db.customers.bulk_write([
+            UpdateOne(
+                {"email": value},
+                {
+                    "$inc": {"total_orders": op["orders"], "lifetime_value": op["value"]},
+                    "$set": customer_stamp,
+                    "$setOnInsert": {"id": str(uuid.uuid4()), "name": op["name"], "phone": op["phone"], "created_at": datetime.now(timezone.utc).isoformat()}
+                },
+                upsert=True
+            ) if field == "email" else UpdateOne({"phone": value}, {"$inc": {"total_orders": op["orders"], "lifetime_value": op["value"]}, "$set": customer_stamp})
+            for (field, value), op in customer_ops.items()
+        ], ordered=False)
+    
+    return len(inserted), [{"row": row, "error": message} for row, message in sorted(errors.items())]
+
+STOCK_MOVEMENT_TYPES = {"sale", "sale_reversal", "cancellation", "return", "adjustment", "receipt"}
+
+async def record_stock_movements(changes: dict, movement_type: str, reference: Optional[str] = None):
+    # Keys are (product_id, location) pairs, or a bare product id for the default warehouse
+    created_at = datetime.now(timezone.utc).isoformat()
+    movements = []
+    for key, qty in changes.items():
+        if qty:
+            pid, location = key if isinstance(key, tuple) else (key, DEFAULT_WAREHOUSE)
+            movements.append({
+                "id": str(uuid.uuid4()), "product_id": pid, "location": location, "quantity": qty,
+                "type": movement_type, "reference": reference, "created_at": created_at
+            })
+    if movements:
+        await db.stock_movements.insert_many(movements)
+
+def stock_location(location: Optional[str]) -> str:
+    if location is None:
+        return DEFAULT_WAREHOUSE
+    if location not in WAREHOUSES:
+        raise HTTPException(status_code=400, detail=f"Unknown location '{location}'; use one of {', '.join(WAREHOUSES)}")
+    return location
+
+async def apply_stock_changes(
+    changes: dict,
+    movement_type: str,
+    reference: Optional[str] = None,
+    guarded: bool = False,
+    expected: Optional[dict] = None
+) -> set:
+    # Every stock change goes through here. `changes` maps (product_id, location) to a delta: one $inc
+    # bulk_write on stock_locations, the same deltas on products.stock (the available-to-promise total
+    # across locations, so readers never sum locations) and the matching ledger rows.
+    # guarded=True only applies a decrement while enough stock is left at that location; `expected`
+    # maps keys to the stock the caller read and only applies while it is unchanged.
+    # Unguarded changes always apply. A guarded row records the batch id until this call has read it back,
+    # so the answer cannot be lost to other writes on the same row in between.
+    # Returns the keys that changed.
+    changes = {key: qty for key, qty in changes.items() if qty}
+    if not changes:
+        return set()
+    batch_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    ops, unguarded = [], set()
+    for (pid, location), qty in changes.items():
+        guard = {}
+        update = {"$inc": {"stock": qty}, "$set": {"updated_at": now}}
+        if expected is not None:
+            guard = {"stock": expected.get((pid, location), 0)}
+        elif guarded and qty < 0:
+            guard = {"stock": {"$gte": -qty}}
+        if guard:
+            update["$push"] = {"applied_batches": batch_id}
+        else:
+            unguarded.add(len(ops))
+        ops.append(UpdateOne({"product_id": pid, "location": location, **guard}, update, upsert=not guard or guard["stock"] == 0))
+    try:
+        result = await db.stock_locations.bulk_write(ops, ordered=False)
+        complete = result.modified_count + result.upserted_count == len(changes)
+    except BulkWriteError as e:
+        # Two first receipts for the same location race on the upsert; the loser finds the row on retry.
+        # A guarded write that loses the same race simply did not apply.
+        retry = [ops[error["index"]] for error in e.details.get("writeErrors", []) if error.get("code") == 11000 and error["index"] in unguarded]
+        if retry:
+            await db.stock_locations.bulk_write(retry, ordered=False)
+        complete = False
+    keys = list(changes)
+    marked = {"product_id": {"$in": list({pid for pid, _ in keys})}, "applied_batches": batch_id}
+    if complete:
+        applied = set(keys)
+    else:
+        applied = {keys[index] for index in unguarded} | {
+            (row["product_id"], row["location"])
+            async for row in db.stock_locations.find(marked, {"_id": 0, "product_id": 1, "location": 1})
+        }
+    if len(unguarded) < len(keys):
+        await db.stock_locations.update_many(marked, {"$pull": {"applied_batches": batch_id}})
+    
+    totals = {}
+    for pid, location in applied:
+        totals[pid] = totals.get(pid, 0) + changes[(pid, location)]
+    totals = {pid: qty for pid, qty in totals.items() if qty}
+    if totals:
+        product_stamp = await stamp_update("products")
+        await db.products.bulk_write([
+            UpdateOne({"id": pid}, {"$inc": {"stock": qty}, "$set": product_stamp}) for pid, qty in totals.items()
+        ], ordered=False)
+    await record_stock_movements({key: changes[key] for key in applied}, movement_type, reference)
+    return applied
+
+def plan_allocation(needed: dict, levels: dict) -> dict:
+    # Ship from a single warehouse when one can fill the whole order, trying WAREHOUSES in order;
+    # otherwise take each product from its fullest locations first. Products that cannot be
+    # covered are left out of the plan.
+    rank = {location: index for index, location in enumerate(WAREHOUSES)}
+    locations = sorted({loc for stock in levels.values() for loc in stock}, key=lambda loc: (rank.get(loc, len(rank)), loc))
+    for location in locations:
+        if all(levels.get(pid, {}).get(location, 0) >= qty for pid, qty in needed.items()):
+            return {pid: {location: qty} for pid, qty in needed.items()}
+    plan = {}
+    for pid, qty in needed.items():
+        taken = {}
+        for location, stock in sorted(levels.get(pid, {}).items(), key=lambda level: (-level[1], rank.get(level[0], len(rank)))):
+            take = min(stock, qty - sum(taken.values()))
+            if take > 0:
+                taken[location] = take
+        if sum(taken.values()) == qty:
+            plan[pid] = taken
+    return plan
+
+async def allocate_stock(needed: dict, reference: str) -> dict:
+    # Decrements {product_id: qty} across locations; returns {product_id: {location: qty}} for the
+    # products that were fully allocated. A product only partly taken is put back.
+    levels = {}
+    async for row in db.stock_locations.find(
+        {"product_id": {"$in": list(needed)}, "stock": {"$gt": 0}},
+        {"_id": 0, "product_id": 1, "location": 1, "stock": 1}
+    ):
+        levels.setdefault(row["product_id"], {})[row["location"]] = row["stock"]
+    plan = plan_allocation(needed, levels)
+    applied = await apply_stock_changes(
+        {(pid, location): -qty for pid, taken in plan.items() for location, qty in taken.items()}, "sale", reference, guarded=True
+    )
+    allocations = {pid: taken for pid, taken in plan.items() if all((pid, location) in applied for location in taken)}
+    await apply_stock_changes({
+        (pid, location): qty for pid, taken in plan.items() if pid not in allocations
+        for location, qty in taken.items() if (pid, location) in applied
+    }, "sale_reversal", reference)
+    return allocations
+
+def take_allocation(allocations: dict, product_id: str, quantity: int) -> dict:
+    # Carves one order's share out of a product's pooled {location: qty} allocation
+    taken = {}
+    pool = allocations[product_id]
+    for location in list(pool):
+        take = min(pool[location], quantity - sum(taken.values()))
+        if take > 0:
+            taken[location] = take
+            pool[location] -= take
+    return taken
+
+def order_stock_changes(order: dict) -> dict:
+    # {(product_id, location): qty} an order took; orders from before allocations took from the default warehouse
+    lines = order.get("allocations") or [{**item, "location": DEFAULT_WAREHOUSE} for item in order.get("items", [])]
+    changes = {}
+    for line in lines:
+        key = (line["product_id"], line["location"])
+        changes[key] = changes.get(key, 0) + line["quantity"]
+    return changes
+
+async def get_stock_snapshot_watermark() -> Optional[str]:
+    doc = await db.counters.find_one({"_id": "stock_snapshot_watermark"})
+    return doc["as_of"] if doc else None
+
+async def compact_stock_movements() -> dict:
+    if not await acquire_lease("stock_snapshot", 3600):
+        return {"products": 0, "skipped": "another instance is compacting"}
+    try:
+        watermark = await get_stock_snapshot_watermark()
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=STOCK_SNAPSHOT_LAG)).isoformat()
+        if watermark and watermark >= cutoff:
+            return {"products": 0, "as_of": watermark}
+        
+        # Snapshots past the watermark are leftovers of a run that died before committing it
+        await db.stock_snapshots.delete_many({"as_of": {"$gt": watermark}} if watermark else {})
+        window = {"$lte": cutoff, **({"$gt": watermark} if watermark else {})}
+        deltas = await db.stock_movements.aggregate([
+            {"$match": {"created_at": window}},
+            {"$group": {"_id": "$product_id", "quantity": {"$sum": "$quantity"}}}
+        ]).to_list(None)
+        if deltas:
+            previous = await latest_stock_snapshots(watermark, [row["_id"] for row in deltas]) if watermark else {}
+            await db.stock_snapshots.insert_many([
+                {"product_id": row["_id"], "as_of": cutoff, "balance": previous.get(row["_id"], {}).get("balance", 0) + row["quantity"]}
+                for row in deltas
+            ])
+        await db.counters.update_one({"_id": "stock_snapshot_watermark"}, {"$set": {"as_of": cutoff}}, upsert=True)
+        return {"products": len(deltas), "as_of": cutoff}
+    finally:
+        await release_lease("stock_snapshot")
+
+async def latest_stock_snapshots(as_of: str, product_ids: Optional[List[str]] = None) -> dict:
+    match = {"as_of": {"$lte": as_of}}
+    if product_ids is not None:
+        match["product_id"] = {"$in": product_ids}
+    rows = await db.stock_snapshots.aggregate([
+        {"$match": match},
+        {"$sort": {"product_id": 1, "as_of": -1}},
+        {"$group": {"_id": "$product_id", "balance": {"$first": "$balance"}, "as_of": {"$first": "$as_of"}}}
+    ]).to_list(None)
+    return {row["_id"]: row for row in rows}
+
+async def stock_balances(as_of: str, product_ids: Optional[List[str]] = None) -> dict:
+    # Every compaction run snapshots each product that moved in its window, so after the newest snapshot at
+    # or before the bound no product has unsnapshotted movements: one shared tail range covers them all
+    watermark = await get_stock_snapshot_watermark()
+    bound = min(as_of, watermark) if watermark else None
+    snapshots = await latest_stock_snapshots(bound, product_ids) if bound else {}
+    balances = {pid: row["balance"] for pid, row in snapshots.items()}
+    tail_from = max((row["as_of"] for row in snapshots.values()), default=None)
+    
+    match = {"created_at": {"$lte": as_of, **({"$gt": tail_from} if tail_from else {})}}
+    if product_ids is not None:
+        match["product_id"] = {"$in": product_ids}
+    async for row in db.stock_movements.aggregate([{"$match": match}, {"$group": {"_id": "$product_id", "quantity": {"$sum": "$quantity"}}}]):
+        balances[row["_id"]] = balances.get(row["_id"], 0) + row["quantity"]
+    return balances
+
+async def _stock_snapshot_loop():
+    while True:
+        await asyncio.sleep(STOCK_SNAPSHOT_INTERVAL)
+        try:
+            await compact_stock_movements()
+        except Exception as e:
+            logger.warning(f"Stock snapshot compaction failed: {e}")
+
+@api_router.get("/inventory/movements")
+async def get_stock_movements(product_id: Optional[str] = None, limit: int = Query(100, ge=1, le=1000), _: dict = Depends(verify_token)):
+    filter_query = {"product_id": product_id} if product_id else {}
+    return await db.stock_movements.find(filter_query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+
+@api_router.get("/inventory/stock-as-of")
+async def get_stock_as_of(
+    date: str,
+    product_id: Optional[str] = None,
+    brand_id: Optional[str] = None,
+    _: dict = Depends(verify_token)
+):
+    as_of = created_at_range(None, date)["created_at"]["$lt"]
+    product_query = {"id": product_id} if product_id else ({"brand_id": brand_id} if brand_id else None)
+    product_ids = [p["id"] async for p in db.products.find(product_query, {"_id": 0, "id": 1})] if product_query else None
+    balances = await stock_balances(as_of, product_ids)
+    return {"as_of": as_of, "balances": [{"product_id": pid, "stock": stock} for pid, stock in sorted(balances.items())]}
+
+@api_router.get("/inventory/locations")
+async def get_stock_locations(product_id: Optional[str] = None, location: Optional[str] = None, _: dict = Depends(verify_token)):
+    filter_query = {}
+    if product_id:
+        filter_query["product_id"] = product_id
+    if location:
+        filter_query["location"] = location
+    return await db.stock_locations.find(filter_query, {"_id": 0, "applied_batches": 0}).sort([("product_id", 1), ("location", 1)]).to_list(5000)
+
+@api_router.get("/inventory/reconcile")
+async def reconcile_stock(_: dict = Depends(verify_token)):
+    balances = await stock_balances(datetime.now(timezone.utc).isoformat())
+    located = {row["_id"]: row["stock"] async for row in db.stock_locations.aggregate([{"$group": {"_id": "$product_id", "stock": {"$sum": "$stock"}}}])}
+    mismatches = []
+    async for product in db.products.find({}, {"_id": 0, "id": 1, "sku": 1, "name": 1, "stock": 1}):
+        ledger = balances.pop(product["id"], 0)
+        location_stock = located.get(product["id"], 0)
+        if ledger != product["stock"] or location_stock != product["stock"]:
+            mismatches.append({**product, "ledger_stock": ledger, "location_stock": location_stock, "difference": product["stock"] - ledger})
+    return {"checked_at": datetime.now(timezone.utc).isoformat(), "mismatches": mismatches, "orphan_movements": sorted(balances)}
+
+@api_router.post("/admin/inventory/compact")
+async def run_stock_compaction(current_user: dict = Depends(verify_token)):
+    admin_doc = await db.users.find_one({"email": current_user["sub"]}, {"_id": 0})
+    if not admin_doc or admin_doc.get('role') != 'admin':
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    customer_identifier = order_data.customer_email or order_data.customer_phone
-    customer_query = {"email": order_data.customer_email} if order_data.customer_email else {"phone": order_data.customer_phone}
-    customer = await db.customers.find_one(customer_query, {"_id": 0})
+    return await compact_stock_movements()
+
+async def refresh_low_stock(product_ids: List[str]) -> int:
+    # low_stock mirrors stock <= reorder_level so the partial index can serve it; alerts fire on the way down only
+    if not product_ids:
+        return 0
+    products = await db.products.find(
+        {"id": {"$in": list(set(product_ids))}},
+        {"_id": 0, "id": 1, "sku": 1, "name": 1, "brand_id": 1, "stock": 1, "reorder_level": 1, "low_stock": 1}
+    ).to_list(None)
+    flips, alerts = [], []
+    now = datetime.now(timezone.utc).isoformat()
+    for product in products:
+        low = product.get("reorder_level") is not None and product["stock"] <= product["reorder_level"]
+        if low == bool(product.get("low_stock")):
+            continue
+        flips.append((product, low))
+        if low:
+            alerts.append({
+                "id": str(uuid.uuid4()), "product_id": product["id"], "sku": product["sku"], "name": product["name"],
+                "brand_id": product["brand_id"], "stock": product["stock"], "reorder_level": product["reorder_level"], "created_at": now
+            })
+    if flips:
+        # Guarded on the stock we judged; if it moved since, its ledger entry brings it back to the watcher
+        product_stamp = await stamp_update("products")
+        await db.products.bulk_write([
+            UpdateOne({"id": product["id"], "stock": product["stock"]}, {"$set": {"low_stock": low, **product_stamp}})
+            for product, low in flips
+        ], ordered=False)
+    if alerts:
+        await db.stock_alerts.insert_many(alerts)
+        logger.warning(f"Low stock: {', '.join(alert['sku'] for alert in alerts)}")
+    return len(alerts)
+
+async def watch_low_stock() -> dict:
+    if not await acquire_lease("low_stock", max(LOW_STOCK_WATCH_INTERVAL, 60)):
+        return {"checked": 0, "skipped": "another instance is watching"}
+    try:
+        started = datetime.now(timezone.utc)
+        state = await db.counters.find_one({"_id": "low_stock_watermark"})
+        if state:
+            # Re-read a little before the watermark: movements are stamped before they are inserted
+            since = (datetime.fromisoformat(state["created_at"]) - timedelta(seconds=LOW_STOCK_WATCH_OVERLAP)).isoformat()
+            product_ids = await db.stock_movements.distinct("product_id", {"created_at": {"$gt": since}})
+        else:
+            product_ids = await db.products.distinct("id", {"reorder_level": {"$ne": None}})
+        alerts = 0
+        for start in range(0, len(product_ids), 1000):
+            alerts += await refresh_low_stock(product_ids[start:start + 1000])
+        await db.counters.update_one({"_id": "low_stock_watermark"}, {"$set": {"created_at": started.isoformat()}}, upsert=True)
+        return {"checked": len(product_ids), "alerts": alerts}
+    finally:
+        await release_lease("low_stock")
+
+async def _low_stock_watch_loop():
+    while True:
+        try:
+            await watch_low_stock()
+        except Exception as e:
+            logger.warning(f"Low stock watcher failed: {e}")
+        await asyncio.sleep(LOW_STOCK_WATCH_INTERVAL)
+
+@api_router.get("/products/low-stock")
+async def get_low_stock_products(brand_id: Optional[str] = None, _: dict = Depends(verify_token)):
+    filter_query = {"low_stock": True}
+    if brand_id:
+        filter_query["brand_id"] = brand_id
+    products = await db.products.find(
+        filter_query,
+        {"_id": 0, "id": 1, "sku": 1, "name": 1, "brand_id": 1, "brand_name": 1, "stock": 1, "reorder_level": 1}
+    ).sort("stock", 1).to_list(1000)
+    for product in products:
+        product["shortfall"] = product["reorder_level"] - product["stock"]
+    return products
+
+@api_router.get("/inventory/alerts")
+async def get_stock_alerts(brand_id: Optional[str] = None, limit: int = Query(50, ge=1, le=500), _: dict = Depends(verify_token)):
+    filter_query = {"brand_id": brand_id} if brand_id else {}
+    return await db.stock_alerts.find(filter_query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+
+@api_router.post("/orders/import")
+async def import_orders(request: Request, format: Optional[str] = Query(None, pattern="^(ndjson|csv)$"), current_user: dict = Depends(verify_token)):
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    
+    imported = 0
+    errors = []
+    chunk = []
+    async for record in _iter_import_records(request, format):
+        chunk.append(record)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            count, chunk_errors = await _import_order_chunk(chunk, current_user.get("sub"))
+            imported += count
+            errors.extend(chunk_errors)
+            chunk = []
+    if chunk:
+        count, chunk_errors = await _import_order_chunk(chunk, current_user.get("sub"))
+        imported += count
+        errors.extend(chunk_errors)
+    
+    return {"imported": imported, "failed": len(errors), "errors": errors}
+
+ORDER_STATUS_TRANSITIONS = {
+    "pending": {"processing", "cancelled"},
+    "processing": {"shipped", "completed", "cancelled"},
+    "shipped": {"delivered", "returned"},
+    "delivered": {"returned"},
+    "completed": {"returned"},
+    "cancelled": set(),
+    "returned": set()
+}
+RESTOCK_ON_STATUS = {"cancelled"}
+# New and imported orders may start anywhere except a terminal status, which needs a cancellation or return to reach
+INITIAL_ORDER_STATUSES = {status for status, allowed in ORDER_STATUS_TRANSITIONS.items() if allowed}
+
+def validate_initial_status(status: str) -> Optional[str]:
+    if status not in ORDER_STATUS_TRANSITIONS:
+        return f"Unknown status '{status}'"
+    if status not in INITIAL_ORDER_STATUSES:
+        return f"Orders cannot be created as '{status}'"
+    return None
+
+def validate_status_transition(current: str, new_status: str) -> Optional[str]:
+    if current not in ORDER_STATUS_TRANSITIONS:
+        return f"Unknown current status '{current}'"
+    if new_status not in ORDER_STATUS_TRANSITIONS[current]:
+        return f"Cannot change status from '{current}' to '{new_status}'"
+    return None
+
+async def apply_status_transition(orders: list, new_status: str) -> set:
+    if new_status == "returned":
+        # Marking an order returned is a return of everything not returned yet, so stock and customer totals follow
+        applied = set()
+        async for order in db.orders.find({"id": {"$in": [o["id"] for o in orders]}}, ORDER_PROJECTION):
+            await create_order_return(order, remaining_return_quantities(order), "Order marked as returned")
+            applied.add(order["id"])
+        return applied
+    
+    by_status = {}
+    for order in orders:
+        by_status.setdefault(order["status"], []).append(order["id"])
+    
+    # The current status is part of each filter, so a concurrent change makes that order drop out
+    # instead of being overwritten; the batch marker tells us which orders actually moved.
+    batch_id = str(uuid.uuid4())
+    order_stamp = await stamp_update("orders")
+    result = await db.orders.bulk_write([
+        UpdateMany({"id": {"$in": ids}, "status": current}, {"$set": {"status": new_status, "status_batch": batch_id, **order_stamp}})
+        for current, ids in by_status.items()
+    ], ordered=False)
+    if result.modified_count == len(orders):
+        applied = {order["id"] for order in orders}
+    else:
+        applied = {o["id"] async for o in db.orders.find({"id": {"$in": [o["id"] for o in orders]}, "status_batch": batch_id}, {"_id": 0, "id": 1})}
+    
+    if new_status in RESTOCK_ON_STATUS:
+        # Stock goes back to the locations the order was allocated from
+        quantities = {}
+        for order in orders:
+            if order["id"] in applied:
+                for key, qty in order_stock_changes(order).items():
+                    quantities[key] = quantities.get(key, 0) + qty
+        await apply_stock_changes(quantities, "cancellation", f"status:{batch_id}")
+        jobs = []
+        for order in orders:
+            if order["id"] in applied:
+                record_product_sales(order, sign=-1)
+                jobs.append(customer_adjustment_job(order, -1, -(order["total"] - order.get("refunded_total", 0))))
+        if jobs:
+            await db.outbox.insert_many(jobs)
+            _outbox_wakeup.set()
+    return applied
+
+_transactions_supported = None
+_outbox_wakeup = asyncio.Event()
+
+def order_outbox_jobs(order_dict: dict) -> List[dict]:
+    now = datetime.now(timezone.utc)
+    payloads = {
+        "customer_stats": {
+            "name": order_dict["customer_name"],
+            "email": order_dict.get("customer_email"),
+            "phone": order_dict.get("customer_phone"),
+            "total": order_dict["total"]
+        },
+        "order_rollups": {"order_id": order_dict["id"]}
+    }
+    return [
+        {"id": str(uuid.uuid4()), "type": job_type, "order_id": order_dict["id"], "payload": payload,
+         "status": "pending", "attempts": 0, "available_at": now, "created_at": now}
+        for job_type, payload in payloads.items()
+    ]
+
+def customer_adjustment_job(order: dict, orders: int, value: float) -> dict:
+    now = datetime.now(timezone.utc)
+    return {
+        "id": str(uuid.uuid4()), "type": "customer_adjustment", "order_id": order["id"],
+        "payload": {"email": order.get("customer_email"), "phone": order.get("customer_phone"), "orders": orders, "value": value},
+        "status": "pending", "attempts": 0, "available_at": now, "created_at": now
+    }
+
+def order_insert_error(write_error: dict) -> HTTPException:
+    if write_error.get("code") == 11000:
+        return HTTPException(status_code=409, detail="Duplicate order number")
+    return HTTPException(status_code=500, detail=write_error.get("errmsg", "Order insert failed"))
+
+async def insert_orders_with_outbox(orders: List[dict], jobs: List[dict]):
+    # Returns {order_id: HTTPException} for the orders that could not be written; their jobs are dropped
+    global _transactions_supported
+    if _transactions_supported is not False:
+        try:
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    await db.orders.insert_many(orders, session=session)
+                    await db.outbox.insert_many(jobs, session=session)
+            _transactions_supported = True
+            _outbox_wakeup.set()
+            return {}
+        except BulkWriteError as e:
+            # The transaction wrote nothing and stopped at the first bad order: fail that one and write the rest again
+            _transactions_supported = True
+            write_error = e.details["writeErrors"][0]
+            failed_id = orders[write_error["index"]]["id"]
+            failures = {failed_id: order_insert_error(write_error)}
+            rest = [order for order in orders if order["id"] != failed_id]
+            if rest:
+                failures.update(await insert_orders_with_outbox(rest, [job for job in jobs if job["order_id"] != failed_id]))
+            return failures
+        except OperationFailure as e:
+            # Code 20 (IllegalOperation): standalone mongod, transactions need a replica set
+            if e.code != 20:
+                raise
+            _transactions_supported = False
+            logger.warning("MongoDB deployment does not support transactions; outbox jobs are written right after the order")
+    
+    failures = {}
+    try:
+        await db.orders.insert_many(orders, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            failures[orders[error["index"]]["id"]] = order_insert_error(error)
+    jobs = [job for job in jobs if job["order_id"] not in failures]
+    if jobs:
+        await db.outbox.insert_many(jobs)
+    _outbox_wakeup.set()
+    return failures
+
+class OrderWriteCoalescer:
+    """Group-commits concurrent checkouts: orders submitted within one window are written together."""
+    
+    def __init__(self, window_ms: float, max_docs: int):
+        self.window = window_ms / 1000
+        self.max_docs = max(1, max_docs)
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+    
+    async def submit(self, order_dict: dict, jobs: List[dict]):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((order_dict, jobs, future))
+        if len(self._pending) >= self.max_docs:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+        return await future
+    
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+    
+    async def _flush(self, batch: list):
+        try:
+            failures = await insert_orders_with_outbox(
+                [order for order, _, _ in batch],
+                [job for _, jobs, _ in batch for job in jobs]
+            )
+            results = [failures.get(order["id"]) for order, _, _ in batch]
+        except Exception:
+            # A failed transaction wrote nothing: retry one by one so a single bad
+            # order does not fail every checkout that shared its batch
+            results = []
+            for order, jobs, _ in batch:
+                order.pop("_id", None)
+                for job in jobs:
+                    job.pop("_id", None)
+                try:
+                    failures = await insert_orders_with_outbox([order], jobs)
+                    results.append(failures.get(order["id"]))
+                except Exception as e:
+                    results.append(e)
+        for (_, _, future), error in zip(batch, results):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+    
+    async def drain(self):
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+order_write_coalescer = OrderWriteCoalescer(WRITE_COALESCE_WINDOW_MS, WRITE_COALESCE_MAX_DOCS)
+
+async def insert_order_with_outbox(order_dict: dict, jobs: List[dict]):
+    if WRITE_COALESCE_WINDOW_MS > 0:
+        await order_write_coalescer.submit(order_dict, jobs)
+        return
+    failures = await insert_orders_with_outbox([order_dict], jobs)
+    if order_dict["id"] in failures:
+        raise failures[order_dict["id"]]
+
+async def _apply_customer_stats(job: dict):
+    payload = job["payload"]
+    # The job id is remembered on the customer so a retried job cannot count the same order twice
+    not_applied = {"applied_jobs": {"$ne": job["id"]}}
+    update = {
+        "$inc": {"total_orders": 1, "lifetime_value": payload["total"]},
+        "$push": {"applied_jobs": {"$each": [job["id"]], "$slice": -50}},
+        "$set": await stamp_update("customers")
+    }
+    if payload.get("email"):
+        update["$setOnInsert"] = {
+            "id": str(uuid.uuid4()),
+            "name": payload["name"],
+            "phone": payload.get("phone"),
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+        try:
+            await db.customers.update_one({"email": payload["email"], **not_applied}, update, upsert=True)
+        except DuplicateKeyError:
+            pass
+    elif payload.get("phone"):
+        await db.customers.update_one({"phone": payload["phone"], **not_applied}, update)
+
+async def _apply_customer_adjustment(job: dict):
+    payload = job["payload"]
+    if not payload.get("email") and not payload.get("phone"):
+        return
+    key = {"email": payload["email"]} if payload.get("email") else {"phone": payload["phone"]}
+    # Both counters move in one update, and only once per job
+    result = await db.customers.update_one(
+        {**key, "applied_jobs": {"$ne": job["id"]}},
+        {
+            "$inc": {"total_orders": payload["orders"], "lifetime_value": payload["value"]},
+            "$push": {"applied_jobs": {"$each": [job["id"]], "$slice": -50}},
+            "$set": await stamp_update("customers")
+        }
+    )
+    if not result.matched_count and await db.outbox.find_one(
+        {"order_id": job["order_id"], "type": "customer_stats", "status": {"$ne": "done"}}, {"_id": 1}
+    ):
+        raise RuntimeError("Customer stats for this order have not been applied yet")
+
+async def _apply_order_rollups(job: dict):
+    order = await db.orders.find_one({"id": job["payload"]["order_id"]}, {"_id": 0, "search_tokens": 0})
+    if order:
+        record_order_sketches(order)
+        record_product_sales(order)
+
+OUTBOX_HANDLERS = {
+    "customer_stats": _apply_customer_stats,
+    "customer_adjustment": _apply_customer_adjustment,
+    "order_rollups": _apply_order_rollups
+}
+
+async def lease_outbox_job():
+    now = datetime.now(timezone.utc)
+    # A lease is just a later available_at: if the worker dies, the job becomes available again on its own
+    return await db.outbox.find_one_and_update(
+        {"status": {"$in": ["pending", "leased"]}, "available_at": {"$lte": now}},
+        {
+            "$set": {"status": "leased", "leased_by": INSTANCE_ID, "available_at": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("available_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def process_outbox_job(job: dict):
+    try:
+        handler = OUTBOX_HANDLERS.get(job["type"])
+        if handler is None:
+            raise ValueError(f"No handler for outbox job type '{job['type']}'")
+        await handler(job)
+    except Exception as e:
+        now = datetime.now(timezone.utc)
+        if job["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(f"Outbox job {job['id']} ({job['type']}) failed permanently: {e}")
+            update = {"status": "failed", "last_error": str(e), "failed_at": now}
+        else:
+            update = {"status": "pending", "last_error": str(e), "available_at": now + timedelta(seconds=2 ** job["attempts"])}
+        await db.outbox.update_one({"id": job["id"], "leased_by": INSTANCE_ID}, {"$set": update})
+        return
+    
+    await db.outbox.update_one(
+        {"id": job["id"], "leased_by": INSTANCE_ID},
+        {"$set": {"status": "done", "completed_at": datetime.now(timezone.utc)}}
+    )
+
+async def _outbox_worker_loop():
+    while True:
+        # A failed write leaves the job leased; it is picked up again once the lease runs out
+        try:
+            job = await lease_outbox_job()
+            if job:
+                await process_outbox_job(job)
+                continue
+        except Exception:
+            logger.exception("Outbox worker iteration failed")
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+            continue
+        
+        _outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(_outbox_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+@api_router.get("/admin/outbox")
+async def get_outbox_status(current_user: dict = Depends(verify_token)):
+    admin_doc = await db.users.find_one({"email": current_user["sub"]}, {"_id": 0})
+    if not admin_doc or admin_doc.get('role') != 'admin':
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    if customer:
-        await db.customers.update_one(
-            customer_query,
-            {"$inc": {"total_orders": 1, "lifetime_value": total}}
+    counts = await db.outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list(10)
+    failed = await db.outbox.find({"status": "failed"}, {"_id": 0, "payload": 0}).sort("failed_at", -1).limit(20).to_list(20)
+    return {"counts": {row["_id"]: row["count"] for row in counts}, "recent_failures": failed}
+
+SYNC_PROJECTIONS = {
+    "orders": {"_id": 0, "search_tokens": 0, "status_batch": 0},
+    "products": {"_id": 0},
+    "customers": {"_id": 0, "applied_jobs": 0}
+}
+
+async def record_tombstones(collection: str, ids: List[str]):
+    if not ids:
+        return
+    stamp = await stamp_update(collection)
+    deleted_at = datetime.now(timezone.utc)
+    await db.tombstones.insert_many([
+        {"collection": collection, "id": doc_id, "deleted_at": deleted_at, **stamp} for doc_id in ids
+    ])
+
+def _encode_sync_token(cursors: dict) -> str:
+    raw = json.dumps({"c": cursors, "t": datetime.now(timezone.utc).isoformat()}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_sync_token(token: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        issued = datetime.fromisoformat(data["t"])
+        cursors = {key: [int(seq), str(last_id)] for key, (seq, last_id) in data["c"].items()}
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    if issued < datetime.now(timezone.utc) - timedelta(days=SYNC_TOMBSTONE_DAYS):
+        # Deletions older than the tombstone retention are gone, so the client has to start over
+        raise HTTPException(status_code=410, detail="Sync token expired; fetch without 'since' to resync")
+    return cursors
+
+async def _sync_page(collection, query: dict, cursor: Optional[list], projection: dict, limit: int, settled_before: str):
+    seq, last_id = cursor or [-1, ""]
+    docs = await collection.find(
+        {**query, "$or": [{"updated_seq": {"$gt": seq}}, {"updated_seq": seq, "id": {"$gt": last_id}}]},
+        projection
+    ).sort([("updated_seq", 1), ("id", 1)]).limit(limit + 1).to_list(limit + 1)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    
+    # Writers take their sequence number just before writing, so a lower number can still land after
+    # a higher one has been read. The cursor only moves past documents older than the settle window;
+    # newer ones are returned now and again on the next poll, and clients upsert them by id.
+    next_cursor = [seq, last_id]
+    for doc in docs:
+        if doc.get("updated_at", "") > settled_before:
+            break
+        next_cursor = [doc["updated_seq"], doc["id"]]
+    if has_more and next_cursor == [seq, last_id]:
+        next_cursor = [docs[-1]["updated_seq"], docs[-1]["id"]]
+    return docs, next_cursor, has_more
+
+@api_router.get("/sync")
+async def sync_changes(
+    since: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=2000),
+    _: dict = Depends(verify_token)
+):
+    cursors = _decode_sync_token(since) if since else {}
+    settled_before = (datetime.now(timezone.utc) - timedelta(seconds=SYNC_SETTLE_SECONDS)).isoformat()
+    
+    response = {}
+    next_cursors = {}
+    has_more = False
+    for collection, projection in SYNC_PROJECTIONS.items():
+        changed, next_cursors[collection], more_changed = await _sync_page(
+            db[collection], {}, cursors.get(collection), projection, limit, settled_before
+        )
+        deleted_key = f"{collection}:deleted"
+        if since:
+            deleted, next_cursors[deleted_key], more_deleted = await _sync_page(
+                db.tombstones, {"collection": collection}, cursors.get(deleted_key),
+                {"_id": 0, "id": 1, "updated_seq": 1, "updated_at": 1}, limit, settled_before
+            )
+        else:
+            # A full sync has nothing to delete on the client; start the deletion cursor at the newest tombstone
+            latest = await db.tombstones.find({"collection": collection}, {"_id": 0, "id": 1, "updated_seq": 1}).sort([("updated_seq", -1), ("id", -1)]).limit(1).to_list(1)
+            deleted, more_deleted = [], False
+            next_cursors[deleted_key] = [latest[0]["updated_seq"], latest[0]["id"]] if latest else [-1, ""]
+        response[collection] = {"changed": changed, "deleted": [doc["id"] for doc in deleted]}
+        has_more = has_more or more_changed or more_deleted
+    
+    return {"token": _encode_sync_token(next_cursors), "has_more": has_more, **response}
+
+ARCHIVED_STATUSES = ["delivered", "completed", "cancelled", "returned"]
+_archive_cache = {"watermark": None, "checked_at": 0.0}
+
+async def get_archive_watermark() -> Optional[str]:
+    # Closed orders created before the watermark may live in orders_archive; nothing newer ever does
+    if time.monotonic() - _archive_cache["checked_at"] > ARCHIVE_WATERMARK_TTL:
+        doc = await db.counters.find_one({"_id": "archive_watermark"})
+        _archive_cache["watermark"] = doc["created_at"] if doc else None
+        _archive_cache["checked_at"] = time.monotonic()
+    return _archive_cache["watermark"]
+
+async def range_reaches_archive(filter_query: dict) -> bool:
+    watermark = await get_archive_watermark()
+    if watermark is None:
+        return False
+    start = filter_query.get("created_at", {}).get("$gte")
+    return start is None or start < watermark
+
+async def find_orders(filter_query: dict, projection: dict, limit: int = 1000) -> List[dict]:
+    orders = await db.orders.find(filter_query, projection).to_list(limit)
+    if len(orders) < limit and await range_reaches_archive(filter_query):
+        seen = {order["id"] for order in orders}
+        archived = await db.orders_archive.find(filter_query, projection).to_list(limit - len(orders))
+        orders += [order for order in archived if order["id"] not in seen]
+    return orders
+
+async def find_one_order(filter_query: dict, projection: dict) -> Optional[dict]:
+    order = await db.orders.find_one(filter_query, projection)
+    if order is None and await get_archive_watermark() is not None:
+        order = await db.orders_archive.find_one(filter_query, projection)
+    return order
+
+# Archived orders are read-only: status changes and returns on them are refused with 409 instead of a 404
+ARCHIVED_ORDER_ERROR = "Order is archived; orders closed before the archive cutoff can no longer be changed"
+
+async def find_archived_order(order_id: str, projection: dict) -> Optional[dict]:
+    if await get_archive_watermark() is None:
+        return None
+    return await db.orders_archive.find_one({"id": order_id}, projection)
+
+async def archived_order_ids(order_ids: List[str]) -> set:
+    if not order_ids or await get_archive_watermark() is None:
+        return set()
+    return set(await db.orders_archive.distinct("id", {"id": {"$in": order_ids}}))
+
+async def _merge_by_created_at(*cursors):
+    heads = []
+    for index, cursor in enumerate(cursors):
+        async for doc in cursor:
+            heads.append((doc["created_at"], index, doc))
+            break
+    heapq.heapify(heads)
+    while heads:
+        _created_at, index, doc = heapq.heappop(heads)
+        yield doc
+        async for following in cursors[index]:
+            heapq.heappush(heads, (following["created_at"], index, following))
+            break
+
+async def _archive_batch(cutoff: str, after: Optional[list] = None):
+    # Returns the number of orders moved and the (created_at, id) to continue after, or None once the range is done.
+    # Orders that stay hot are not deleted, so the next batch has to start past them rather than at the beginning.
+    filter_query = {"status": {"$in": ARCHIVED_STATUSES}, "created_at": {"$lt": cutoff}}
+    if after:
+        filter_query["$or"] = [{"created_at": {"$gt": after[0]}}, {"created_at": after[0], "id": {"$gt": after[1]}}]
+    batch = await db.orders.find(filter_query, {"_id": 0}).sort([("created_at", 1), ("id", 1)]).limit(ARCHIVE_BATCH_SIZE).to_list(ARCHIVE_BATCH_SIZE)
+    if not batch:
+        return 0, None
+    next_after = [batch[-1]["created_at"], batch[-1]["id"]] if len(batch) == ARCHIVE_BATCH_SIZE else None
+    
+    # Copy first (idempotent by id), then delete only the exact version that was copied. An order that
+    # changed in between stays hot and its archive copy is dropped again, so no order lives in both.
+    await db.orders_archive.bulk_write([ReplaceOne({"id": order["id"]}, order, upsert=True) for order in batch], ordered=False)
+    await db.orders.bulk_write([DeleteOne({"id": order["id"], "updated_seq": order.get("updated_seq")}) for order in batch], ordered=False)
+    still_hot = {o["id"] async for o in db.orders.find({"id": {"$in": [order["id"] for order in batch]}}, {"_id": 0, "id": 1})}
+    if still_hot:
+        await db.orders_archive.delete_many({"id": {"$in": list(still_hot)}})
+    
+    moved = [order for order in batch if order["id"] not in still_hot]
+    rollups = {}
+    for order in moved:
+        row = rollups.setdefault(order["brand_id"], {"total_revenue": 0.0, "total_orders": 0})
+        row["total_revenue"] += order.get("total_base") or 0
+        row["total_orders"] += 1
+    if rollups:
+        await db.archive_totals.bulk_write([
+            UpdateOne({"_id": brand_id}, {"$inc": row}, upsert=True) for brand_id, row in rollups.items()
+        ], ordered=False)
+    product_rollups = {}
+    for order in moved:
+        for item in order.get("items", []):
+            row = product_rollups.setdefault((order["brand_id"], item["product_id"]), {"name": item["product_name"], "quantity": 0, "revenue": 0.0})
+            row["quantity"] += item["quantity"]
+            row["revenue"] += item["total"] * (order.get("fx_rate") or 1)
+    if product_rollups:
+        await db.archive_product_totals.bulk_write([
+            UpdateOne(
+                {"_id": f"{brand_id}:{pid}"},
+                {"$inc": {"quantity": row["quantity"], "revenue": row["revenue"]}, "$setOnInsert": {"brand_id": brand_id, "product_id": pid, "product_name": row["name"]}},
+                upsert=True
+            )
+            for (brand_id, pid), row in product_rollups.items()
+        ], ordered=False)
+    await record_tombstones("orders", [order["id"] for order in moved])
+    return len(moved), next_after
+
+async def _rebuild_archive_totals():
+    rows = await db.orders_archive.aggregate([
+        {"$group": {"_id": "$brand_id", "total_revenue": {"$sum": "$total_base"}, "total_orders": {"$sum": 1}}}
+    ]).to_list(1000)
+    if rows:
+        await db.archive_totals.bulk_write([
+            ReplaceOne({"_id": row["_id"]}, {"total_revenue": row["total_revenue"], "total_orders": row["total_orders"]}, upsert=True)
+            for row in rows
+        ], ordered=False)
+    await db.archive_totals.delete_many({"_id": {"$nin": [row["_id"] for row in rows]}})
+    
+    products = await db.orders_archive.aggregate([
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {"brand_id": "$brand_id", "product_id": "$items.product_id"},
+            "product_name": {"$first": "$items.product_name"},
+            "quantity": {"$sum": "$items.quantity"},
+            "revenue": {"$sum": {"$multiply": ["$items.total", {"$ifNull": ["$fx_rate", 1]}]}}
+        }}
+    ]).to_list(None)
+    ids = [f"{row['_id']['brand_id']}:{row['_id']['product_id']}" for row in products]
+    if products:
+        await db.archive_product_totals.bulk_write([
+            ReplaceOne({"_id": row_id}, {**row["_id"], "product_name": row["product_name"], "quantity": row["quantity"], "revenue": row["revenue"]}, upsert=True)
+            for row_id, row in zip(ids, products)
+        ], ordered=False)
+    await db.archive_product_totals.delete_many({"_id": {"$nin": ids}})
+
+async def acquire_lease(name: str, seconds: float) -> bool:
+    now = datetime.now(timezone.utc)
+    try:
+        await db.counters.find_one_and_update(
+            {"_id": f"{name}_lock", "until": {"$lt": now}},
+            {"$set": {"until": now + timedelta(seconds=seconds), "owner": INSTANCE_ID}},
+            upsert=True
         )
-    elif order_data.customer_email:
-        new_customer = Customer(
-            name=order_data.customer_name,
-            email=order_data.customer_email,
-            phone=order_data.customer_phone,
-            total_orders=1,
-            lifetime_value=total
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def release_lease(name: str):
+    await db.counters.update_one({"_id": f"{name}_lock", "owner": INSTANCE_ID}, {"$set": {"until": datetime.now(timezone.utc)}})
+
+async def archive_closed_orders() -> dict:
+    now = datetime.now(timezone.utc)
+    if not await acquire_lease("archive", 3600):
+        return {"archived": 0, "skipped": "another instance is archiving"}
+    
+    try:
+        cutoff = (now - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+        previous = await db.counters.find_one_and_update(
+            {"_id": "archive_watermark"},
+            {"$max": {"created_at": cutoff}},
+            upsert=True
         )
-        customer_dict = new_customer.model_dump()
-        customer_dict['created_at'] = customer_dict['created_at'].isoformat()
-        await db.customers.insert_one(customer_dict)
+        if not previous or previous.get("created_at", "") < cutoff:
+            # Give every instance's cached watermark time to move before orders disappear from the hot collection
+            await asyncio.sleep(ARCHIVE_WATERMARK_TTL)
+        
+        archived = 0
+        after = None
+        while True:
+            moved, after = await _archive_batch(cutoff, after)
+            archived += moved
+            if after is None:
+                break
+        if archived:
+            await _rebuild_archive_totals()
+        return {"archived": archived, "cutoff": cutoff}
+    finally:
+        await release_lease("archive")
+
+async def _archive_loop():
+    while True:
+        try:
+            result = await archive_closed_orders()
+            if result["archived"]:
+                logger.info(f"Archived {result['archived']} orders created before {result['cutoff']}")
+        except Exception as e:
+            logger.warning(f"Order archival failed: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+@api_router.post("/admin/archive/run")
+async def run_order_archival(current_user: dict = Depends(verify_token)):
+    admin_doc = await db.users.find_one({"email": current_user["sub"]}, {"_id": 0})
+    if not admin_doc or admin_doc.get('role') != 'admin':
+        raise HTTPException(status_code=403, detail="Admin access required")
     
-    return order
+    return await archive_closed_orders()
+
+@api_router.put("/orders/status:bulk")
+async def bulk_update_order_status(update_data: OrderStatusBulkUpdate, _: dict = Depends(verify_token)):
+    if update_data.status not in ORDER_STATUS_TRANSITIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown status '{update_data.status}'")
+    
+    order_ids = list(dict.fromkeys(update_data.order_ids))
+    orders = await db.orders.find(
+        {"id": {"$in": order_ids}},
+        {
+            "_id": 0, "id": 1, "status": 1, "customer_email": 1, "customer_phone": 1, "total": 1, "total_base": 1,
+            "refunded_total": 1, "items.product_id": 1, "items.quantity": 1, "items.total": 1, "allocations": 1
+        }
+    ).to_list(len(order_ids))
+    found = {order["id"]: order for order in orders}
+    archived = await archived_order_ids([order_id for order_id in order_ids if order_id not in found])
+    
+    errors = []
+    valid = []
+    for order_id in order_ids:
+        order = found.get(order_id)
+        if not order:
+            error = ARCHIVED_ORDER_ERROR if order_id in archived else "Order not found"
+        else:
+            error = validate_status_transition(order["status"], update_data.status)
+        if error:
+            errors.append({"order_id": order_id, "error": error})
+        else:
+            valid.append(order)
+    
+    applied, failed = set(), set()
+    if update_data.status == "returned":
+        # Each return can fail on its own (a concurrent partial return, say), so they are applied one at a time
+        for order in valid:
+            try:
+                applied |= await apply_status_transition([order], update_data.status)
+            except HTTPException as e:
+                errors.append({"order_id": order["id"], "error": e.detail})
+                failed.add(order["id"])
+    elif valid:
+        applied = await apply_status_transition(valid, update_data.status)
+    errors.extend({"order_id": order["id"], "error": "Order status changed concurrently"} for order in valid if order["id"] not in applied | failed)
+    
+    return {"status": update_data.status, "updated": [order_id for order_id in order_ids if order_id in applied], "errors": errors}
 
 @api_router.put("/orders/{order_id}", response_model=Order)
 async def update_order(order_id: str, status: str, _: dict = Depends(verify_token)):
     order = await db.orders.find_one({"id": order_id}, {"_id": 0})
+    archived = False
+    if not order:
+        order = await find_archived_order(order_id, {"_id": 0})
+        archived = order is not None
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    await db.orders.update_one({"id": order_id}, {"$set": {"status": status}})
-    order['status'] = status
+    if order['status'] != status:
+        if archived:
+            raise HTTPException(status_code=409, detail=ARCHIVED_ORDER_ERROR)
+        error = validate_status_transition(order['status'], status)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        if not await apply_status_transition([order], status):
+            raise HTTPException(status_code=409, detail="Order status changed concurrently, please reload")
+        order = await db.orders.find_one({"id": order_id}, {"_id": 0}) if status == "returned" else {**order, "status": status}
     
     if isinstance(order['created_at'], str):
         order['created_at'] = datetime.fromisoformat(order['created_at'])
     
     return Order(**order)
 
+RETURNABLE_STATUSES = {"shipped", "delivered", "completed"}
+
+async def allocate_document_number(counter_id: str, prefix: str) -> str:
+    counter = await db.counters.find_one_and_update(
+        {"_id": counter_id},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return f"{prefix}-{datetime.now(timezone.utc).strftime('%Y%m%d')}-{str(counter['seq']).zfill(6)}"
+
+def remaining_return_quantities(order: dict) -> dict:
+    remaining = {}
+    for item in order.get("items", []):
+        remaining[item["product_id"]] = remaining.get(item["product_id"], 0) + item["quantity"]
+    for pid, qty in (order.get("returned_quantities") or {}).items():
+        remaining[pid] = remaining.get(pid, 0) - qty
+    return {pid: qty for pid, qty in remaining.items() if qty > 0}
+
+async def create_order_return(
+    order: dict,
+    quantities: dict,
+    reason: Optional[str] = None,
+    restock: bool = True,
+    location: Optional[str] = None,
+    created_by: Optional[str] = None
+) -> OrderReturn:
+    if order["status"] not in RETURNABLE_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Orders that are {order['status']} cannot be returned")
+    if not quantities:
+        raise HTTPException(status_code=400, detail="At least one item is required")
+    
+    remaining = remaining_return_quantities(order)
+    names, amounts, purchased = {}, {}, {}
+    for item in order.get("items", []):
+        names[item["product_id"]] = item["product_name"]
+        amounts[item["product_id"]] = amounts.get(item["product_id"], 0) + item["total"]
+        purchased[item["product_id"]] = purchased.get(item["product_id"], 0) + item["quantity"]
+    for pid, qty in quantities.items():
+        if pid not in purchased:
+            raise HTTPException(status_code=400, detail=f"Product {pid} is not part of order {order['order_number']}")
+        if qty <= 0:
+            raise HTTPException(status_code=400, detail="Return quantities must be positive")
+        if qty > remaining.get(pid, 0):
+            raise HTTPException(status_code=400, detail=f"Cannot return {qty} of {names[pid]}; {remaining.get(pid, 0)} left to return")
+    
+    # Refunds cover the returned lines and their VAT; shipping is not refunded
+    vat_share = order["vat_amount"] / order["subtotal"] if order.get("subtotal") else 0.0
+    items = [
+        ReturnItem(product_id=pid, product_name=names[pid], quantity=qty, amount=round(amounts[pid] / purchased[pid] * qty * (1 + vat_share), 2))
+        for pid, qty in quantities.items()
+    ]
+    refund = round(sum(item.amount for item in items), 2)
+    rate = order["total_base"] / order["total"] if order.get("total") and order.get("total_base") is not None else None
+    
+    restocked = {}
+    if restock:
+        # Stock goes back where it was allocated from, after what earlier returns already put back
+        pool = {}
+        for (pid, allocated_at), qty in order_stock_changes(order).items():
+            pool.setdefault(pid, {})[allocated_at] = qty
+        for pid, qty in (order.get("returned_quantities") or {}).items():
+            if pid in pool:
+                take_allocation(pool, pid, qty)
+        for pid, qty in quantities.items():
+            for allocated_at, taken in (take_allocation(pool, pid, qty) if pid in pool else {DEFAULT_WAREHOUSE: qty}).items():
+                key = (pid, location or allocated_at)
+                restocked[key] = restocked.get(key, 0) + taken
+    
+    order_return = OrderReturn(
+        rma_number=await allocate_document_number("rma_number", "RMA"),
+        order_id=order["id"],
+        order_number=order["order_number"],
+        customer_email=order.get("customer_email"),
+        customer_phone=order.get("customer_phone"),
+        items=items,
+        currency=order.get("currency", "SAR"),
+        refund_amount=refund,
+        refund_base=round(refund * rate, 2) if rate is not None else None,
+        restocked=[StockAllocation(product_id=pid, location=at, quantity=qty) for (pid, at), qty in restocked.items()],
+        reason=reason,
+        created_by=created_by
+    )
+    return_dict = order_return.model_dump()
+    return_dict["created_at"] = return_dict["created_at"].isoformat()
+    await db.returns.insert_one(return_dict)
+    
+    # The order only moves on if nobody returned from it since we read it; the record goes again if we lost
+    returned = dict(order.get("returned_quantities") or {})
+    for pid, qty in quantities.items():
+        returned[pid] = returned.get(pid, 0) + qty
+    fully_returned = not remaining_return_quantities({**order, "returned_quantities": returned})
+    claimed = await db.orders.update_one(
+        {"id": order["id"], "status": order["status"], "return_seq": order.get("return_seq")},
+        {
+            "$set": {"returned_quantities": returned, **({"status": "returned"} if fully_returned else {}), **await stamp_update("orders")},
+            "$inc": {"return_seq": 1, "refunded_total": refund}
+        }
+    )
+    if not claimed.modified_count:
+        await db.returns.delete_one({"id": order_return.id})
+        raise HTTPException(status_code=409, detail="Order changed concurrently, please retry the return")
+    
+    await apply_stock_changes(restocked, "return", order_return.id)
+    record_product_sales({**order, "items": [
+        {"product_id": pid, "quantity": qty, "total": amounts[pid] / purchased[pid] * qty} for pid, qty in quantities.items()
+    ]}, sign=-1)
+    await db.outbox.insert_one(customer_adjustment_job(order, -1 if fully_returned else 0, -refund))
+    _outbox_wakeup.set()
+    return order_return
+
+@api_router.post("/returns", response_model=OrderReturn)
+async def create_return(return_data: ReturnCreate, current_user: dict = Depends(verify_token)):
+    location = stock_location(return_data.location) if return_data.location else None
+    order = await db.orders.find_one({"id": return_data.order_id}, ORDER_PROJECTION)
+    if not order:
+        if await find_archived_order(return_data.order_id, {"_id": 0, "id": 1}):
+            raise HTTPException(status_code=409, detail=ARCHIVED_ORDER_ERROR)
+        raise HTTPException(status_code=404, detail="Order not found")
+    quantities = {}
+    for item in return_data.items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    return await create_order_return(order, quantities, return_data.reason, return_data.restock, location, current_user.get("sub"))
+
+@api_router.get("/returns", response_model=List[OrderReturn])
+async def get_returns(order_id: Optional[str] = None, _: dict = Depends(verify_token)):
+    filter_query = {"order_id": order_id} if order_id else {}
+    returns = await db.returns.find(filter_query, {"_id": 0}).sort("created_at", -1).to_list(500)
+    for order_return in returns:
+        order_return["created_at"] = datetime.fromisoformat(order_return["created_at"])
+    return returns
+
+@api_router.get("/returns/reconcile")
+async def reconcile_returns(current_user: dict = Depends(verify_token)):
+    admin_doc = await db.users.find_one({"email": current_user["sub"]}, {"_id": 0})
+    if not admin_doc or admin_doc.get('role') != 'admin':
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    # Orders: returned quantities and refunds on the order against the return records
+    recorded, refunds, restocked = {}, {}, {}
+    async for order_return in db.returns.find({}, {"_id": 0, "id": 1, "order_id": 1, "items": 1, "refund_amount": 1, "restocked": 1}):
+        lines = recorded.setdefault(order_return["order_id"], {})
+        for item in order_return["items"]:
+            lines[item["product_id"]] = lines.get(item["product_id"], 0) + item["quantity"]
+        refunds[order_return["order_id"]] = refunds.get(order_return["order_id"], 0) + order_return["refund_amount"]
+        restocked[order_return["id"]] = sum(line["quantity"] for line in order_return.get("restocked", []))
+    order_mismatches = []
+    for collection in (db.orders, db.orders_archive):
+        async for order in collection.find(
+            {"$or": [{"return_seq": {"$gt": 0}}, {"id": {"$in": list(recorded)}}]},
+            {"_id": 0, "id": 1, "order_number": 1, "returned_quantities": 1, "refunded_total": 1}
+        ):
+            expected = recorded.pop(order["id"], {})
+            if (order.get("returned_quantities") or {}) != expected or abs(order.get("refunded_total", 0) - refunds.get(order["id"], 0)) > 0.01:
+                order_mismatches.append({
+                    **order, "recorded_quantities": expected, "recorded_refunds": round(refunds.get(order["id"], 0), 2)
+                })
+    
+    # Stock: every restocked return has matching ledger rows
+    ledger = {
+        row["_id"]: row["quantity"]
+        async for row in db.stock_movements.aggregate([
+            {"$match": {"type": "return"}},
+            {"$group": {"_id": "$reference", "quantity": {"$sum": "$quantity"}}}
+        ])
+    }
+    stock_mismatches = [
+        {"return_id": return_id, "restocked": quantity, "ledger": ledger.get(return_id, 0)}
+        for return_id, quantity in restocked.items() if ledger.get(return_id, 0) != quantity
+    ]
+    
+    # Customers: counters against what the orders say, net of cancellations and refunds
+    expected_customers = {}
+    for collection in (db.orders, db.orders_archive):
+        async for row in collection.aggregate([
+            {"$match": {"status": {"$ne": "cancelled"}}},
+            {"$group": {
+                "_id": {"$ifNull": ["$customer_email", "$customer_phone"]},
+                "orders": {"$sum": {"$cond": [{"$eq": ["$status", "returned"]}, 0, 1]}},
+                "value": {"$sum": {"$subtract": ["$total", {"$ifNull": ["$refunded_total", 0]}]}}
+            }}
+        ]):
+            current = expected_customers.setdefault(row["_id"], {"orders": 0, "value": 0.0})
+            current["orders"] += row["orders"]
+            current["value"] += row["value"]
+    customer_mismatches = []
+    async for customer in db.customers.find({}, {"_id": 0, "id": 1, "name": 1, "email": 1, "phone": 1, "total_orders": 1, "lifetime_value": 1}):
+        expected = expected_customers.get(customer.get("email") or customer.get("phone"), {"orders": 0, "value": 0.0})
+        if customer.get("total_orders", 0) != expected["orders"] or abs(customer.get("lifetime_value", 0) - expected["value"]) > 0.01:
+            customer_mismatches.append({**customer, "expected_orders": expected["orders"], "expected_value": round(expected["value"], 2)})
+    
+    pending = await db.outbox.count_documents({"type": {"$in": ["customer_stats", "customer_adjustment"]}, "status": {"$ne": "done"}})
+    return {
+        "checked_at": datetime.now(timezone.utc).isoformat(),
+        "order_mismatches": order_mismatches,
+        "orphan_returns": sorted(recorded),
+        "stock_mismatches": stock_mismatches,
+        "customer_mismatches": customer_mismatches[:500],
+        # Customer counters trail the outbox, so mismatches may clear once these jobs have run
+        "pending_customer_jobs": pending
+    }
+
+PRODUCT_SORT_FIELDS = ("name", "price", "stock", "created_at")
+# Equality filters come first, then the sort key, then id as the tie-breaker; stock and price ranges
+# are bounded by the index when they are also the sort key and filtered during the scan otherwise.
+# Category-only listings fall back to the unprefixed sort index.
+PRODUCT_LIST_PREFIXES = ((), ("brand_id",), ("brand_id", "category"))
+
+def product_list_indexes() -> List[tuple]:
+    return [
+        ("products_list_" + "_".join(prefix + (field,)), [(key, 1) for key in prefix] + [(field, 1), ("id", 1)])
+        for prefix in PRODUCT_LIST_PREFIXES for field in PRODUCT_SORT_FIELDS
+    ]
+
+def _encode_list_cursor(value, last_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, last_id], separators=(",", ":")).encode()).decode().rstrip("=")
+
+def product_list_query(
+    brand_id: Optional[str] = None,
+    category: Optional[str] = None,
+    min_stock: Optional[int] = None,
+    max_stock: Optional[int] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    sort: str = "name",
+    cursor: Optional[str] = None
+):
+    field, direction = (sort[1:], -1) if sort.startswith("-") else (sort, 1)
+    if field not in PRODUCT_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Invalid sort; use one of {', '.join(PRODUCT_SORT_FIELDS)} with an optional '-' prefix")
+    filter_query = {}
+    if brand_id:
+        filter_query["brand_id"] = brand_id
+    if category:
+        filter_query["category"] = category
+    for key, low, high in (("stock", min_stock, max_stock), ("price", min_price, max_price)):
+        bounds = {op: value for op, value in (("$gte", low), ("$lte", high)) if value is not None}
+        if bounds:
+            filter_query[key] = bounds
+    if cursor:
+        try:
+            value, last_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        after, at_or_after = ("$gt", "$gte") if direction == 1 else ("$lt", "$lte")
+        filter_query["$and"] = [
+            {field: {at_or_after: value}},
+            {"$or": [{field: {after: value}}, {"id": {"$gt" if direction == 1 else "$lt": last_id}}]}
+        ]
+    return filter_query, [(field, direction), ("id", direction)]
+
 @api_router.get("/products", response_model=List[Product])
-async def get_products(brand_id: Optional[str] = None, _: dict = Depends(verify_token)):
-    filter_query = {"brand_id": brand_id} if brand_id else {}
-    products = await db.products.find(filter_query, {"_id": 0}).to_list(1000)
+async def get_products(
+    request: Request,
+    response: Response,
+    brand_id: Optional[str] = None,
+    category: Optional[str] = None,
+    min_stock: Optional[int] = None,
+    max_stock: Optional[int] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    sort: str = "name",
+    cursor: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=1000),
+    fields: Optional[str] = None,
+    _: dict = Depends(verify_token)
+):
+    # The catalog cache notices product edits on its own schedule, so the tag names the catalog it serves from
+    catalog = await get_catalog()
+    not_modified = await conditional_list(request, response, "products", f"catalog:{catalog['version']}")
+    if not_modified:
+        return not_modified
+    
+    filter_query, sort_spec = product_list_query(brand_id, category, min_stock, max_stock, min_price, max_price, sort, cursor)
+    sort_field = sort_spec[0][0]
+    slim_model = field_projection(Product, fields)[1] if fields else None
+    rows = await db.products.find(
+        filter_query, {"_id": 0, "id": 1, "stock": 1, "units_sold": 1, "revenue": 1, sort_field: 1}
+    ).sort(sort_spec).limit(limit + 1).to_list(limit + 1)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = _encode_list_cursor(rows[-1].get(sort_field), rows[-1]["id"])
+    if any(row["id"] not in catalog["by_id"] for row in rows):
+        await _load_catalog(catalog["version"])
+    products = [
+        {**catalog["by_id"][row["id"]], "stock": row["stock"], "units_sold": row.get("units_sold", 0), "revenue": row.get("revenue", 0.0)}
+        for row in rows if row["id"] in catalog["by_id"]
+    ]
+    if slim_model:
+        return projected_response(products, slim_model, response)
     for product in products:
         if isinstance(product['created_at'], str):
             product['created_at'] = datetime.fromisoformat(product['created_at'])
     return products
 
+@api_router.get("/products/suggest")
+async def suggest_products(
+    q: str = Query(..., min_length=1),
+    brand_id: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=50),
+    _: dict = Depends(verify_token)
+):
+    catalog = await get_catalog()
+    suggestions = []
+    for product_id in product_suggest_index.suggest(q, brand_id, limit):
+        product = catalog["by_id"].get(product_id)
+        if product:
+            suggestions.append({field: product.get(field) for field in ("id", "sku", "name", "brand_id", "brand_name", "price", "image_url")})
+    return suggestions
+
 @api_router.post("/products", response_model=Product)
 async def create_product(product_data: ProductCreate, _: dict = Depends(verify_token)):
+    location = stock_location(product_data.location)
     brand = await db.brands.find_one({"id": product_data.brand_id}, {"_id": 0})
     if not brand:
         brands = await get_brands()
@@ -511,39 +3086,364 @@ async def create_product(product_data: ProductCreate, _: dict = Depends(verify_t
         category=product_data.category,
         stock=product_data.stock,
         price=product_data.price,
-        image_url=product_data.image_url
+        image_url=product_data.image_url,
+        reorder_level=product_data.reorder_level
     )
     
     product_dict = product.model_dump()
     product_dict['created_at'] = product_dict['created_at'].isoformat()
-    await db.products.insert_one(product_dict)
+    product_dict.update(await stamp_update("products"))
+    # Opening stock arrives as a receipt so the location record and the total are written by one path
+    await db.products.insert_one({**product_dict, "stock": 0})
+    await apply_stock_changes({(product.id, location): product.stock}, "receipt", "product_created")
+    await bump_catalog_version()
+    await refresh_low_stock([product.id])
     
     return product
 
+async def _upsert_product_chunk(records: list) -> List[dict]:
+    results = {}
+    rows = []
+    seen = set()
+    for row_number, record in records:
+        if isinstance(record, Exception) or not isinstance(record, dict):
+            results[row_number] = {"row": row_number, "status": "error", "error": str(record) if isinstance(record, Exception) else "Row must be an object"}
+            continue
+        try:
+            row = ProductBulkRow(**record)
+        except ValidationError as e:
+            first = e.errors()[0]
+            results[row_number] = {"row": row_number, "status": "error", "error": f"{'.'.join(str(part) for part in first['loc'])}: {first['msg']}"}
+            continue
+        if row.sku in seen:
+            results[row_number] = {"row": row_number, "sku": row.sku, "status": "error", "error": "Duplicate sku in this upload"}
+        elif row.stock is not None and row.stock_delta is not None:
+            results[row_number] = {"row": row_number, "sku": row.sku, "status": "error", "error": "Use either stock or stock_delta, not both"}
+        else:
+            seen.add(row.sku)
+            rows.append((row_number, row))
+    
+    existing = {p["sku"]: p async for p in db.products.find({"sku": {"$in": [row.sku for _, row in rows]}}, {"_id": 0})} if rows else {}
+    levels = {
+        (level["product_id"], level["location"]): level["stock"]
+        async for level in db.stock_locations.find(
+            {"product_id": {"$in": [p["id"] for p in existing.values()]}}, {"_id": 0, "product_id": 1, "location": 1, "stock": 1}
+        )
+    } if existing else {}
+    brand_names = {b["id"]: b["name"] for b in await get_brands()}
+    reference = f"bulk:{uuid.uuid4()}"
+    product_stamp = await stamp_update("products")
+    
+    inserts, insert_rows, updates = [], [], []
+    for row_number, row in rows:
+        if row.location is not None and row.location not in WAREHOUSES:
+            results[row_number] = {"row": row_number, "sku": row.sku, "status": "error", "error": f"Unknown location '{row.location}'"}
+            continue
+        key_location = row.location or DEFAULT_WAREHOUSE
+        current = existing.get(row.sku)
+        if current is None:
+            missing = [field for field in ("name", "brand_id", "category", "price") if getattr(row, field) is None]
+            stock = row.stock if row.stock is not None else (row.stock_delta or 0)
+            if missing or stock < 0:
+                error = f"New product needs {', '.join(missing)}" if missing else "Stock cannot be negative"
+                results[row_number] = {"row": row_number, "sku": row.sku, "status": "error", "error": error}
+                continue
+            product = Product(
+                sku=row.sku, name=row.name, brand_id=row.brand_id, brand_name=brand_names.get(row.brand_id, "Unknown"),
+                category=row.category, stock=0, price=row.price, image_url=row.image_url, reorder_level=row.reorder_level
+            )
+            product_dict = product.model_dump()
+            product_dict['created_at'] = product_dict['created_at'].isoformat()
+            inserts.append(InsertOne({**product_dict, **product_stamp}))
+            insert_rows.append((row_number, row, (product.id, key_location), stock))
+            continue
+        
+        fields = {
+            field: getattr(row, field) for field in ("name", "brand_id", "category", "price", "image_url", "reorder_level")
+            if getattr(row, field) is not None and getattr(row, field) != current.get(field)
+        }
+        if "brand_id" in fields:
+            fields["brand_name"] = brand_names.get(fields["brand_id"], "Unknown")
+        if row.stock is not None and row.stock < 0:
+            results[row_number] = {"row": row_number, "sku": row.sku, "status": "error", "error": "Stock cannot be negative"}
+            continue
+        key = (current["id"], key_location)
+        # Stock counts are per location; an absolute count becomes a delta against the level we read
+        delta = row.stock - levels.get(key, 0) if row.stock is not None else (row.stock_delta or 0)
+        if not fields and not delta:
+            results[row_number] = {"row": row_number, "sku": row.sku, "status": "unchanged", "id": current["id"]}
+            continue
+        updates.append((row_number, row, key, delta, fields))
+    
+    insert_errors = {}
+    if inserts:
+        try:
+            await db.products.bulk_write(inserts, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                insert_errors[write_error["index"]] = "SKU already exists" if write_error.get("code") == 11000 else write_error.get("errmsg", "Write failed")
+    created = []
+    for index, (row_number, row, key, stock) in enumerate(insert_rows):
+        if index in insert_errors:
+            results[row_number] = {"row": row_number, "sku": row.sku, "status": "error", "error": insert_errors[index]}
+        else:
+            created.append((row_number, row, key, stock))
+    await apply_stock_changes({key: stock for _, _, key, stock in created}, "receipt", reference)
+    
+    # Absolute counts only apply while the level is still the one we read; negative deltas while enough is left
+    counted = {key: delta for _, row, key, delta, _ in updates if delta and row.stock is not None}
+    relative = {key: delta for _, row, key, delta, _ in updates if delta and row.stock is None}
+    applied = await apply_stock_changes(counted, "adjustment", reference, expected={key: levels.get(key, 0) for key in counted})
+    applied |= await apply_stock_changes(relative, "adjustment", reference, guarded=True)
+    
+    field_ops = []
+    watched = [key[0] for _, _, key, _ in created]
+    for row_number, row, key, delta, fields in updates:
+        if delta and key not in applied:
+            error = "Stock changed during upload; please retry this row" if row.stock is not None else f"Insufficient stock for a change of {delta}"
+            results[row_number] = {"row": row_number, "sku": row.sku, "status": "error", "error": error}
+            continue
+        if fields:
+            field_ops.append(UpdateOne({"id": key[0]}, {"$set": {**fields, **product_stamp}}))
+        if row.reorder_level is not None:
+            watched.append(key[0])
+        results[row_number] = {"row": row_number, "sku": row.sku, "status": "updated", "id": key[0]}
+    for row_number, row, key, _ in created:
+        results[row_number] = {"row": row_number, "sku": row.sku, "status": "created", "id": key[0]}
+    if field_ops:
+        await db.products.bulk_write(field_ops, ordered=False)
+    if inserts or field_ops:
+        await bump_catalog_version()
+    # Stock-only changes reach the low-stock watcher through the ledger; new thresholds are checked right away
+    await refresh_low_stock(watched)
+    return [results[row_number] for row_number in sorted(results)]
+
+async def _iter_product_records(request: Request, format: str):
+    if format == "ndjson":
+        async for record in _iter_ndjson_records(request):
+            yield record
+    elif format == "csv":
+        async for record in _iter_csv_rows(request):
+            yield record
+    else:
+        try:
+            body = await request.json()
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON: {e.msg}")
+        if not isinstance(body, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array of products")
+        for row_number, record in enumerate(body, start=1):
+            yield row_number, record
+
+@api_router.post("/products/bulk")
+async def bulk_upsert_products(request: Request, format: Optional[str] = Query(None, pattern="^(json|ndjson|csv)$"), _: dict = Depends(verify_token)):
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if "csv" in content_type else ("ndjson" if "ndjson" in content_type else "json")
+    
+    results = []
+    chunk = []
+    async for record in _iter_product_records(request, format):
+        chunk.append(record)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            results.extend(await _upsert_product_chunk(chunk))
+            chunk = []
+    if chunk:
+        results.extend(await _upsert_product_chunk(chunk))
+    
+    counts = {status_name: sum(1 for r in results if r["status"] == status_name) for status_name in ("created", "updated", "unchanged", "error")}
+    return {**counts, "results": results}
+
 @api_router.put("/products/{product_id}", response_model=Product)
 async def update_product(product_id: str, update_data: ProductUpdate, _: dict = Depends(verify_token)):
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
+    location = stock_location(update_data.location)
     update_fields = {}
-    if update_data.stock is not None:
-        update_fields["stock"] = update_data.stock
     if update_data.category is not None:
         update_fields["category"] = update_data.category
+    if update_data.reorder_level is not None:
+        update_fields["reorder_level"] = update_data.reorder_level
     
     if update_fields:
-        await db.products.update_one({"id": product_id}, {"$set": update_fields})
-        product.update(update_fields)
+        product = await db.products.find_one_and_update(
+            {"id": product_id},
+            {"$set": {**update_fields, **await stamp_update("products")}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if product:
+            await bump_catalog_version()
+    else:
+        product = await db.products.find_one({"id": product_id}, {"_id": 0})
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    
+    if update_data.stock is not None:
+        # A manual count sets one location; the difference to the level we read is posted as an adjustment
+        key = (product_id, location)
+        level = await db.stock_locations.find_one({"product_id": product_id, "location": location}, {"_id": 0, "stock": 1})
+        current = level["stock"] if level else 0
+        if update_data.stock != current:
+            if not await apply_stock_changes({key: update_data.stock - current}, "adjustment", "manual", expected={key: current}):
+                raise HTTPException(status_code=409, detail="Stock changed concurrently, please reload")
+            product["stock"] += update_data.stock - current
+    if update_fields or update_data.stock is not None:
+        await refresh_low_stock([product_id])
     
     if isinstance(product['created_at'], str):
         product['created_at'] = datetime.fromisoformat(product['created_at'])
     
     return Product(**product)
 
+@api_router.post("/suppliers", response_model=Supplier)
+async def create_supplier(supplier_data: SupplierCreate, _: dict = Depends(verify_token)):
+    supplier = Supplier(**supplier_data.model_dump())
+    supplier_dict = supplier.model_dump()
+    supplier_dict['created_at'] = supplier_dict['created_at'].isoformat()
+    await db.suppliers.insert_one(supplier_dict)
+    return supplier
+
+@api_router.get("/suppliers", response_model=List[Supplier])
+async def get_suppliers(_: dict = Depends(verify_token)):
+    suppliers = await db.suppliers.find({}, {"_id": 0}).sort("name", 1).to_list(1000)
+    for supplier in suppliers:
+        if isinstance(supplier['created_at'], str):
+            supplier['created_at'] = datetime.fromisoformat(supplier['created_at'])
+    return suppliers
+
+def _purchase_order_response(purchase_order: dict) -> dict:
+    for field in ("created_at", "received_at"):
+        if isinstance(purchase_order.get(field), str):
+            purchase_order[field] = datetime.fromisoformat(purchase_order[field])
+    return purchase_order
+
+@api_router.post("/purchase-orders", response_model=PurchaseOrder)
+async def create_purchase_order(po_data: PurchaseOrderCreate, current_user: dict = Depends(verify_token)):
+    location = stock_location(po_data.location)
+    supplier = await db.suppliers.find_one({"id": po_data.supplier_id}, {"_id": 0})
+    if not supplier:
+        raise HTTPException(status_code=404, detail="Supplier not found")
+    if not po_data.lines:
+        raise HTTPException(status_code=400, detail="At least one line is required")
+    
+    product_ids = [line.product_id for line in po_data.lines if line.product_id]
+    skus = [line.sku for line in po_data.lines if not line.product_id and line.sku]
+    by_id, by_sku = {}, {}
+    async for product in db.products.find({"$or": [{"id": {"$in": product_ids}}, {"sku": {"$in": skus}}]}, {"_id": 0, "id": 1, "sku": 1, "name": 1}):
+        by_id[product["id"]] = product
+        by_sku[product["sku"]] = product
+    
+    lines = {}
+    for index, line in enumerate(po_data.lines, start=1):
+        product = by_id.get(line.product_id) if line.product_id else by_sku.get(line.sku)
+        if not product:
+            raise HTTPException(status_code=400, detail=f"Line {index}: product {line.product_id or line.sku} not found")
+        if line.quantity <= 0:
+            raise HTTPException(status_code=400, detail=f"Line {index}: quantity must be positive")
+        if product["id"] in lines:
+            raise HTTPException(status_code=400, detail=f"Line {index}: {product['sku']} is already on this purchase order")
+        lines[product["id"]] = PurchaseOrderLine(
+            product_id=product["id"], sku=product["sku"], product_name=product["name"], quantity=line.quantity, unit_cost=line.unit_cost
+        )
+    
+    purchase_order = PurchaseOrder(
+        po_number=await allocate_document_number("po_number", "PO"),
+        supplier_id=supplier["id"],
+        supplier_name=supplier["name"],
+        location=location,
+        lines=list(lines.values()),
+        total_cost=round(sum(line.quantity * line.unit_cost for line in lines.values()), 2),
+        notes=po_data.notes,
+        created_by=current_user.get("sub")
+    )
+    po_dict = purchase_order.model_dump()
+    po_dict['created_at'] = po_dict['created_at'].isoformat()
+    await db.purchase_orders.insert_one(po_dict)
+    return purchase_order
+
+@api_router.get("/purchase-orders", response_model=List[PurchaseOrder])
+async def get_purchase_orders(status: Optional[str] = None, supplier_id: Optional[str] = None, _: dict = Depends(verify_token)):
+    filter_query = {}
+    if status:
+        filter_query["status"] = status
+    if supplier_id:
+        filter_query["supplier_id"] = supplier_id
+    purchase_orders = await db.purchase_orders.find(filter_query, {"_id": 0}).sort("created_at", -1).to_list(500)
+    return [_purchase_order_response(po) for po in purchase_orders]
+
+@api_router.post("/purchase-orders/{po_id}/receive", response_model=PurchaseOrder)
+async def receive_purchase_order(po_id: str, receipt: Optional[PurchaseOrderReceipt] = None, _: dict = Depends(verify_token)):
+    purchase_order = await db.purchase_orders.find_one({"id": po_id}, {"_id": 0})
+    if not purchase_order:
+        raise HTTPException(status_code=404, detail="Purchase order not found")
+    if purchase_order["status"] != "open":
+        raise HTTPException(status_code=400, detail=f"Purchase order is already {purchase_order['status']}")
+    
+    outstanding = {line["product_id"]: line["quantity"] - line["received_quantity"] for line in purchase_order["lines"]}
+    skus = {line["product_id"]: line["sku"] for line in purchase_order["lines"]}
+    if receipt and receipt.lines is not None:
+        if not receipt.lines:
+            raise HTTPException(status_code=400, detail="At least one line is required; leave out lines to receive everything outstanding")
+        received = {}
+        for line in receipt.lines:
+            received[line.product_id] = received.get(line.product_id, 0) + line.quantity
+        for pid, qty in received.items():
+            if pid not in outstanding:
+                raise HTTPException(status_code=400, detail=f"Product {pid} is not on this purchase order")
+            if qty > outstanding[pid]:
+                raise HTTPException(status_code=400, detail=f"Cannot receive {qty} of {skus[pid]}; {outstanding[pid]} outstanding")
+    else:
+        received = {pid: qty for pid, qty in outstanding.items() if qty > 0}
+    
+    lines = [{**line, "received_quantity": line["received_quantity"] + received.get(line["product_id"], 0)} for line in purchase_order["lines"]]
+    complete = all(line["received_quantity"] >= line["quantity"] for line in lines)
+    receipt_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    # The receipt sequence makes a double submit or a concurrent receipt lose instead of posting stock twice
+    claimed = await db.purchase_orders.update_one(
+        {"id": po_id, "status": "open", "receipt_seq": purchase_order.get("receipt_seq")},
+        {
+            "$set": {"lines": lines, **({"status": "received", "received_at": now} if complete else {})},
+            "$inc": {"receipt_seq": 1},
+            "$push": {"receipts": {"id": receipt_id, "received_at": now, "quantities": received}}
+        }
+    )
+    if not claimed.modified_count:
+        raise HTTPException(status_code=409, detail="Purchase order changed concurrently, please reload")
+    
+    # Every line is posted in one bulk_write, with its receipt row in the ledger
+    try:
+        await apply_stock_changes(
+            {(pid, purchase_order["location"]): qty for pid, qty in received.items()}, "receipt", f"{purchase_order['po_number']}:{receipt_id}"
+        )
+    except OperationFailure:
+        # Take the receipt back so the purchase order can be received again rather than stay received
+        # without stock; a failure after the locations were written leaves no ledger row and shows in reconciliation
+        undone = await db.purchase_orders.update_one(
+            {"id": po_id, "receipt_seq": (purchase_order.get("receipt_seq") or 0) + 1},
+            {
+                "$set": {"lines": purchase_order["lines"], "status": "open"},
+                "$unset": {"received_at": ""},
+                "$inc": {"receipt_seq": 1},
+                "$pull": {"receipts": {"id": receipt_id}}
+            }
+        )
+        if not undone.modified_count:
+            logger.error(f"Receipt {receipt_id} on {purchase_order['po_number']} failed to post its stock and could not be taken back")
+        raise
+    return _purchase_order_response({
+        **purchase_order, "lines": lines, **({"status": "received", "received_at": now} if complete else {})
+    })
+
 @api_router.get("/customers", response_model=List[Customer])
-async def get_customers(_: dict = Depends(verify_token)):
-    customers = await db.customers.find({}, {"_id": 0}).sort("lifetime_value", -1).to_list(1000)
+async def get_customers(request: Request, response: Response, fields: Optional[str] = None, _: dict = Depends(verify_token)):
+    not_modified = await conditional_list(request, response, "customers")
+    if not_modified:
+        return not_modified
+    
+    projection, slim_model = field_projection(Customer, fields) if fields else (CUSTOMER_PROJECTION, None)
+    customers = await db.customers.find({}, projection).sort("lifetime_value", -1).to_list(1000)
+    if slim_model:
+        return projected_response(customers, slim_model, response)
     for customer in customers:
         if isinstance(customer['created_at'], str):
             customer['created_at'] = datetime.fromisoformat(customer['created_at'])
@@ -551,7 +3451,7 @@ async def get_customers(_: dict = Depends(verify_token)):
 
 @api_router.get("/customers/with-orders")
 async def get_customers_with_orders(_: dict = Depends(verify_token)):
-    customers = await db.customers.find({}, {"_id": 0}).sort("lifetime_value", -1).to_list(1000)
+    customers = await db.customers.find({}, CUSTOMER_PROJECTION).sort("lifetime_value", -1).to_list(1000)
     
     result = []
     for customer in customers:
@@ -569,12 +3469,17 @@ async def get_customers_with_orders(_: dict = Depends(verify_token)):
     return result
 
 @api_router.get("/customers/{customer_id}/invoice")
-async def get_customer_invoice(customer_id: str, _: dict = Depends(verify_token)):
-    customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
+async def get_customer_invoice(
+    customer_id: str,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    _: dict = Depends(verify_token)
+):
+    customer = await db.customers.find_one({"id": customer_id}, CUSTOMER_PROJECTION)
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
     
-    orders = await db.orders.find({"customer_email": customer["email"]}, {"_id": 0}).to_list(1000)
+    orders = await find_orders({"customer_email": customer["email"], **created_at_range(start, end)}, ORDER_PROJECTION)
     
     for order in orders:
         if isinstance(order.get('created_at'), str):
@@ -593,7 +3498,7 @@ async def get_customer_invoice(customer_id: str, _: dict = Depends(verify_token)
 
 @api_router.get("/search/invoice")
 async def search_invoice_by_order_number(order_number: str, _: dict = Depends(verify_token)):
-    order = await db.orders.find_one({"order_number": order_number}, {"_id": 0})
+    order = await find_one_order({"order_number": order_number}, ORDER_PROJECTION)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
@@ -601,7 +3506,7 @@ async def search_invoice_by_order_number(order_number: str, _: dict = Depends(ve
     if not customer_email:
         raise HTTPException(status_code=404, detail="Customer not found for this order")
     
-    customer = await db.customers.find_one({"email": customer_email}, {"_id": 0})
+    customer = await db.customers.find_one({"email": customer_email}, CUSTOMER_PROJECTION)
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
     
@@ -612,12 +3517,16 @@ async def search_invoice_by_order_number(order_number: str, _: dict = Depends(ve
     }
 
 @api_router.get("/public/invoice/{customer_id}")
-async def get_public_invoice(customer_id: str):
-    customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
+async def get_public_invoice(
+    customer_id: str,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to")
+):
+    customer = await db.customers.find_one({"id": customer_id}, CUSTOMER_PROJECTION)
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
     
-    orders = await db.orders.find({"customer_email": customer["email"]}, {"_id": 0}).to_list(1000)
+    orders = await find_orders({"customer_email": customer["email"], **created_at_range(start, end)}, ORDER_PROJECTION)
     
     for order in orders:
         if isinstance(order.get('created_at'), str):
@@ -635,7 +3544,19 @@ async def get_public_invoice(customer_id: str):
     }
 
 @api_router.get("/employees", response_model=List[Employee])
-async def get_employees(brand_id: Optional[str] = None, department: Optional[str] = None, status: Optional[str] = None, _: dict = Depends(verify_token)):
+async def get_employees(
+    request: Request,
+    response: Response,
+    brand_id: Optional[str] = None,
+    department: Optional[str] = None,
+    status: Optional[str] = None,
+    fields: Optional[str] = None,
+    _: dict = Depends(verify_token)
+):
+    not_modified = await conditional_list(request, response, "employees")
+    if not_modified:
+        return not_modified
+    
     filter_query = {}
     if brand_id:
         filter_query["brand_id"] = brand_id
@@ -644,7 +3565,10 @@ async def get_employees(brand_id: Optional[str] = None, department: Optional[str
     if status:
         filter_query["status"] = status
     
-    employees = await db.employees.find(filter_query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    projection, slim_model = field_projection(Employee, fields) if fields else ({"_id": 0}, None)
+    employees = await db.employees.find(filter_query, projection).sort("created_at", -1).to_list(1000)
+    if slim_model:
+        return projected_response(employees, slim_model, response)
     for employee in employees:
         if isinstance(employee['created_at'], str):
             employee['created_at'] = datetime.fromisoformat(employee['created_at'])
@@ -675,6 +3599,7 @@ async def create_employee(employee_data: EmployeeCreate, _: dict = Depends(verif
     employee_dict = employee.model_dump()
     employee_dict['created_at'] = employee_dict['created_at'].isoformat()
     employee_dict['hire_date'] = employee_dict['hire_date'].isoformat()
+    employee_dict.update(await stamp_update("employees"))
     await db.employees.insert_one(employee_dict)
     
     return employee
@@ -688,7 +3613,7 @@ async def update_employee(employee_id: str, employee_update: EmployeeUpdate, _:
     update_data = {k: v for k, v in employee_update.model_dump().items() if v is not None}
     
     if update_data:
-        await db.employees.update_one({"id": employee_id}, {"$set": update_data})
+        await db.employees.update_one({"id": employee_id}, {"$set": {**update_data, **await stamp_update("employees")}})
         employee.update(update_data)
     
     if isinstance(employee['created_at'], str):
@@ -703,6 +3628,7 @@ async def delete_employee(employee_id: str, _: dict = Depends(verify_token)):
     result = await db.employees.delete_one({"id": employee_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Employee not found")
+    await stamp_update("employees")
     return {"message": "Employee deleted successfully"}
 
 @api_router.get("/employees/stats")
@@ -747,18 +3673,369 @@ async def get_orders_by_user(current_user: dict = Depends(verify_token)):
 @app.on_event("startup")
 async def create_indexes():
     try:
+        await db.orders.create_index("id", unique=True)
         await db.orders.create_index("order_number", unique=True)
         await db.orders.create_index("customer_email")
         await db.orders.create_index("created_by")
         await db.orders.create_index("created_at")
         await db.customers.create_index("email", unique=True)
+        await db.products.create_index("id", unique=True)
         await db.products.create_index("sku", unique=True)
         await db.products.create_index("brand_id")
+        for name, keys in product_list_indexes():
+            await db.products.create_index(keys, name=name)
+        await db.orders.create_index([("brand_id", 1), ("total_base", 1)])
+        await db.orders.create_index([("brand_id", 1), ("created_at", -1)])
+        await db.orders.create_index([("search_tokens", 1), ("created_at", -1)])
+        await db.orders.create_index([("status", 1), ("created_at", 1)])
+        await db.orders_archive.create_index("id", unique=True)
+        await db.orders_archive.create_index("order_number")
+        await db.orders_archive.create_index([("customer_email", 1), ("created_at", 1)])
+        await db.orders_archive.create_index([("brand_id", 1), ("created_at", 1)])
+        await db.orders_archive.create_index("created_at")
+        await db.archive_product_totals.create_index("brand_id")
+        await db.stock_movements.create_index("created_at")
+        await db.stock_locations.create_index([("product_id", 1), ("location", 1)], unique=True)
+        await db.stock_locations.create_index([("location", 1), ("product_id", 1)])
+        await db.returns.create_index("id", unique=True)
+        await db.returns.create_index([("order_id", 1), ("created_at", -1)])
+        await db.suppliers.create_index("id", unique=True)
+        await db.purchase_orders.create_index("id", unique=True)
+        await db.purchase_orders.create_index([("status", 1), ("created_at", -1)])
+        await db.purchase_orders.create_index([("supplier_id", 1), ("created_at", -1)])
+        await db.stock_movements.create_index([("product_id", 1), ("created_at", -1)])
+        await db.stock_snapshots.create_index([("product_id", 1), ("as_of", -1)])
+        await db.stock_snapshots.create_index("as_of")
+        await db.products.create_index(
+            [("brand_id", 1), ("stock", 1)],
+            name="low_stock_brand_stock",
+            partialFilterExpression={"low_stock": True}
+        )
+        await db.stock_alerts.create_index([("brand_id", 1), ("created_at", -1)])
+        await db.stock_alerts.create_index("created_at")
+        await db.fx_rates.create_index("currency", unique=True)
+        await db.order_sketches.create_index([("day", 1), ("brand_id", 1)])
+        await db.outbox.create_index("id", unique=True)
+        await db.outbox.create_index([("status", 1), ("available_at", 1)])
+        await db.outbox.create_index("completed_at", expireAfterSeconds=OUTBOX_RETENTION_DAYS * 86400)
+        for collection in SYNC_PROJECTIONS:
+            await db[collection].create_index([("updated_seq", 1), ("id", 1)])
+        await db.tombstones.create_index([("collection", 1), ("updated_seq", 1), ("id", 1)])
+        await db.tombstones.create_index("deleted_at", expireAfterSeconds=SYNC_TOMBSTONE_DAYS * 86400)
         await db.users.create_index("email", unique=True)
         logger.info("Database indexes created successfully")
     except Exception as e:
         logger.warning(f"Index creation warning: {e}")
 
+# Sketches are kept per (brand, day). Pending in-memory deltas are merged into the persisted
+# document under an optimistic `rev` check, so several workers can flush the same key safely.
+_pending_sketches = {}
+
+def _new_sketch_set():
+    return {name: sketch_type() for name, sketch_type in ORDER_SKETCH_TYPES.items()}
+
+def record_order_sketches(order_dict: dict):
+    key = (order_dict["brand_id"], str(order_dict["created_at"])[:10])
+    sketches = _pending_sketches.get(key)
+    if sketches is None:
+        sketches = _pending_sketches[key] = _new_sketch_set()
+    
+    if order_dict.get("total_base") is not None:
+        sketches["order_value"].add(order_dict["total_base"])
+    sketches["basket_size"].add(sum(item.get("quantity", 0) for item in order_dict.get("items", [])))
+    customer_key = customer_sketch_key(order_dict.get("customer_email"), order_dict.get("customer_phone"))
+    if customer_key:
+        sketches["customers"].add(customer_key)
+
+def customer_sketch_key(email: Optional[str], phone: Optional[str]) -> Optional[str]:
+    if email:
+        return f"email:{email.strip().lower()}"
+    digits = "".join(ch for ch in (phone or "") if ch.isdigit())
+    return f"phone:{digits}" if digits else None
+
+async def _flush_sketch_key(key, sketches):
+    brand_id, day = key
+    doc_id = f"{brand_id}:{day}"
+    for _attempt in range(5):
+        existing = await db.order_sketches.find_one({"_id": doc_id})
+        merged = {}
+        for name, sketch_type in ORDER_SKETCH_TYPES.items():
+            merged[name] = sketch_type.from_doc(existing.get(name) if existing else None)
+            merged[name].merge(sketches[name])
+        
+        new_doc = {"_id": doc_id, "brand_id": brand_id, "day": day, "rev": (existing["rev"] + 1) if existing else 1, "updated_at": datetime.now(timezone.utc).isoformat()}
+        new_doc.update({name: sketch.to_doc() for name, sketch in merged.items()})
+        try:
+            if existing:
+                result = await db.order_sketches.replace_one({"_id": doc_id, "rev": existing["rev"]}, new_doc)
+                if result.matched_count:
+                    return
+            else:
+                await db.order_sketches.insert_one(new_doc)
+                return
+        except DuplicateKeyError:
+            pass
+    raise RuntimeError(f"Could not flush sketch {doc_id} after repeated write conflicts")
+
+async def flush_order_sketches():
+    pending = list(_pending_sketches.items())
+    _pending_sketches.clear()
+    for key, sketches in pending:
+        try:
+            await _flush_sketch_key(key, sketches)
+        except Exception as e:
+            logger.warning(f"Sketch flush failed for {key}: {e}")
+            current = _pending_sketches.setdefault(key, _new_sketch_set())
+            for name, sketch in sketches.items():
+                current[name].merge(sketch)
+
+# Per-product sales counters are write-behind: deltas accumulate here and are flushed with one
+# bulk_write every SALES_FLUSH_INTERVAL seconds or SALES_FLUSH_MAX_EVENTS orders, whichever comes first.
+_pending_sales = {}
+_pending_sales_events = 0
+_sales_flushes = set()
+
+def record_product_sales(order_dict: dict, sign: int = 1):
+    global _pending_sales_events
+    total, total_base = order_dict.get("total"), order_dict.get("total_base")
+    # Line totals are in the order currency; revenue is kept in the base currency
+    rate = total_base / total if total and total_base is not None else None
+    for item in order_dict.get("items", []):
+        pending = _pending_sales.setdefault(item["product_id"], {"units_sold": 0, "revenue": 0.0})
+        pending["units_sold"] += sign * item.get("quantity", 0)
+        if rate is not None:
+            pending["revenue"] += sign * item.get("total", 0) * rate
+    _pending_sales_events += 1
+    if _pending_sales_events >= SALES_FLUSH_MAX_EVENTS:
+        task = asyncio.create_task(flush_product_sales())
+        _sales_flushes.add(task)
+        task.add_done_callback(_sales_flushes.discard)
+
+def _requeue_sales(deltas):
+    for product_id, delta in deltas:
+        pending = _pending_sales.setdefault(product_id, {"units_sold": 0, "revenue": 0.0})
+        pending["units_sold"] += delta["units_sold"]
+        pending["revenue"] += delta["revenue"]
+
+async def flush_product_sales():
+    global _pending_sales_events
+    pending = [(pid, delta) for pid, delta in _pending_sales.items() if delta["units_sold"] or delta["revenue"]]
+    _pending_sales.clear()
+    _pending_sales_events = 0
+    if not pending:
+        return
+    try:
+        product_stamp = await stamp_update("products")
+        await db.products.bulk_write([
+            UpdateOne({"id": pid}, {"$inc": {"units_sold": delta["units_sold"], "revenue": round(delta["revenue"], 2)}, "$set": product_stamp})
+            for pid, delta in pending
+        ], ordered=False)
+    except BulkWriteError as e:
+        logger.warning(f"Sales counter flush failed for {len(e.details.get('writeErrors', []))} products")
+        _requeue_sales([pending[error["index"]] for error in e.details.get("writeErrors", [])])
+    except Exception as e:
+        logger.warning(f"Sales counter flush failed: {e}")
+        _requeue_sales(pending)
+
+async def drain_product_sales():
+    if _sales_flushes:
+        await asyncio.gather(*_sales_flushes, return_exceptions=True)
+    await flush_product_sales()
+
+async def load_order_sketches(brand_id: Optional[str], start_day: str, end_day: str):
+    query = {"day": {"$gte": start_day, "$lte": end_day}}
+    if brand_id:
+        query["brand_id"] = brand_id
+    
+    merged = _new_sketch_set()
+    async for doc in db.order_sketches.find(query):
+        for name, sketch_type in ORDER_SKETCH_TYPES.items():
+            merged[name].merge(sketch_type.from_doc(doc.get(name)))
+    
+    for (key_brand, day), sketches in list(_pending_sketches.items()):
+        if (not brand_id or key_brand == brand_id) and start_day <= day <= end_day:
+            for name, sketch in sketches.items():
+                merged[name].merge(sketch)
+    return merged
+
+def _sketch_day_range(start: Optional[str], end: Optional[str]):
+    today = datetime.now(timezone.utc).date()
+    try:
+        end_day = datetime.fromisoformat(end).date() if end else today
+        start_day = datetime.fromisoformat(start).date() if start else end_day - timedelta(days=29)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+    if start_day > end_day:
+        raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+    return start_day.isoformat(), end_day.isoformat()
+
+@api_router.get("/analytics/order-value-distribution")
+async def get_order_value_distribution(
+    brand_id: Optional[str] = None,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    _: dict = Depends(verify_token)
+):
+    start_day, end_day = _sketch_day_range(start, end)
+    sketches = await load_order_sketches(brand_id, start_day, end_day)
+    return {
+        "brand_id": brand_id,
+        "from": start_day,
+        "to": end_day,
+        "currency": BASE_CURRENCY,
+        "order_value": sketches["order_value"].summary(),
+        "basket_size": sketches["basket_size"].summary()
+    }
+
+@api_router.get("/analytics/unique-customers")
+async def get_unique_customers(
+    brand_id: Optional[str] = None,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    _: dict = Depends(verify_token)
+):
+    start_day, end_day = _sketch_day_range(start, end)
+    sketches = await load_order_sketches(brand_id, start_day, end_day)
+    return {
+        "brand_id": brand_id,
+        "from": start_day,
+        "to": end_day,
+        "unique_customers": sketches["customers"].estimate(),
+        "relative_error": round(sketches["customers"].relative_error, 4)
+    }
+
+async def _sketch_flush_loop():
+    while True:
+        await asyncio.sleep(SKETCH_FLUSH_INTERVAL)
+        await flush_order_sketches()
+
+async def _sales_flush_loop():
+    while True:
+        await asyncio.sleep(SALES_FLUSH_INTERVAL)
+        await flush_product_sales()
+
+_background_tasks = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    _background_tasks.append(asyncio.create_task(_sketch_flush_loop()))
+    _background_tasks.append(asyncio.create_task(_sales_flush_loop()))
+    for _ in range(OUTBOX_WORKERS):
+        _background_tasks.append(asyncio.create_task(_outbox_worker_loop()))
+    if ARCHIVE_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(_archive_loop()))
+    if STOCK_SNAPSHOT_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(_stock_snapshot_loop()))
+    if LOW_STOCK_WATCH_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(_low_stock_watch_loop()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in _background_tasks:
+        task.cancel()
+    await order_write_coalescer.drain()
+    await flush_order_sketches()
+    await drain_product_sales()
+
+@app.on_event("startup")
+async def stamp_unsynced_documents():
+    try:
+        for collection in SYNC_PROJECTIONS:
+            await db[collection].update_many({"updated_seq": {"$exists": False}}, {"$set": {"updated_seq": 0}})
+    except Exception as e:
+        logger.warning(f"Sync sequence backfill warning: {e}")
+
+@app.on_event("startup")
+async def drop_stock_batch_markers():
+    # Stock writes used to leave a single stock_batch marker behind; it is no longer read or projected out
+    try:
+        for collection in ("products", "stock_locations"):
+            await db[collection].update_many({"stock_batch": {"$exists": True}}, {"$unset": {"stock_batch": ""}})
+    except Exception as e:
+        logger.warning(f"Stock batch marker cleanup warning: {e}")
+
+@app.on_event("startup")
+async def warm_catalog_cache():
+    try:
+        await get_catalog()
+    except Exception as e:
+        logger.warning(f"Catalog cache warm-up warning: {e}")
+
+async def run_seed_once(marker: str, seed, label: str):
+    # One instance runs each one-shot seed. A seed that fails hands its marker back so the next start
+    # retries it; the seeds skip whatever an earlier attempt already wrote.
+    claimed = False
+    try:
+        result = await db.counters.update_one(
+            {"_id": marker},
+            {"$setOnInsert": {"at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+        claimed = result.upserted_id is not None
+        if claimed:
+            await seed()
+    except Exception as e:
+        logger.warning(f"{label} warning: {e}")
+        if claimed:
+            try:
+                await db.counters.delete_one({"_id": marker})
+            except Exception as e:
+                logger.warning(f"{label} could not release {marker}: {e}")
+
+async def _seed_stock_ledger():
+    tracked = set(await db.stock_movements.distinct("product_id"))
+    opening = {p["id"]: p["stock"] async for p in db.products.find({}, {"_id": 0, "id": 1, "stock": 1}) if p["id"] not in tracked}
+    await record_stock_movements(opening, "adjustment", "opening_balance")
+
+@app.on_event("startup")
+async def seed_stock_ledger():
+    # Products created before the ledger existed get one opening movement so ledger balances match stock
+    await run_seed_once("stock_ledger_seeded", _seed_stock_ledger, "Stock ledger seed")
+
+async def _seed_stock_locations():
+    located = set(await db.stock_locations.distinct("product_id"))
+    now = datetime.now(timezone.utc).isoformat()
+    rows = [
+        {"product_id": p["id"], "location": DEFAULT_WAREHOUSE, "stock": p["stock"], "updated_at": now}
+        async for p in db.products.find({}, {"_id": 0, "id": 1, "stock": 1}) if p["id"] not in located
+    ]
+    if rows:
+        await db.stock_locations.insert_many(rows, ordered=False)
+
+@app.on_event("startup")
+async def seed_stock_locations():
+    # Stock from before locations existed is placed in the default warehouse
+    await run_seed_once("stock_locations_seeded", _seed_stock_locations, "Stock location seed")
+
+async def _reindex_email_search_tokens():
+    reindexed = await reindex_order_search_tokens({"customer_email": {"$regex": r"^[^@]*[^\w@]"}})
+    if reindexed:
+        logger.info(f"Reindexed email search tokens on {reindexed} orders")
+
+@app.on_event("startup")
+async def reindex_email_search_tokens():
+    # Email prefixes used to be indexed with their punctuation; only local parts that have some need new tokens
+    await run_seed_once("order_search_email_compacted", _reindex_email_search_tokens, "Email search token reindex")
+
+@app.on_event("startup")
+async def seed_order_number_counter():
+    try:
+        order_count = await db.orders.count_documents({})
+        await db.counters.update_one({"_id": "order_number"}, {"$max": {"seq": order_count}}, upsert=True)
+    except Exception as e:
+        logger.warning(f"Order number counter warning: {e}")
+
+@app.on_event("startup")
+async def load_fx_rates():
+    try:
+        _version, rates = await get_fx_rates()
+        for currency, rate in rates.items():
+            filled = await backfill_total_base(currency, rate)
+            if filled:
+                logger.info(f"Backfilled total_base on {filled} {currency} orders")
+    except Exception as e:
+        logger.warning(f"FX rate load warning: {e}")
+
 app.include_router(api_router)
 
 app.add_middleware(
@@ -767,6 +4044,8 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    # Browsers only let scripts read these response headers when they are listed
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 logging.basicConfig(
@@ -1,7 +1,9 @@
 import requests
 import sys
+import time
 from datetime import datetime
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 class RihlaAPITester:
     def __init__(self, base_url="https://ecomm-command.preview.emergentagent.com/api"):
@@ -12,6 +14,8 @@ class RihlaAPITester:
         self.test_results = []
         self.created_order_id = None
         self.created_product_id = None
+        self.is_admin = False
+        self.imported_order = None
 
     def log_result(self, test_name, passed, status_code=None, message=""):
         """Log test result"""
@@ -103,6 +107,7 @@ class RihlaAPITester:
             200
         )
         if success and 'email' in response:
+            self.is_admin = response.get('role') == 'admin'
             print(f"   User: {response['email']}")
             return True
         return False
@@ -133,6 +138,91 @@ class RihlaAPITester:
             return True
         return False
 
+    def known_order(self, name, brand_id, quantity, price=25.0):
+        """Create a product and an order for it with a known total (no VAT, no shipping, base currency)"""
+        stamp = datetime.now().strftime('%H%M%S%f')
+        success, response = self.run_test(
+            f"{name} Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": f"KNOWN-{stamp}", "name": f"{name} Test Item", "brand_id": brand_id, "category": "Known", "price": price, "stock": quantity}]
+        )
+        if not (success and response.get('created') == 1):
+            return None
+        success, order = self.run_test(
+            f"{name} Setup Order",
+            "POST",
+            "orders",
+            200,
+            data={"customer_name": f"{name} Customer", "customer_email": "known@test.com", "brand_id": brand_id, "currency": "SAR",
+                  "apply_vat": False, "items": [{"product_id": response['results'][0]['id'], "quantity": quantity}]}
+        )
+        return order if success else None
+
+    def test_get_brands_summary(self):
+        """Test per-brand revenue in the summary moves by exactly one known order"""
+        success, before = self.run_test("Get Brands Summary (before)", "GET", "dashboard/brands-summary", 200)
+        if not success:
+            return False
+        order = self.known_order("Summary", "atelier", 2)
+        if not order:
+            return False
+        success, after = self.run_test("Get Brands Summary", "GET", "dashboard/brands-summary", 200)
+        if not success:
+            return False
+        success, metrics = self.run_test("Get Atelier Metrics", "GET", "dashboard/metrics?brand_id=atelier", 200)
+        if not success:
+            return False
+        rows = lambda summary: {b['brand_id']: (round(b['total_revenue'], 2), b['total_orders']) for b in summary['brands']}
+        old, new = rows(before), rows(after)
+        expected = dict(old, atelier=(round(old['atelier'][0] + 50.0, 2), old['atelier'][1] + 1))
+        total_moved = round(after['total']['total_revenue'] - before['total']['total_revenue'], 2) == 50.0
+        if order['total_base'] == 50.0 and new == expected and total_moved and new['atelier'] == (round(metrics['total_revenue'], 2), metrics['total_orders']):
+            print(f"   atelier {old['atelier']} -> {new['atelier']}, other brands unchanged, matches /dashboard/metrics")
+            return True
+        print(f"   Expected {expected}, got {new}; atelier metrics {metrics.get('total_revenue')}/{metrics.get('total_orders')}")
+        return False
+
+    def test_get_dashboard_bundle(self):
+        """Test batched dashboard sections match their own endpoints and are then served from cache"""
+        order = self.known_order("Bundle", "atelier", 1)
+        if not order:
+            return False
+        endpoint = "dashboard/bundle?parts=metrics,top_products,recent_orders&brand_id=atelier"
+        success, first = self.run_test("Get Dashboard Bundle", "GET", endpoint, 200)
+        if not success:
+            return False
+        standalone = {}
+        for part, path in (("metrics", "dashboard/metrics"), ("top_products", "dashboard/top-products"), ("recent_orders", "dashboard/recent-orders")):
+            success, standalone[part] = self.run_test(f"Get {part} alone", "GET", f"{path}?brand_id=atelier", 200)
+            if not success:
+                return False
+        success, second = self.run_test("Get Dashboard Bundle (cached)", "GET", endpoint, 200)
+        if not success:
+            return False
+        
+        key_fields = {
+            "metrics": lambda v: (round(v['total_revenue'], 2), v['total_orders']),
+            "top_products": lambda v: [(p['product_id'], p['quantity']) for p in v],
+            "recent_orders": lambda v: [o['id'] for o in v]
+        }
+        for part, meta in first['meta'].items():
+            print(f"   {part}: {meta['ms']}ms, cached: {meta['cached']}")
+            if meta['error']:
+                return False
+            # A section another run cached in the last DASHBOARD_CACHE_TTL seconds may predate the setup order
+            if not meta['cached'] and key_fields[part](first['data'][part]) != key_fields[part](standalone[part]):
+                print(f"   {part} differs from its endpoint: {first['data'][part]} vs {standalone[part]}")
+                return False
+        if not first['meta']['recent_orders']['cached'] and first['data']['recent_orders'][0]['id'] != order['id']:
+            print(f"   Setup order {order['order_number']} is not the most recent")
+            return False
+        if all(meta['cached'] for meta in second['meta'].values()) and second['data'] == first['data']:
+            return True
+        print(f"   Second request not served from cache: {second['meta']}")
+        return False
+
     def test_get_revenue_trend(self):
         """Test get revenue trend"""
         success, response = self.run_test(
@@ -146,6 +236,63 @@ class RihlaAPITester:
             return True
         return False
 
+    def test_get_order_value_distribution(self):
+        """Test the sketched p50 of orders imported onto an otherwise empty day"""
+        stamp = datetime.now().strftime('%H%M%S%f')
+        # A day nobody else has orders on, so the sketch holds only the nine orders below
+        day = f"20{int(stamp[:2]) % 9 + 1:02d}-{int(stamp[2:4]) % 12 + 1:02d}-{int(stamp[4:6]) % 28 + 1:02d}"
+        sku = f"P50-{stamp}"
+        success, response = self.run_test(
+            "Distribution Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": sku, "name": "Distribution Test Oud", "brand_id": "atelier", "category": "Oud", "price": 10.0, "stock": 45}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        rows = [
+            {"order_number": f"ORD-P50-{stamp}-{q}", "customer_name": "Distribution Customer", "customer_email": f"p50-{q}@test.com", "brand_id": "atelier",
+             "currency": "SAR", "apply_vat": False, "created_at": f"{day}T12:00:00+00:00", "items": [{"sku": sku, "quantity": q}]}
+            for q in range(1, 10)
+        ]
+        success, response = self.post_lines("Import Distribution Orders", "orders/import", rows, "application/x-ndjson", 200)
+        if not (success and response.get('imported') == 9):
+            return False
+        
+        # Sketches reach the database every SKETCH_FLUSH_INTERVAL seconds
+        deadline = time.time() + 45
+        while True:
+            success, response = self.run_test(
+                "Get Order Value Distribution",
+                "GET",
+                f"analytics/order-value-distribution?brand_id=atelier&from={day}&to={day}",
+                200
+            )
+            stats = response.get('order_value', {}) if success else {}
+            if stats.get('count') == 9 or not success or time.time() > deadline:
+                break
+            time.sleep(3)
+        # Order values are 10, 20, ... 90
+        if stats.get('count') == 9 and abs(stats['p50'] - 50.0) <= 1.0 and stats['min'] == 10.0 and stats['max'] == 90.0:
+            print(f"   Orders: {stats['count']}, p50: {stats['p50']}, p90: {stats['p90']}, p99: {stats['p99']}")
+            return True
+        print(f"   Expected 9 orders with p50 near 50 on {day}, got {stats}")
+        return False
+
+    def test_get_unique_customers(self):
+        """Test approximate distinct customers per brand"""
+        success, response = self.run_test(
+            "Get Unique Customers",
+            "GET",
+            "analytics/unique-customers?brand_id=atelier",
+            200
+        )
+        if success and 'unique_customers' in response:
+            print(f"   Unique customers: {response['unique_customers']} (±{response['relative_error'] * 100:.1f}%)")
+            return True
+        return False
+
     def test_create_order(self):
         """Test create order"""
         order_data = {
@@ -169,6 +316,20 @@ class RihlaAPITester:
             return True
         return False
 
+    def test_create_order_terminal_status(self):
+        """Test that orders cannot be created in a terminal status"""
+        success, response = self.run_test(
+            "Create Order As Returned",
+            "POST",
+            "orders",
+            400,
+            data={"customer_name": "Test Customer", "customer_email": "customer@test.com", "brand_id": "abaya", "items": [{"product_id": "any", "quantity": 1}], "status": "returned"}
+        )
+        if success:
+            print(f"   Rejected: {response.get('detail')}")
+            return True
+        return False
+
     def test_get_orders(self):
         """Test get orders"""
         success, response = self.run_test(
@@ -195,6 +356,21 @@ class RihlaAPITester:
             return True
         return False
 
+    def test_get_orders_projected(self):
+        """Test get orders with a field projection"""
+        success, response = self.run_test(
+            "Get Orders (fields)",
+            "GET",
+            "orders?fields=order_number,customer_name,total,status",
+            200
+        )
+        if success and isinstance(response, list):
+            allowed = {'id', 'order_number', 'customer_name', 'total', 'status'}
+            if all(set(order) <= allowed for order in response):
+                print(f"   Found {len(response)} slim orders")
+                return True
+        return False
+
     def test_update_order_status(self):
         """Test update order status"""
         if not self.created_order_id:
@@ -213,6 +389,72 @@ class RihlaAPITester:
             return True
         return False
 
+    def test_bulk_update_order_status(self):
+        """Test bulk order status transition"""
+        if not self.created_order_id:
+            print("⚠️  Skipping - No order ID available")
+            self.log_result("Bulk Update Order Status", False, None, "No order ID available")
+            return False
+        
+        success, response = self.run_test(
+            "Bulk Update Order Status",
+            "PUT",
+            "orders/status:bulk",
+            200,
+            data={"order_ids": [self.created_order_id], "status": "cancelled"}
+        )
+        if success and self.created_order_id in response.get('updated', []):
+            print(f"   Updated: {len(response['updated'])}, Errors: {len(response['errors'])}")
+            return True
+        return False
+
+    def test_search_orders(self):
+        """Test prefix search across orders"""
+        success, response = self.run_test(
+            "Search Orders",
+            "GET",
+            "orders/search?q=Test",
+            200
+        )
+        if success and 'results' in response:
+            print(f"   Found {len(response['results'])} orders, has more: {response['has_more']}")
+            return True
+        return False
+
+    def test_search_orders_by_email(self):
+        """Test that a full dotted email finds its order"""
+        stamp = datetime.now().strftime('%H%M%S%f')
+        success, response = self.run_test(
+            "Email Search Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": f"SRCH-{stamp}", "name": "Search Test Scarf", "brand_id": "abaya", "category": "Scarves", "price": 50.0, "stock": 5}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        email = f"sara.q{stamp}@x.com"
+        success, order = self.run_test(
+            "Email Search Setup Order",
+            "POST",
+            "orders",
+            200,
+            data={"customer_name": "Sara Q", "customer_email": email, "brand_id": "abaya", "items": [{"product_id": response['results'][0]['id'], "quantity": 1}]}
+        )
+        if not success:
+            return False
+        
+        success, response = self.run_test(
+            "Search Orders By Email",
+            "GET",
+            f"orders/search?q={email}",
+            200
+        )
+        if success and [r['id'] for r in response.get('results', [])] == [order['id']]:
+            print(f"   Found {order['order_number']} by {email}")
+            return True
+        return False
+
     def test_create_product(self):
         """Test create product"""
         product_data = {
@@ -268,6 +510,638 @@ class RihlaAPITester:
             return True
         return False
 
+    def location_stock(self, product_id):
+        """Total stock of a product across its locations"""
+        response = requests.get(f"{self.base_url}/inventory/locations?product_id={product_id}", headers={'Authorization': f'Bearer {self.token}'}, timeout=10)
+        return sum(row['stock'] for row in response.json())
+
+    def post_lines(self, name, endpoint, lines, content_type, expected_status):
+        """POST newline-delimited records as a raw body"""
+        print(f"\n🔍 Testing {name}...")
+        try:
+            response = requests.post(
+                f"{self.base_url}/{endpoint}",
+                data="\n".join(json.dumps(line) for line in lines),
+                headers={'Authorization': f'Bearer {self.token}', 'Content-Type': content_type},
+                timeout=10
+            )
+            passed = response.status_code == expected_status
+            print(f"{'✅ Passed' if passed else '❌ Failed'} - Status: {response.status_code}")
+            self.log_result(name, passed, response.status_code, "Success" if passed else f"Expected {expected_status}, got {response.status_code}")
+            return passed, response.json() if response.text else {}
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            self.log_result(name, False, None, str(e))
+            return False, {}
+
+    def test_bulk_upsert_products(self):
+        """Test bulk product upsert keyed by sku"""
+        sku = f"BULK-{datetime.now().strftime('%H%M%S')}"
+        success, response = self.run_test(
+            "Bulk Upsert Products",
+            "POST",
+            "products/bulk",
+            200,
+            data=[
+                {"sku": sku, "name": "Bulk Test Abaya", "brand_id": "abaya", "category": "Abayas", "price": 250.0, "stock": 10},
+                {"sku": sku, "stock_delta": 5}
+            ]
+        )
+        if not (success and response.get('created') == 1 and response.get('error') == 1):
+            return False
+        product_id = response['results'][0]['id']
+        if self.location_stock(product_id) != 10:
+            print("   Created product does not hold its initial stock")
+            return False
+        
+        success, response = self.run_test(
+            "Bulk Upsert Products (update)",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": sku, "price": 275.0, "stock_delta": 5}]
+        )
+        if not (success and response.get('updated') == 1):
+            return False
+        success, products = self.run_test(
+            "Bulk Upserted Product Fields",
+            "GET",
+            "products?brand_id=abaya&category=Abayas&min_price=275&max_price=275",
+            200
+        )
+        product = next((p for p in products if p.get('sku') == sku), None) if success else None
+        stock = self.location_stock(product_id)
+        if product and product['price'] == 275.0 and product['name'] == "Bulk Test Abaya" and product['stock'] == 15 and stock == 15:
+            print(f"   Created at 10, delta applied to {stock}, price updated to {product['price']}")
+            return True
+        return False
+
+    def test_catalog_reload(self):
+        """Test the product list serves catalog fields changed by an edit and by a bulk upsert"""
+        sku = f"CAT-{datetime.now().strftime('%H%M%S%f')}"
+        success, response = self.run_test(
+            "Catalog Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": sku, "name": "Catalog Test Scarf", "brand_id": "abaya", "category": "Scarves", "price": 90.0, "stock": 3}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        product_id = response['results'][0]['id']
+        listed = lambda products: next((p for p in products if p.get('id') == product_id), None)
+        # Load the catalog with the product in it before changing anything
+        success, products = self.run_test("Catalog Before Edit", "GET", "products?brand_id=abaya&category=Scarves", 200)
+        if not (success and listed(products)):
+            return False
+        
+        success, _ = self.run_test("Catalog Edit Product", "PUT", f"products/{product_id}", 200, data={"category": "Shawls"})
+        if not success:
+            return False
+        success, products = self.run_test("Catalog After Edit", "GET", "products?brand_id=abaya&category=Shawls", 200)
+        product = listed(products) if success else None
+        if not (product and product['category'] == "Shawls"):
+            print(f"   Edited category not served: {product}")
+            return False
+        
+        success, _ = self.run_test("Catalog Bulk Update", "POST", "products/bulk", 200, data=[{"sku": sku, "name": "Catalog Test Shawl", "price": 95.0}])
+        if not success:
+            return False
+        success, products = self.run_test("Catalog After Bulk Update", "GET", "products?brand_id=abaya&category=Shawls", 200)
+        product = listed(products) if success else None
+        if product and product['name'] == "Catalog Test Shawl" and product['price'] == 95.0:
+            print(f"   Served category {product['category']}, name {product['name']}, price {product['price']}")
+            return True
+        print(f"   Bulk-updated fields not served: {product}")
+        return False
+
+    def test_import_orders(self):
+        """Test order import with a bad row and the stock it takes"""
+        stamp = datetime.now().strftime('%H%M%S%f')
+        sku = f"IMP-{stamp}"
+        success, response = self.run_test(
+            "Import Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": sku, "name": "Import Test Scarf", "brand_id": "abaya", "category": "Scarves", "price": 100.0, "stock": 5}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        product_id = response['results'][0]['id']
+        
+        order_number = f"ORD-IMP-{stamp}"
+        rows = [
+            {"order_number": order_number, "customer_name": "Import Customer", "customer_email": "import@test.com", "brand_id": "abaya", "items": [{"sku": sku, "quantity": 2}]},
+            {"customer_name": "Import Customer", "brand_id": "abaya", "items": [{"sku": sku, "quantity": 1}]},
+            {"customer_name": "Import Customer", "customer_email": "import@test.com", "brand_id": "abaya", "items": [{"sku": sku, "quantity": 10}]}
+        ]
+        success, response = self.post_lines("Import Orders", "orders/import", rows, "application/x-ndjson", 200)
+        if not success:
+            return False
+        failed_rows = [error['row'] for error in response.get('errors', [])]
+        stock = self.location_stock(product_id)
+        self.imported_order = {"order_number": order_number, "product_id": product_id, "sku": sku}
+        if response.get('imported') == 1 and failed_rows == [2, 3] and stock == 3:
+            print(f"   Imported 1, rejected rows {failed_rows}, stock 5 -> {stock}")
+            return True
+        print(f"   Unexpected result: {response}, stock {stock}")
+        return False
+
+    def test_import_order_created_at_utc(self):
+        """Test that an imported created_at with an offset is stored in UTC"""
+        imported = self.imported_order
+        if not imported:
+            print("\n⏭️  Skipping Import Created At (no imported product)")
+            return True
+        order_number = f"ORD-TZ-{datetime.now().strftime('%H%M%S%f')}"
+        success, response = self.post_lines("Import Order With Offset", "orders/import", [{
+            "order_number": order_number, "customer_name": "Offset Customer", "customer_email": "offset@test.com",
+            "brand_id": "abaya", "created_at": "2025-03-01T02:00:00+03:00", "items": [{"sku": imported['sku'], "quantity": 1}]
+        }], "application/x-ndjson", 200)
+        if not (success and response.get('imported') == 1):
+            return False
+        export = requests.get(
+            f"{self.base_url}/orders/export?format=ndjson&brand_id=abaya&from=2025-02-28&to=2025-02-28",
+            headers={'Authorization': f'Bearer {self.token}'},
+            timeout=30
+        )
+        created = [json.loads(line)['created_at'] for line in export.text.splitlines() if line and json.loads(line)['order_number'] == order_number]
+        if created == ["2025-02-28T23:00:00+00:00"]:
+            print(f"   Stored as {created[0]}")
+            return True
+        print(f"   Expected 2025-02-28T23:00:00+00:00, got {created}")
+        return False
+
+    def test_export_orders_round_trip(self):
+        """Test that an exported order matches the import and cannot be imported twice"""
+        imported = self.imported_order
+        if not imported:
+            print("\n⏭️  Skipping Export Round Trip (no imported order)")
+            return True
+        print(f"\n🔍 Testing Export Orders...")
+        try:
+            response = requests.get(
+                f"{self.base_url}/orders/export?format=ndjson&brand_id=abaya&from={datetime.now().strftime('%Y-%m-%d')}",
+                headers={'Authorization': f'Bearer {self.token}'},
+                timeout=30
+            )
+            orders = [json.loads(line) for line in response.text.splitlines() if line]
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            self.log_result("Export Orders", False, None, str(e))
+            return False
+        exported = next((o for o in orders if o['order_number'] == imported['order_number']), None)
+        passed = (
+            response.status_code == 200 and exported is not None
+            and [(i['product_id'], i['quantity']) for i in exported['items']] == [(imported['product_id'], 2)]
+            and exported['subtotal'] == 200.0
+        )
+        print(f"{'✅ Passed' if passed else '❌ Failed'} - Status: {response.status_code}")
+        self.log_result("Export Orders", passed, response.status_code, "Success" if passed else "Imported order missing or changed in export")
+        if not passed:
+            return False
+        
+        success, response = self.post_lines("Re-import Exported Order", "orders/import", [exported], "application/x-ndjson", 200)
+        stock = self.location_stock(imported['product_id'])
+        if success and response.get('imported') == 0 and response['errors'][0]['error'] == "Duplicate order number" and stock == 3:
+            print(f"   Exported order rejected as a duplicate, stock stays at {stock}")
+            return True
+        return False
+
+    def test_reconcile_stock(self):
+        """Test that stock moved by these tests matches the ledger and locations"""
+        success, response = self.run_test(
+            "Reconcile Stock",
+            "GET",
+            "inventory/reconcile",
+            200
+        )
+        if not (success and 'mismatches' in response):
+            return False
+        mismatched = {row['id'] for row in response['mismatches']}
+        checked = [self.imported_order['product_id']] if self.imported_order else []
+        if not mismatched & set(checked):
+            print(f"   {len(response['mismatches'])} mismatches overall, none on the {len(checked)} products moved here")
+            return True
+        print(f"   Ledger or locations disagree with stock for {mismatched & set(checked)}")
+        return False
+
+    def test_get_low_stock_products(self):
+        """Test a product joins the low-stock list once it drops to its reorder level"""
+        sku = f"LOW-{datetime.now().strftime('%H%M%S%f')}"
+        success, response = self.run_test(
+            "Low Stock Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": sku, "name": "Low Stock Test Belt", "brand_id": "abaya", "category": "Belts", "price": 40.0, "stock": 5}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        product_id = response['results'][0]['id']
+        listed = lambda products: next((p for p in products if p.get('id') == product_id), None)
+        
+        success, _ = self.run_test("Low Stock Set Reorder Level", "PUT", f"products/{product_id}", 200, data={"reorder_level": 3})
+        if not success:
+            return False
+        success, response = self.run_test("Low Stock Products (above level)", "GET", "products/low-stock?brand_id=abaya", 200)
+        if not success or listed(response):
+            print("   Listed while stock 5 is above reorder level 3")
+            return False
+        
+        success, _ = self.run_test("Low Stock Count Down", "PUT", f"products/{product_id}", 200, data={"stock": 2})
+        if not success:
+            return False
+        success, response = self.run_test("Low Stock Products (below level)", "GET", "products/low-stock?brand_id=abaya", 200)
+        product = listed(response) if success else None
+        if product and product['stock'] == 2 and product['shortfall'] == 1:
+            print(f"   Listed at stock {product['stock']}, shortfall {product['shortfall']}")
+            return True
+        print(f"   Not listed after dropping below its reorder level: {product}")
+        return False
+
+    def test_suggest_products(self):
+        """Test a SKU match ranks ahead of a product that only has the same text in its name"""
+        code = f"SG{datetime.now().strftime('%H%M%S%f')}"
+        success, response = self.run_test(
+            "Suggest Setup Products",
+            "POST",
+            "products/bulk",
+            200,
+            data=[
+                {"sku": f"X-{code}", "name": f"{code} Oud Decoy", "brand_id": "abaya", "category": "Oud", "price": 80.0, "stock": 1},
+                {"sku": code, "name": "Suggest Test Musk", "brand_id": "abaya", "category": "Oud", "price": 80.0, "stock": 1}
+            ]
+        )
+        if not (success and response.get('created') == 2):
+            return False
+        decoy_id, sku_id = (row['id'] for row in response['results'])
+        success, response = self.run_test(
+            "Suggest Products",
+            "GET",
+            f"products/suggest?q={code[:-2].lower()}&brand_id=abaya&limit=5",
+            200
+        )
+        ids = [p['id'] for p in response] if success else []
+        if ids[:2] == [sku_id, decoy_id]:
+            print(f"   {response[0]['sku']} (SKU match) ranked ahead of '{response[1]['name']}'")
+            return True
+        print(f"   Expected the SKU match first, got {[(p['sku'], p['name']) for p in response] if success else response}")
+        return False
+
+    def test_get_stock_locations(self):
+        """Test per-location stock records"""
+        success, response = self.run_test(
+            "Stock Locations",
+            "GET",
+            "inventory/locations",
+            200
+        )
+        if success and isinstance(response, list):
+            print(f"   {len(response)} product/location stock records")
+            return True
+        return False
+
+    def test_get_returns(self):
+        """Test return (RMA) listing"""
+        success, response = self.run_test(
+            "Get Returns",
+            "GET",
+            "returns",
+            200
+        )
+        if success and isinstance(response, list):
+            print(f"   Found {len(response)} returns")
+            return True
+        return False
+
+    def test_partial_return(self):
+        """Test a partial return restocks and books only the returned quantity"""
+        stamp = datetime.now().strftime('%H%M%S%f')
+        success, response = self.run_test(
+            "Return Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": f"RMA-{stamp}", "name": "Return Test Abaya", "brand_id": "abaya", "category": "Abayas", "price": 100.0, "stock": 10}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        product_id = response['results'][0]['id']
+        success, order = self.run_test(
+            "Return Setup Order",
+            "POST",
+            "orders",
+            200,
+            data={"customer_name": "Return Customer", "customer_email": "return@test.com", "brand_id": "abaya", "status": "shipped", "items": [{"product_id": product_id, "quantity": 3}]}
+        )
+        if not success or self.location_stock(product_id) != 7:
+            return False
+        
+        success, order_return = self.run_test(
+            "Partial Return",
+            "POST",
+            "returns",
+            200,
+            data={"order_id": order['id'], "items": [{"product_id": product_id, "quantity": 2}], "restock": True}
+        )
+        if not success:
+            return False
+        success, movements = self.run_test(
+            "Return Movements",
+            "GET",
+            f"inventory/movements?product_id={product_id}",
+            200
+        )
+        booked = [m['quantity'] for m in movements if m.get('type') == 'return' and m.get('reference') == order_return['id']] if success else []
+        stock = self.location_stock(product_id)
+        if stock != 9 or booked != [2]:
+            print(f"   Expected stock 9 and one +2 return movement, got stock {stock} and {booked}")
+            return False
+        
+        success, response = self.run_test(
+            "Return Over Remaining Quantity",
+            "POST",
+            "returns",
+            400,
+            data={"order_id": order['id'], "items": [{"product_id": product_id, "quantity": 2}], "restock": True}
+        )
+        if success and self.location_stock(product_id) == 9:
+            print(f"   Returned 2 of 3 ({order_return['rma_number']}), stock 7 -> 9, second return rejected: {response.get('detail')}")
+            return True
+        return False
+
+    def sold_product(self, product_id, category, units_sold, timeout=20):
+        """Poll the product list until the write-behind sales counters reach units_sold"""
+        deadline = time.time() + timeout
+        while True:
+            response = requests.get(f"{self.base_url}/products?brand_id=abaya&category={category}", headers={'Authorization': f'Bearer {self.token}'}, timeout=10)
+            product = next((p for p in response.json() if p.get('id') == product_id), None)
+            if (product and product['units_sold'] == units_sold) or time.time() > deadline:
+                return product
+            time.sleep(1)
+
+    def test_product_sales_counters(self):
+        """Test units sold and revenue land on the product after a flush and come off again on cancellation"""
+        stamp = datetime.now().strftime('%H%M%S%f')
+        category = f"Sales{stamp}"
+        success, response = self.run_test(
+            "Sales Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": f"SOLD-{stamp}", "name": "Sales Test Abaya", "brand_id": "abaya", "category": category, "price": 100.0, "stock": 10}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        product_id = response['results'][0]['id']
+        success, order = self.run_test(
+            "Sales Setup Order",
+            "POST",
+            "orders",
+            200,
+            data={"customer_name": "Sales Customer", "customer_email": "sales@test.com", "brand_id": "abaya", "items": [{"product_id": product_id, "quantity": 2}]}
+        )
+        if not success:
+            return False
+        revenue = round(order['items'][0]['total'] * order['total_base'] / order['total'], 2)
+        product = self.sold_product(product_id, category, 2)
+        if not (product and product['units_sold'] == 2 and product['revenue'] == revenue):
+            print(f"   Expected 2 sold for {revenue} after the flush, got {product}")
+            return False
+        
+        success, _ = self.run_test("Sales Cancel Order", "PUT", f"orders/{order['id']}?status=cancelled", 200)
+        if not success:
+            return False
+        product = self.sold_product(product_id, category, 0)
+        if product and product['units_sold'] == 0 and product['revenue'] == 0:
+            print(f"   Sold 2 for {revenue}, back to 0 after cancelling {order['order_number']}")
+            return True
+        print(f"   Expected 0 sold after cancelling, got {product}")
+        return False
+
+    def test_concurrent_checkouts(self):
+        """Test simultaneous checkouts each write their own order (group-committed when WRITE_COALESCE_WINDOW_MS is set)"""
+        stamp = datetime.now().strftime('%H%M%S%f')
+        category = f"Rush{stamp}"
+        success, response = self.run_test(
+            "Checkout Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": f"RUSH-{stamp}", "name": "Checkout Test Oud", "brand_id": "abaya", "category": category, "price": 50.0, "stock": 6}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        product_id = response['results'][0]['id']
+        
+        print(f"\n🔍 Testing Concurrent Checkouts...")
+        headers = {'Authorization': f'Bearer {self.token}'}
+        order = {"customer_name": "Rush Customer", "customer_email": "rush@test.com", "brand_id": "abaya", "items": [{"product_id": product_id, "quantity": 1}]}
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            responses = list(pool.map(lambda _: requests.post(f"{self.base_url}/orders", json=order, headers=headers, timeout=10), range(6)))
+        orders = [r.json() for r in responses if r.status_code == 200]
+        passed = len(orders) == 6 and len({o['order_number'] for o in orders}) == 6
+        print(f"{'✅ Passed' if passed else '❌ Failed'} - {len(orders)}/6 checkouts written")
+        self.log_result("Concurrent Checkouts", passed, None, "Success" if passed else f"Statuses {[r.status_code for r in responses]}")
+        if not passed:
+            return False
+        
+        stock = self.location_stock(product_id)
+        product = self.sold_product(product_id, category, 6)
+        if stock == 0 and product and product['units_sold'] == 6:
+            print(f"   6 orders with distinct numbers, stock 6 -> 0, 6 units counted as sold")
+            return True
+        print(f"   Expected stock 0 and 6 sold, got stock {stock} and {product}")
+        return False
+
+    def test_get_purchase_orders(self):
+        """Test purchase order listing"""
+        success, response = self.run_test(
+            "Get Purchase Orders",
+            "GET",
+            "purchase-orders",
+            200
+        )
+        if success and isinstance(response, list):
+            print(f"   Found {len(response)} purchase orders")
+            return True
+        return False
+
+    def test_partial_receipt(self):
+        """Test that a partial goods receipt posts only the received quantity"""
+        stamp = datetime.now().strftime('%H%M%S%f')
+        success, response = self.run_test(
+            "Receipt Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": f"PO-{stamp}", "name": "Receipt Test Oud", "brand_id": "atelier", "category": "Oud", "price": 120.0, "stock": 2}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        product_id = response['results'][0]['id']
+        success, supplier = self.run_test("Create Supplier", "POST", "suppliers", 200, data={"name": f"Test Supplier {stamp}"})
+        if not success:
+            return False
+        success, purchase_order = self.run_test(
+            "Create Purchase Order",
+            "POST",
+            "purchase-orders",
+            200,
+            data={"supplier_id": supplier['id'], "lines": [{"product_id": product_id, "quantity": 10, "unit_cost": 60.0}]}
+        )
+        if not success:
+            return False
+        
+        success, _ = self.run_test(
+            "Receive Empty Lines",
+            "POST",
+            f"purchase-orders/{purchase_order['id']}/receive",
+            400,
+            data={"lines": []}
+        )
+        if not success or self.location_stock(product_id) != 2:
+            return False
+        
+        success, response = self.run_test(
+            "Receive Partial",
+            "POST",
+            f"purchase-orders/{purchase_order['id']}/receive",
+            200,
+            data={"lines": [{"product_id": product_id, "quantity": 4}]}
+        )
+        if not (success and response['status'] == 'open' and response['lines'][0]['received_quantity'] == 4 and self.location_stock(product_id) == 6):
+            return False
+        
+        success, response = self.run_test(
+            "Receive Remainder",
+            "POST",
+            f"purchase-orders/{purchase_order['id']}/receive",
+            200
+        )
+        stock = self.location_stock(product_id)
+        if success and response['status'] == 'received' and response['lines'][0]['received_quantity'] == 10 and stock == 12:
+            print(f"   Received 4 then 6 of 10 on {purchase_order['po_number']}, stock 2 -> {stock}")
+            return True
+        return False
+
+    def test_get_stock_as_of(self):
+        """Test stock balances from the movement ledger"""
+        success, response = self.run_test(
+            "Stock As Of",
+            "GET",
+            f"inventory/stock-as-of?date={datetime.now().strftime('%Y-%m-%d')}",
+            200
+        )
+        if success and 'balances' in response:
+            print(f"   {len(response['balances'])} products as of {response['as_of']}")
+            return True
+        return False
+
+    def test_products_not_modified(self):
+        """Test conditional GET on the product list"""
+        print(f"\n🔍 Testing Products ETag...")
+        headers = {'Authorization': f'Bearer {self.token}'}
+        try:
+            # Lists that changed within the last second are served without an ETag
+            time.sleep(1.5)
+            first = requests.get(f"{self.base_url}/products", headers=headers, timeout=10)
+            etag = first.headers.get('ETag')
+            second = requests.get(f"{self.base_url}/products", headers={**headers, 'If-None-Match': etag}, timeout=10)
+            passed = second.status_code == 304 and not second.content
+            print(f"{'✅ Passed' if passed else '❌ Failed'} - Status: {second.status_code}")
+            self.log_result("Products ETag", passed, second.status_code, "Success" if passed else f"Expected 304, got {second.status_code}")
+            return passed
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            self.log_result("Products ETag", False, None, str(e))
+            return False
+
+    def test_update_fx_rate(self):
+        """Test that an FX rate update is visible at the new version"""
+        if not self.is_admin:
+            print("\n⏭️  Skipping FX Rate Update (admin only)")
+            return True
+        success, updated = self.run_test(
+            "Update FX Rate",
+            "PUT",
+            "fx-rates/USD",
+            200,
+            data={"rate": 3.75}
+        )
+        if not success:
+            return False
+        
+        success, response = self.run_test(
+            "FX Rates After Update",
+            "GET",
+            "fx-rates",
+            200
+        )
+        rates = {rate['currency']: rate for rate in response.get('rates', [])}
+        if success and response.get('version', 0) >= updated['version'] and rates.get('USD', {}).get('rate') == 3.75:
+            print(f"   USD at {rates['USD']['rate']} from version {updated['version']}")
+            return True
+        return False
+
+    def test_run_archival(self):
+        """Test that an old closed order is archived and still exported once"""
+        if not self.is_admin:
+            print("\n⏭️  Skipping Order Archival (admin only)")
+            return True
+        stamp = datetime.now().strftime('%H%M%S%f')
+        success, response = self.run_test(
+            "Archival Setup Product",
+            "POST",
+            "products/bulk",
+            200,
+            data=[{"sku": f"ARCH-{stamp}", "name": "Archive Test Ring", "brand_id": "atelier", "category": "Rings", "price": 80.0, "stock": 5}]
+        )
+        if not (success and response.get('created') == 1):
+            return False
+        order_number = f"ORD-ARCH-{stamp}"
+        created_at = datetime(datetime.now().year - 3, 1, 15, 12, 0)
+        success, response = self.post_lines("Import Archivable Order", "orders/import", [{
+            "order_number": order_number, "customer_name": "Archive Customer", "customer_email": "archive@test.com",
+            "brand_id": "atelier", "status": "completed", "created_at": created_at.isoformat() + "+00:00",
+            "items": [{"sku": f"ARCH-{stamp}", "quantity": 1}]
+        }], "application/x-ndjson", 200)
+        if not (success and response.get('imported') == 1):
+            return False
+        
+        print(f"\n🔍 Testing Order Archival...")
+        try:
+            # The first run waits for every instance to see the new watermark before moving orders
+            headers = {'Authorization': f'Bearer {self.token}'}
+            archived = requests.post(f"{self.base_url}/admin/archive/run", headers=headers, timeout=120).json()
+            day = created_at.strftime('%Y-%m-%d')
+            export = requests.get(f"{self.base_url}/orders/export?format=ndjson&brand_id=atelier&from={day}&to={day}", headers=headers, timeout=30)
+            exported = [json.loads(line) for line in export.text.splitlines() if line]
+            numbers = [order['order_number'] for order in exported]
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            self.log_result("Order Archival", False, None, str(e))
+            return False
+        passed = archived.get('archived', 0) >= 1 and numbers.count(order_number) == 1
+        print(f"{'✅ Passed' if passed else '❌ Failed'} - Archived {archived.get('archived')}, exported {numbers.count(order_number)} copies")
+        self.log_result("Order Archival", passed, export.status_code, "Success" if passed else "Archived order missing or duplicated")
+        if not passed:
+            return False
+        
+        order_id = next(order['id'] for order in exported if order['order_number'] == order_number)
+        success, response = self.run_test(
+            "Return Archived Order",
+            "PUT",
+            f"orders/{order_id}?status=returned",
+            409
+        )
+        if success:
+            print(f"   Archived order refused: {response.get('detail')}")
+            return True
+        return False
+
     def test_get_customers(self):
         """Test get customers"""
         success, response = self.run_test(
@@ -281,6 +1155,29 @@ class RihlaAPITester:
             return True
         return False
 
+    def test_sync_changes(self):
+        """Test delta sync of orders, products and customers"""
+        success, response = self.run_test(
+            "Full Sync",
+            "GET",
+            "sync?limit=50",
+            200
+        )
+        if not success or 'token' not in response:
+            return False
+        
+        success, response = self.run_test(
+            "Delta Sync",
+            "GET",
+            f"sync?since={response['token']}",
+            200
+        )
+        if success and all(key in response for key in ('orders', 'products', 'customers')):
+            changed = sum(len(response[key]['changed']) for key in ('orders', 'products', 'customers'))
+            print(f"   {changed} documents changed since the full sync")
+            return True
+        return False
+
     def print_summary(self):
         """Print test summary"""
         print("\n" + "="*60)
@@ -332,16 +1229,25 @@ def main():
     print("📊 DASHBOARD TESTS")
     print("="*60)
     tester.test_get_dashboard_metrics()
+    tester.test_get_brands_summary()
+    tester.test_get_dashboard_bundle()
     tester.test_get_revenue_trend()
+    tester.test_get_order_value_distribution()
+    tester.test_get_unique_customers()
     
     # Orders tests
     print("\n" + "="*60)
     print("🛒 ORDERS TESTS")
     print("="*60)
     tester.test_create_order()
+    tester.test_create_order_terminal_status()
     tester.test_get_orders()
     tester.test_get_orders_filtered()
+    tester.test_get_orders_projected()
     tester.test_update_order_status()
+    tester.test_bulk_update_order_status()
+    tester.test_search_orders()
+    tester.test_search_orders_by_email()
     
     # Products tests
     print("\n" + "="*60)
@@ -350,12 +1256,32 @@ def main():
     tester.test_create_product()
     tester.test_get_products()
     tester.test_update_product_stock()
+    tester.test_bulk_upsert_products()
+    tester.test_catalog_reload()
+    tester.test_import_orders()
+    tester.test_export_orders_round_trip()
+    tester.test_import_order_created_at_utc()
+    tester.test_reconcile_stock()
+    tester.test_get_stock_as_of()
+    tester.test_get_low_stock_products()
+    tester.test_suggest_products()
+    tester.test_get_stock_locations()
+    tester.test_get_returns()
+    tester.test_partial_return()
+    tester.test_product_sales_counters()
+    tester.test_concurrent_checkouts()
+    tester.test_get_purchase_orders()
+    tester.test_partial_receipt()
+    tester.test_products_not_modified()
     
     # Customers tests
     print("\n" + "="*60)
     print("👥 CUSTOMERS TESTS")
     print("="*60)
     tester.test_get_customers()
+    tester.test_update_fx_rate()
+    tester.test_run_archival()
+    tester.test_sync_changes()
     
     # Print summary
     all_passed = tester.print_summary()
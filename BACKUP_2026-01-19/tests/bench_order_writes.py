@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+# Benchmarks order writes against a scratch database: per-request inserts vs the group-commit coalescer.
+# Usage: MONGO_URL=mongodb://localhost:27017 python tests/bench_order_writes.py [orders] [concurrency] [window_ms ...]
+os.environ.setdefault("DB_NAME", "rihla_write_bench")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import server
+
+
+def make_order(i):
+    now = datetime.now(timezone.utc).isoformat()
+    return {
+        "id": str(uuid.uuid4()),
+        "order_number": f"BENCH-{i:07d}",
+        "customer_name": f"Bench Customer {i % 500}",
+        "customer_email": f"bench{i % 500}@rihla.com",
+        "customer_phone": None,
+        "brand_id": "abaya",
+        "items": [{"product_id": "bench", "product_name": "Bench", "quantity": 1, "price": 100.0, "total": 100.0}],
+        "subtotal": 100.0,
+        "vat_amount": 15.0,
+        "total": 115.0,
+        "total_base": 115.0,
+        "currency": "SAR",
+        "status": "pending",
+        "created_at": now
+    }
+
+
+async def run_round(label, write, total, concurrency):
+    await server.db.orders.delete_many({"order_number": {"$regex": "^BENCH-"}})
+    await server.db.outbox.delete_many({})
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        order = make_order(i)
+        async with semaphore:
+            started = time.perf_counter()
+            await write(order, server.order_outbox_jobs(order))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    print(f"{label:<28} {total / elapsed:>10.0f} orders/s   p50 {p50:>7.1f} ms   p99 {p99:>7.1f} ms")
+
+
+async def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    windows = [float(w) for w in sys.argv[3:]] or [1, 2, 5]
+
+    print(f"🚀 {total} orders, {concurrency} concurrent checkouts, database {os.environ['DB_NAME']}")
+    print("=" * 80)
+
+    async def per_request(order, jobs):
+        await server.insert_orders_with_outbox([order], jobs)
+
+    await run_round("per-request writes", per_request, total, concurrency)
+    for window in windows:
+        coalescer = server.OrderWriteCoalescer(window, server.WRITE_COALESCE_MAX_DOCS)
+        await run_round(f"coalesced ({window:g} ms window)", coalescer.submit, total, concurrency)
+
+    await server.db.orders.delete_many({"order_number": {"$regex": "^BENCH-"}})
+    await server.db.outbox.delete_many({})
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+
+# Checks that the product list picks up catalog edits made by another instance and tags what it serves.
+# Needs a real MongoDB: MONGO_URL=mongodb://localhost:27017 pytest tests/test_catalog_cache.py
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="MONGO_URL is not set")
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+    from motor.motor_asyncio import AsyncIOMotorClient
+    import server
+
+    loop = asyncio.new_event_loop()
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"], io_loop=loop)
+    server.db = client[f"rihla_catalog_test_{uuid.uuid4().hex[:8]}"]
+    yield server, loop
+    loop.run_until_complete(client.drop_database(server.db.name))
+    loop.close()
+
+
+def list_products(server, loop, product_id):
+    from starlette.requests import Request
+    from starlette.responses import Response
+
+    response = Response()
+    request = Request({"type": "http", "method": "GET", "query_string": b"", "headers": []})
+    products = loop.run_until_complete(server.get_products(
+        request, response, brand_id=None, category=None, min_stock=None, max_stock=None, min_price=None,
+        max_price=None, sort="name", cursor=None, limit=1000, fields=None, _={}
+    ))
+    return next(p for p in products if p["id"] == product_id), response.headers.get("ETag")
+
+
+def other_instance_rename(server, loop, product_id, name):
+    # What update_product does on another instance: stamp, write, bump the catalog version
+    async def write():
+        await server.db.products.update_one({"id": product_id}, {"$set": {"name": name, **await server.stamp_update("products")}})
+        await server.db.counters.update_one({"_id": "catalog_version"}, {"$inc": {"seq": 1}}, upsert=True)
+    loop.run_until_complete(write())
+
+
+def test_other_instance_edit(catalog, monkeypatch):
+    server, loop = catalog
+    monkeypatch.setattr(server, "ETAG_SETTLE_SECONDS", 0)
+    monkeypatch.setattr(server, "ETAG_VERSION_TTL", 0)
+    product_id = str(uuid.uuid4())
+    loop.run_until_complete(server.db.products.insert_one({
+        "id": product_id, "sku": "CAT-1", "name": "Old Name", "brand_id": "abaya", "brand_name": "Abaya",
+        "category": "Scarves", "stock": 1, "price": 90.0, "created_at": "2025-01-01T00:00:00+00:00"
+    }))
+    product, first_tag = list_products(server, loop, product_id)
+    assert product["name"] == "Old Name"
+
+    other_instance_rename(server, loop, product_id, "New Name")
+    # Until this instance checks the catalog version again it serves the old name, under a tag naming the old catalog
+    stale, stale_tag = list_products(server, loop, product_id)
+    monkeypatch.setattr(server, "CATALOG_CACHE_TTL", 0)
+    fresh, fresh_tag = list_products(server, loop, product_id)
+    assert stale["name"] == "Old Name"
+    assert fresh["name"] == "New Name"
+    assert fresh_tag not in (first_tag, stale_tag)
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+
+# Checks that coalesced checkouts land as if each had been written on its own.
+# Needs a real MongoDB: MONGO_URL=mongodb://localhost:27017 pytest tests/test_order_coalescer.py
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="MONGO_URL is not set")
+
+
+@pytest.fixture(scope="module")
+def orders():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+    from motor.motor_asyncio import AsyncIOMotorClient
+    import server
+
+    loop = asyncio.new_event_loop()
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"], io_loop=loop)
+    server.client = client
+    server.db = client[f"rihla_coalesce_test_{uuid.uuid4().hex[:8]}"]
+    loop.run_until_complete(server.db.orders.create_index("order_number", unique=True))
+    yield server, loop
+    loop.run_until_complete(client.drop_database(server.db.name))
+    loop.close()
+
+
+def checkout(order_number):
+    order = {"id": str(uuid.uuid4()), "order_number": order_number}
+    return order, [{"id": str(uuid.uuid4()), "order_id": order["id"], "type": "order_rollups", "status": "pending"}]
+
+
+def written(server, loop, order_numbers):
+    async def read():
+        found = await server.db.orders.find({"order_number": {"$in": order_numbers}}, {"_id": 0, "id": 1, "order_number": 1}).to_list(None)
+        jobs = await server.db.outbox.find({"order_id": {"$in": [order["id"] for order in found]}}, {"_id": 0, "order_id": 1}).to_list(None)
+        return found, jobs
+    return loop.run_until_complete(read())
+
+
+def test_batch_with_duplicate(orders):
+    server, loop = orders
+    coalescer = server.OrderWriteCoalescer(window_ms=50, max_docs=100)
+    prefix = uuid.uuid4().hex[:6]
+    checkouts = [checkout(f"{prefix}-{i}") for i in range(4)] + [checkout(f"{prefix}-1")]
+
+    async def submit_all():
+        return await asyncio.gather(*(coalescer.submit(order, jobs) for order, jobs in checkouts), return_exceptions=True)
+    results = loop.run_until_complete(submit_all())
+
+    assert results[:4] == [None] * 4
+    assert isinstance(results[4], server.HTTPException) and results[4].status_code == 409
+    found, jobs = written(server, loop, [f"{prefix}-{i}" for i in range(4)])
+    assert {order["id"] for order in found} == {order["id"] for order, _ in checkouts[:4]}
+    assert sorted(job["order_id"] for job in jobs) == sorted(order["id"] for order, _ in checkouts[:4])
+
+
+def test_full_batch_flushes_before_window(orders):
+    server, loop = orders
+    coalescer = server.OrderWriteCoalescer(window_ms=60000, max_docs=3)
+    prefix = uuid.uuid4().hex[:6]
+    checkouts = [checkout(f"{prefix}-{i}") for i in range(3)]
+
+    async def submit_all():
+        return await asyncio.wait_for(asyncio.gather(*(coalescer.submit(order, jobs) for order, jobs in checkouts)), timeout=5)
+    assert loop.run_until_complete(submit_all()) == [None] * 3
+    found, jobs = written(server, loop, [f"{prefix}-{i}" for i in range(3)])
+    assert len(found) == len(jobs) == 3
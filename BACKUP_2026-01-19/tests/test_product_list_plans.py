@@ -0,0 +1,79 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+# Checks that every supported product listing runs as an index scan without an in-memory sort.
+# Needs a real MongoDB: MONGO_URL=mongodb://localhost:27017 pytest tests/test_product_list_plans.py
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="MONGO_URL is not set")
+
+CASES = [
+    ({}, "name", "products_list_name"),
+    ({"category": "dresses"}, "price", "products_list_price"),
+    ({"brand_id": "abaya"}, "-created_at", "products_list_brand_id_created_at"),
+    ({"brand_id": "abaya", "min_price": 50}, "price", "products_list_brand_id_price"),
+    ({"brand_id": "abaya", "category": "dresses"}, "name", "products_list_brand_id_category_name"),
+    ({"brand_id": "abaya", "category": "dresses", "min_stock": 5}, "-stock", "products_list_brand_id_category_stock"),
+    ({"brand_id": "perfume", "category": "oud", "max_price": 200}, "created_at", "products_list_brand_id_category_created_at"),
+]
+
+
+@pytest.fixture(scope="module")
+def products():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+    from pymongo import MongoClient
+    import server
+
+    client = MongoClient(os.environ["MONGO_URL"])
+    collection = client[f"rihla_plan_test_{uuid.uuid4().hex[:8]}"].products
+    collection.insert_many([
+        {
+            "id": str(uuid.uuid4()),
+            "sku": f"PLAN-{i:05d}",
+            "name": f"Product {i:05d}",
+            "brand_id": ["abaya", "perfume", "jewelry"][i % 3],
+            "category": ["dresses", "oud", "rings", "scarves"][i % 4],
+            "stock": i % 40,
+            "price": float(i % 300),
+            "created_at": f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}T00:00:00+00:00"
+        }
+        for i in range(3000)
+    ])
+    collection.create_index("id", unique=True)
+    collection.create_index("sku", unique=True)
+    collection.create_index("brand_id")
+    for name, keys in server.product_list_indexes():
+        collection.create_index(keys, name=name)
+    yield server, collection
+    client.drop_database(collection.database.name)
+
+
+def plan_stages(plan):
+    plan = plan.get("queryPlan", plan)
+    stages = [(plan.get("stage"), plan.get("indexName"))]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages += plan_stages(child)
+    return stages
+
+
+@pytest.mark.parametrize("filters,sort,index_name", CASES)
+def test_listing_uses_index(products, filters, sort, index_name):
+    server, collection = products
+    query, sort_spec = server.product_list_query(sort=sort, **filters)
+    stages = plan_stages(collection.find(query).sort(sort_spec).limit(50).explain()["queryPlanner"]["winningPlan"])
+    assert ("SORT", None) not in stages
+    assert ("IXSCAN", index_name) in stages
+
+
+@pytest.mark.parametrize("filters,sort,index_name", CASES)
+def test_next_page_uses_index(products, filters, sort, index_name):
+    server, collection = products
+    query, sort_spec = server.product_list_query(sort=sort, **filters)
+    last = list(collection.find(query).sort(sort_spec).limit(50))[-1]
+    cursor = server._encode_list_cursor(last[sort_spec[0][0]], last["id"])
+    query, sort_spec = server.product_list_query(sort=sort, cursor=cursor, **filters)
+    stages = plan_stages(collection.find(query).sort(sort_spec).limit(50).explain()["queryPlanner"]["winningPlan"])
+    assert ("SORT", None) not in stages
+    assert ("IXSCAN", index_name) in stages
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+
+# Checks which rows apply_stock_changes reports when part of a guarded batch cannot apply.
+# Needs a real MongoDB: MONGO_URL=mongodb://localhost:27017 pytest tests/test_stock_changes.py
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="MONGO_URL is not set")
+
+
+@pytest.fixture(scope="module")
+def stock():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+    from motor.motor_asyncio import AsyncIOMotorClient
+    import server
+
+    loop = asyncio.new_event_loop()
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"], io_loop=loop)
+    server.db = client[f"rihla_stock_test_{uuid.uuid4().hex[:8]}"]
+    loop.run_until_complete(server.db.stock_locations.create_index([("product_id", 1), ("location", 1)], unique=True))
+    yield server, loop
+    loop.run_until_complete(client.drop_database(server.db.name))
+    loop.close()
+
+
+def seed(server, loop, levels):
+    product_id = str(uuid.uuid4())
+    loop.run_until_complete(server.db.products.insert_one({"id": product_id, "stock": sum(levels.values())}))
+    loop.run_until_complete(server.db.stock_locations.insert_many([
+        {"product_id": product_id, "location": location, "stock": qty} for location, qty in levels.items()
+    ]))
+    return product_id
+
+
+def state(server, loop, product_id):
+    async def read():
+        levels = {row["location"]: row async for row in server.db.stock_locations.find({"product_id": product_id}, {"_id": 0})}
+        product = await server.db.products.find_one({"id": product_id})
+        movements = await server.db.stock_movements.find({"product_id": product_id}, {"_id": 0, "location": 1, "quantity": 1}).to_list(100)
+        return levels, product["stock"], movements
+    return loop.run_until_complete(read())
+
+
+def test_partial_guarded_batch(stock):
+    server, loop = stock
+    product_id = seed(server, loop, {"riyadh": 5, "jeddah": 1})
+    applied = loop.run_until_complete(server.apply_stock_changes(
+        {(product_id, "riyadh"): -2, (product_id, "jeddah"): -3}, "sale", "test", guarded=True
+    ))
+    levels, total, movements = state(server, loop, product_id)
+    assert applied == {(product_id, "riyadh")}
+    assert (levels["riyadh"]["stock"], levels["jeddah"]["stock"]) == (3, 1)
+    assert total == 4
+    assert movements == [{"location": "riyadh", "quantity": -2}]
+    assert not levels["riyadh"].get("applied_batches")
+
+
+def test_busy_row_still_reports_applied(stock):
+    # Earlier guarded batches on the same row must not push this batch's marker out
+    server, loop = stock
+    product_id = seed(server, loop, {"riyadh": 200, "jeddah": 0})
+    for _ in range(60):
+        loop.run_until_complete(server.apply_stock_changes({(product_id, "riyadh"): -1}, "sale", "busy", guarded=True))
+    applied = loop.run_until_complete(server.apply_stock_changes(
+        {(product_id, "riyadh"): -1, (product_id, "jeddah"): -1}, "sale", "test", guarded=True
+    ))
+    levels, total, movements = state(server, loop, product_id)
+    assert applied == {(product_id, "riyadh")}
+    assert levels["riyadh"]["stock"] == total == 139
+    assert len(movements) == 61